@@ -1,21 +1,48 @@
-from fastapi import FastAPI, HTTPException, Request, Response
+import time
+_boot_started = time.perf_counter()
+
+from fastapi import FastAPI, Header, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
 from starlette.middleware.base import BaseHTTPMiddleware
 from routes import schedules, testing
-from routes.matched import trigger_match_schedule, set_selected_timezone, set_firebase_ready
+from routes.matched import trigger_match_schedule, set_firebase_ready
 from routes import device_management
+from routes import events
+from routes import inventory as inventory_routes
+from routes import profiling as profiling_routes
 from pydantic import BaseModel, field_validator
-from firebase import initialize_firebase, is_firebase_initialized
-from database import init_device_db, get_device_db_path
-from context import firebase_config_store, qr_state
+from lazy_firebase import initialize_firebase, is_firebase_initialized, reset_firebase
+from database import init_device_db, get_device_db_path, connection_cache
+from context import firebase_config_store, qr_state, persist_context, restore_context
 from routes import configure
 from history import push_history, history_api
 from history.history import init_history_db
+from history import history_retention
+import backup
 import device_registry
+import audit_log
+import db_writer
+import health_monitor
+import event_stream
+import shared_state
+import scheduler_lease
+import profiling
+from dispatch_executor import dispatcher
+import device_settings
+import schedule_plan
+import storage
+from repositories import registry as registry_repo
+from db_executor import get_executor_stats, SCHEDULES_EXECUTOR, HISTORY_EXECUTOR
+from starlette.concurrency import run_in_threadpool
+import anyio.to_thread
 import re
 import os
 import json
-from typing import Callable
+import threading
+from typing import Callable, Optional
+from datetime import datetime
+from fastapi.responses import JSONResponse
+from rate_limit import client_address, limiter as rate_limiter, retry_after_header
 
 app = FastAPI()
 
@@ -30,38 +57,48 @@ app.add_middleware(
 # Simple email validation regex
 EMAIL_REGEX = re.compile(r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$')
 
+# List of endpoints that don't require email validation
+PUBLIC_ENDPOINTS = [
+    "/",
+    "/docs",
+    "/openapi.json",
+    "/health",
+    "/system_status",
+    "/register_firebase",
+    "/firebase_config",
+    "/reset_system",
+    "/device/check_access",
+    "/device/verify_ownership",
+]
+
+# Operator endpoints: no email, but the admin key is checked in the route and
+# requests are rate limited per client address
+ADMIN_ENDPOINTS = [
+    "/metrics",
+]
+
+# ✅ NEW: Device-only endpoints (ESP32 calls - no email needed)
+DEVICE_ONLY_ENDPOINTS = [
+    "/push_history",  # ESP32 logs medicine taken here
+    "/test_command",  # ESP32 can receive test commands
+]
+
+def matches_endpoint(path: str, endpoints) -> bool:
+    return any(path == endpoint or path.startswith(endpoint + "/") for endpoint in endpoints)
+
 # ✅ FIXED: Separate device endpoints from app endpoints
 class DeviceAuthMiddleware(BaseHTTPMiddleware):
     async def dispatch(self, request: Request, call_next: Callable) -> Response:
-        # List of endpoints that don't require email validation
-        public_endpoints = [
-            "/",
-            "/docs",
-            "/openapi.json",
-            "/health",
-            "/system_status",
-            "/register_firebase",
-            "/firebase_config",
-            "/reset_system",
-            "/device/check_access",
-            "/device/verify_ownership",
-        ]
-        
-        # ✅ NEW: Device-only endpoints (ESP32 calls - no email needed)
-        device_only_endpoints = [
-            "/push_history",  # ESP32 logs medicine taken here
-            "/test_command",  # ESP32 can receive test commands
-        ]
-        
         # Check if the path is public or device-only
         path = request.url.path
-        is_public = any(path == endpoint or path.startswith(endpoint + "/") for endpoint in public_endpoints)
-        is_device_only = any(path == endpoint or path.startswith(endpoint + "/") for endpoint in device_only_endpoints)
+        is_public = matches_endpoint(path, PUBLIC_ENDPOINTS)
+        is_device_only = matches_endpoint(path, DEVICE_ONLY_ENDPOINTS)
+        is_admin = matches_endpoint(path, ADMIN_ENDPOINTS)
         
         print(f"🔒 Middleware check: {request.method} {path} | Public: {is_public} | Device-only: {is_device_only}")
         
-        # Skip email validation for public and device-only endpoints
-        if is_public or is_device_only:
+        # Skip email validation for public, device-only and admin-key endpoints
+        if is_public or is_device_only or is_admin:
             if is_device_only:
                 print(f"✅ Device-only endpoint - no email validation required")
             return await call_next(request)
@@ -78,7 +115,7 @@ class DeviceAuthMiddleware(BaseHTTPMiddleware):
         
         if device_id:
             # Check if device is still active
-            is_registered = device_registry.is_device_registered(device_id)
+            is_registered = await registry_repo.ais_device_registered(device_id)
             
             if not is_registered:
                 print("❌ Device not registered")
@@ -88,7 +125,7 @@ class DeviceAuthMiddleware(BaseHTTPMiddleware):
                 )
             
             # Verify ownership matches
-            current_owner = device_registry.get_device_owner(device_id)
+            current_owner = await registry_repo.aget_device_owner(device_id)
             if owner_email and current_owner != owner_email:
                 print(f"❌ Ownership mismatch: {current_owner} vs {owner_email}")
                 raise HTTPException(
@@ -115,11 +152,8 @@ class DeviceAuthMiddleware(BaseHTTPMiddleware):
                             print(f"📧 Email from body: {request_email}")
                         except json.JSONDecodeError:
                             print("⚠️ Failed to parse JSON body")
-                        
-                        # Reset the body for route handlers
-                        async def receive():
-                            return {"type": "http.request", "body": body}
-                        request._receive = receive
+
+                        # The body read here is cached and handed to route handlers by Starlette
                 except Exception as e:
                     print(f"⚠️ Error reading body: {e}")
             
@@ -150,6 +184,13 @@ class DeviceAuthMiddleware(BaseHTTPMiddleware):
                     )
                 
                 print(f"✅ Authorized: {request_email}")
+
+                # Per-device/email limits only count requests that passed auth
+                limited = rate_limited(
+                    [("app_device", device_id), ("app_email", request_email)], path
+                )
+                if limited:
+                    return limited
             else:
                 print("❌ No email provided in request")
                 raise HTTPException(
@@ -160,17 +201,175 @@ class DeviceAuthMiddleware(BaseHTTPMiddleware):
         response = await call_next(request)
         return response
 
+class RateLimitMiddleware(BaseHTTPMiddleware):
+    """Sheds excess load with 429 per client address, before auth and database work happens"""
+    async def dispatch(self, request: Request, call_next: Callable) -> Response:
+        path = request.url.path
+        if matches_endpoint(path, PUBLIC_ENDPOINTS):
+            return await call_next(request)
+
+        client = client_address(request.client.host if request.client else None,
+                                request.headers.get("x-forwarded-for"))
+        if matches_endpoint(path, DEVICE_ONLY_ENDPOINTS):
+            # No auth here: the address bucket is checked first so one address cannot drain the device's
+            checks = [("device_client", client), ("device", firebase_config_store.get("device_id") or client)]
+        else:
+            checks = [("client", client)]
+        limited = rate_limited(checks, path)
+        if limited:
+            return limited
+
+        return await call_next(request)
+
+def rate_limited(checks, path: str) -> Optional[JSONResponse]:
+    """429 response if any of the (scope, key) buckets is empty, else None (tokens taken)"""
+    scope, wait = rate_limiter.check_all(checks)
+    if not wait:
+        return None
+    key = dict(checks)[scope]
+    print(f"🚦 Rate limited {scope}={key} on {path} (retry in {wait:.1f}s)")
+    return JSONResponse(
+        status_code=429,
+        headers={"Retry-After": retry_after_header(wait)},
+        content={
+            "detail": "Too many requests. Please slow down.",
+            "error_code": "RATE_LIMITED",
+            "retry_after": retry_after_header(wait)
+        }
+    )
+
 # ✅ IMPORTANT: Add middleware BEFORE including routers
 app.add_middleware(DeviceAuthMiddleware)
+# Added last so it runs first and rejects per-address floods before auth lookups
+app.add_middleware(RateLimitMiddleware)
+
+class ProfilingMiddleware(BaseHTTPMiddleware):
+    """Profiles admin-requested or sampled requests (installed only when enabled)"""
+    # Requests in flight and requests seen, so a capture can report how many overlapped it
+    in_flight = 0
+    arrivals = 0
+
+    async def dispatch(self, request: Request, call_next: Callable) -> Response:
+        ProfilingMiddleware.in_flight += 1
+        ProfilingMiddleware.arrivals += 1
+        try:
+            return await self._dispatch(request, call_next)
+        finally:
+            ProfilingMiddleware.in_flight -= 1
+
+    async def _dispatch(self, request: Request, call_next: Callable) -> Response:
+        reason = profiling.wants_profile(request.headers)
+        if reason is None or matches_endpoint(request.url.path, ["/admin/profiles"]):
+            return await call_next(request)
+        capture = profiling.begin()
+        if capture is None:
+            return await call_next(request)
+
+        # Their coroutines share the loop thread, so the profile includes them too
+        already_running = ProfilingMiddleware.in_flight - 1
+        arrivals_before = ProfilingMiddleware.arrivals
+        started = time.perf_counter()
+        try:
+            response = await call_next(request)
+        finally:
+            profiling.stop(capture)
+        duration_ms = (time.perf_counter() - started) * 1000
+        route = request.scope.get("route")
+        profile_id = await run_in_threadpool(
+            profiling.save, capture, "request", duration_ms,
+            concurrent_requests=already_running + ProfilingMiddleware.arrivals - arrivals_before,
+            method=request.method,
+            path=request.url.path,
+            route=getattr(route, "path", None),
+            device_id=firebase_config_store.get("device_id"),
+            status_code=response.status_code,
+            reason=reason,
+        )
+        if profile_id:
+            response.headers["X-Profile-Id"] = profile_id
+        return response
+
+# Outermost, so the profile covers rate limiting and auth too; absent unless enabled
+if profiling.PROFILING_ENABLED:
+    ADMIN_ENDPOINTS.append("/admin/profiles")
+    app.add_middleware(ProfilingMiddleware)
+
+# Seconds since the app module started importing, for cold-start tracking
+startup_timings = {"import_done": None, "startup_done": None, "warm": None}
+warm_restore_thread = None
+
+def warm_start_from_saved_context():
+    """Re-open the restored device's databases and Firebase in the background"""
+    device_id = firebase_config_store.get("device_id")
+    try:
+        if not device_registry.is_device_registered(device_id):
+            print(f"⚠️ Saved device {device_id} is no longer registered - waiting for QR code")
+            firebase_config_store.clear()
+            qr_state["received"] = False
+            persist_context()
+            return
+
+        init_device_db(device_id, firebase_config_store["firebase_url"], firebase_config_store["auth_token"])
+        init_history_db(device_id)
+        # The custom message used to live in the saved context; move it into the device settings
+        legacy_message = firebase_config_store.pop("dispensing_message", None)
+        if legacy_message:
+            device_settings.update_settings(device_id, dispensing_message=legacy_message)
+            persist_context()
+        initialize_firebase(firebase_url=firebase_config_store["firebase_url"])
+        set_firebase_ready(True)
+        health_monitor.request_refresh()
+        startup_timings["warm"] = round(time.perf_counter() - _boot_started, 3)
+        print(f"♻️ Device {device_id} restored and Firebase warm after {startup_timings['warm']}s")
+    except Exception as e:
+        print(f"❌ Failed to restore saved device context: {e}")
+
+def reload_shared_context(scope: str):
+    """Adopt a device context saved by another worker (QR scan, disconnect, reset)"""
+    previous_device = firebase_config_store.get("device_id")
+    if restore_context():
+        device_id = firebase_config_store["device_id"]
+        if device_id != previous_device or not is_firebase_initialized():
+            initialize_firebase(firebase_url=firebase_config_store["firebase_url"])
+        set_firebase_ready(True)
+        print(f"🔄 Device context for {device_id} loaded from another worker")
+    elif previous_device:
+        reset_firebase()
+        set_firebase_ready(False)
+        print("🔄 Device context cleared by another worker")
+    health_monitor.request_refresh()
+
+shared_state.on_change("context", reload_shared_context)
 
 @app.on_event("startup")
 def on_startup():
+    global warm_restore_thread
     print("🚀 MediChine API starting up...")
     print("📱 Initializing device registry database...")
     device_registry.init_registry_db()
-    print("📱 Waiting for QR code configuration...")
-    print("⚠️  Firebase will be initialized after QR code is scanned and sent to /register_firebase")
+    # Follow state changed by sibling workers (uvicorn --workers N)
+    shared_state.start()
+    event_stream.start()
+    if restore_context():
+        print(f"♻️ Restoring saved context for device {firebase_config_store['device_id']}...")
+        warm_restore_thread = threading.Thread(target=warm_start_from_saved_context, daemon=True)
+        warm_restore_thread.start()
+    else:
+        print("📱 Waiting for QR code configuration...")
+        print("⚠️  Firebase will be initialized after QR code is scanned and sent to /register_firebase")
     trigger_match_schedule()
+    health_monitor.start()
+    history_retention.start()
+    backup.start()
+    startup_timings["startup_done"] = round(time.perf_counter() - _boot_started, 3)
+
+@app.on_event("shutdown")
+def on_shutdown():
+    # Buffered audit rows and queued writes would otherwise be lost on a clean stop
+    audit_log.flush()
+    db_writer.flush_all(timeout=10)
+    # Let another worker take over scheduling without waiting for the lease to expire
+    scheduler_lease.release()
 
 # ✅ Include routers AFTER middleware
 app.include_router(schedules.router)
@@ -179,6 +378,10 @@ app.include_router(configure.router)
 app.include_router(push_history.router)
 app.include_router(history_api.router)
 app.include_router(device_management.router)
+app.include_router(events.router)
+app.include_router(inventory_routes.router)
+if profiling.PROFILING_ENABLED:
+    app.include_router(profiling_routes.router)
 
 @app.get("/")
 def root():
@@ -201,13 +404,20 @@ class TimezoneRequest(BaseModel):
         return v.lower()
 
 @app.post("/update_timezone")
-def update_timezone(req: TimezoneRequest):
+async def update_timezone(req: TimezoneRequest):
+    device_id = firebase_config_store.get("device_id")
+    if not device_id:
+        raise HTTPException(status_code=400, detail="❌ No device_id found. Please scan QR code.")
     try:
-        set_selected_timezone(req.timezone)
-        return {"message": f"Timezone set to {req.timezone}"}
-    except Exception as e:
+        tz_name = await run_in_threadpool(device_settings.set_timezone, device_id, req.timezone)
+    except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
 
+    # Fire instants are precomputed per timezone - rebuild them
+    schedule_plan.invalidate(device_id)
+    print(f"🌐 Timezone for {device_id} updated to: {tz_name}")
+    return {"message": f"Timezone set to {tz_name}", "device_id": device_id}
+
 class FirebaseConfig(BaseModel):
     firebase_url: str
     device_id: str
@@ -222,7 +432,7 @@ class FirebaseConfig(BaseModel):
         return v.lower()
 
 @app.post("/register_firebase")
-def register_firebase(config: FirebaseConfig):
+async def register_firebase(config: FirebaseConfig):
     try:
         print("📱 Received Firebase config from Flutter app (QR code scan)")
 
@@ -233,7 +443,7 @@ def register_firebase(config: FirebaseConfig):
             raise HTTPException(status_code=400, detail="Invalid Firebase URL from QR code. Must start with 'https://'")
 
         # Check device access and register
-        registration_result = device_registry.register_device(
+        registration_result = await registry_repo.aregister_device(
             config.device_id, 
             config.owner_email, 
             config.firebase_url
@@ -253,14 +463,16 @@ def register_firebase(config: FirebaseConfig):
             "owner_email": config.owner_email
         })
 
-        init_device_db(config.device_id, config.firebase_url, config.auth_token)
-        initialize_firebase(firebase_url=config.firebase_url)
-        init_history_db(config.device_id)
+        await SCHEDULES_EXECUTOR.run(init_device_db, config.device_id, config.firebase_url, config.auth_token)
+        await run_in_threadpool(initialize_firebase, firebase_url=config.firebase_url)
+        await HISTORY_EXECUTOR.run(init_history_db, config.device_id)
 
         qr_state["received"] = True
         set_firebase_ready(True)
+        await run_in_threadpool(persist_context)
+        health_monitor.request_refresh()
         
-        device_registry.update_last_connected(config.device_id)
+        await registry_repo.aupdate_last_connected(config.device_id)
 
         print(f"✅ Device registered: {config.device_id} -> {config.owner_email}")
 
@@ -301,25 +513,30 @@ def get_firebase_config():
         "firebase_initialized": is_firebase_initialized()
     }
 
+def snapshot_device_state(snapshot):
+    """(device_active, masked owner) for the configured device, from the health snapshot"""
+    database = snapshot.get("database") or {}
+    device_id = firebase_config_store.get("device_id")
+    if not device_id or snapshot.get("device_id") != device_id:
+        return False, None
+    return database.get("registered", False), database.get("owner")
+
 @app.get("/system_status")
-def system_status():
-    # Check if device is active
-    device_active = False
-    device_owner = None
-    if firebase_config_store and "device_id" in firebase_config_store:
-        device_id = firebase_config_store.get("device_id")
-        device_active = device_registry.is_device_registered(device_id) if device_id else False
-        if device_active:
-            device_owner = device_registry.get_device_owner(device_id)
+async def system_status():
+    # Served from the health monitor snapshot - no database access here
+    snapshot = health_monitor.get_snapshot()
+    device_active, device_owner = snapshot_device_state(snapshot)
     
     return {
         "api_running": True,
         "qr_config_received": qr_state["received"],
         "firebase_initialized": is_firebase_initialized(),
         "firebase_config_available": bool(firebase_config_store),
-        "device_registry_active": True,
+        "device_registry_active": (snapshot.get("database") or {}).get("registry", False),
         "device_connected": device_active,
-        "device_owner": device_owner[:3] + "***@" + device_owner.split('@')[1] if device_owner else None,
+        "device_owner": device_owner,
+        "scheduler_running": (snapshot.get("scheduler") or {}).get("ok", False),
+        "status_checked_at": snapshot.get("checked_at"),
         "next_step": (
             "✅ System ready" if is_firebase_initialized() and device_active
             else "📱 Please scan QR code to /register_firebase"
@@ -329,12 +546,14 @@ def system_status():
 @app.post("/reset_system")
 def reset_system():
     try:
-        from firebase import reset_firebase
+        from lazy_firebase import reset_firebase
         reset_firebase()
         qr_state["received"] = False
         firebase_config_store.clear()
         firebase_config_store.update({})
         set_firebase_ready(False)
+        persist_context()
+        health_monitor.request_refresh()
 
         return {
             "message": "✅ System reset complete. Please scan QR code again.",
@@ -345,30 +564,79 @@ def reset_system():
         raise HTTPException(status_code=500, detail=f"Failed to reset system: {e}")
 
 @app.get("/health")
-def health_check():
-    # Check device connection status
+async def health_check(response: Response):
+    # Served from the health monitor snapshot - no database access here
+    snapshot = health_monitor.get_snapshot()
+    database = snapshot.get("database") or {}
+    scheduler = snapshot.get("scheduler") or {}
+    notifications = snapshot.get("notifications") or {}
+
+    device_active, device_owner = snapshot_device_state(snapshot)
     device_status = "❌ Not connected"
-    device_owner = None
-    if firebase_config_store and "device_id" in firebase_config_store:
-        device_id = firebase_config_store.get("device_id")
-        if device_id and device_registry.is_device_registered(device_id):
-            device_status = "✅ Connected"
-            device_owner = device_registry.get_device_owner(device_id)
-        elif device_id:
-            device_status = "⚠️ Disconnected"
-    
+    if firebase_config_store.get("device_id"):
+        device_status = "✅ Connected" if device_active else "⚠️ Disconnected"
+
+    if snapshot["stale"] or not database.get("ok") or not scheduler.get("ok"):
+        status = "unhealthy"
+        response.status_code = 503
+    elif not notifications.get("ok", True):
+        status = "degraded"
+    else:
+        status = "healthy"
+
     return {
-        "status": "healthy",
-        "timestamp": __import__("datetime").datetime.now().isoformat(),
+        "status": status,
+        "timestamp": datetime.now().isoformat(),
+        "checked_at": snapshot.get("checked_at"),
+        "snapshot_age_seconds": snapshot["age_seconds"],
         "components": {
             "api": "✅ Running",
-            "database": "✅ Connected",
-            "device_registry": "✅ Active",
+            "database": "✅ Connected" if database.get("ok") else f"❌ {database.get('error') or 'Not checked'}",
+            "device_registry": "✅ Active" if database.get("registry") else "❌ Unreachable",
             "device_connection": device_status,
-            "device_owner": device_owner[:3] + "***@" + device_owner.split('@')[1] if device_owner else None,
+            "device_owner": device_owner,
             "qr_config": "✅ Received" if qr_state["received"] else "⏳ Waiting",
             "firebase": "✅ Initialized" if is_firebase_initialized() else "❌ Not initialized",
-            "scheduler": "✅ Running"
+            "scheduler": (
+                f"✅ Running (heartbeat {scheduler.get('heartbeat_age_seconds')}s ago)"
+                if scheduler.get("ok") else "❌ Stalled"
+            ),
+            "notifications": (
+                f"✅ {notifications.get('in_flight', 0)} in flight" if notifications.get("ok", True)
+                else f"⚠️ Backlog: {notifications.get('in_flight')} in flight"
+            ),
         },
         "ready_for_commands": is_firebase_initialized() and device_status == "✅ Connected"
-    }
\ No newline at end of file
+    }
+
+@app.get("/metrics")
+async def metrics(x_admin_key: Optional[str] = Header(None)):
+    """Threadpool occupancy, queue-wait and connection cache metrics - admin key required"""
+    if not profiling.is_admin(x_admin_key):
+        raise HTTPException(status_code=403, detail="Unauthorized")
+    limiter = anyio.to_thread.current_default_thread_limiter()
+    return {
+        "anyio_threadpool": {
+            "total_tokens": limiter.total_tokens,
+            "borrowed_tokens": limiter.borrowed_tokens,
+            "waiting": limiter.statistics().tasks_waiting,
+        },
+        "db_executors": get_executor_stats(),
+        "db_connection_cache": connection_cache.stats(),
+        "storage_backend": storage.backend.name,
+        "rate_limits": rate_limiter.stats(),
+        "db_writers": db_writer.stats(),
+        "registry": device_registry.stats(),
+        "audit_log": audit_log.stats(),
+        "event_stream": event_stream.stats(),
+        "dispatch": dispatcher.stats(),
+        "history_retention": history_retention.stats(),
+        "backups": backup.stats(),
+        "device_settings": device_settings.stats(),
+        "scheduler_lease": scheduler_lease.status(),
+        "shared_state": shared_state.stats(),
+        "profiling": profiling.stats(),
+        "startup_seconds": startup_timings
+    }
+
+startup_timings["import_done"] = round(time.perf_counter() - _boot_started, 3)
\ No newline at end of file
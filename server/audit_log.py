@@ -0,0 +1,137 @@
+"""
+Connection Audit Log
+Write-behind buffer for connection_history. Request handlers only append
+to memory; a background thread inserts rows in batched transactions and
+prunes rows older than the retention window a batch at a time.
+"""
+import os
+import threading
+import time
+from collections import deque
+from datetime import datetime, timedelta
+from typing import Dict
+import device_registry
+
+AUDIT_FLUSH_INTERVAL = float(os.environ.get("AUDIT_FLUSH_INTERVAL", "1.0"))
+AUDIT_FLUSH_BATCH = int(os.environ.get("AUDIT_FLUSH_BATCH", "200"))
+# Oldest rows are dropped if the database is unreachable for a long time
+AUDIT_BUFFER_MAX = int(os.environ.get("AUDIT_BUFFER_MAX", "10000"))
+AUDIT_RETENTION_DAYS = int(os.environ.get("AUDIT_RETENTION_DAYS", "90"))
+AUDIT_PRUNE_INTERVAL = 600
+AUDIT_PRUNE_BATCH = 500
+
+_buffer = deque()
+_lock = threading.Lock()
+_flush_lock = threading.Lock()
+_wake = threading.Event()
+_thread = None
+_last_prune = 0.0
+_stats = {"buffered": 0, "flushed": 0, "batches": 0, "dropped": 0, "pruned": 0, "flush_errors": 0}
+
+
+def record(device_id: str, email: str, action: str, success: bool, notes: str = ""):
+    """Queue one audit row (no disk I/O on the caller's thread)"""
+    # Same format and UTC clock as the column's CURRENT_TIMESTAMP default
+    timestamp = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+    with _lock:
+        if len(_buffer) >= AUDIT_BUFFER_MAX:
+            _buffer.popleft()
+            _stats["dropped"] += 1
+        _buffer.append((device_id, email, action, success, notes, timestamp))
+        _stats["buffered"] += 1
+        pending = len(_buffer)
+    _ensure_thread()
+    if pending >= AUDIT_FLUSH_BATCH:
+        _wake.set()
+
+
+def _insert_rows(conn, rows):
+    conn.executemany(
+        """INSERT INTO connection_history (device_id, email, action, success, notes, timestamp)
+           VALUES (?, ?, ?, ?, ?, ?)""",
+        rows
+    )
+
+
+def flush() -> int:
+    """Write every buffered row now. Returns the number of rows written."""
+    written = 0
+    with _flush_lock:
+        while True:
+            with _lock:
+                batch = [_buffer.popleft() for _ in range(min(len(_buffer), AUDIT_FLUSH_BATCH))]
+            if not batch:
+                return written
+            # Rows go to their device's registry shard; shards are written in parallel
+            groups = {}
+            for row in batch:
+                groups.setdefault(device_registry.shard_for(row[0]), []).append(row)
+            pending = [(rows, device_registry.shard_writer(shard).submit(_insert_rows, rows))
+                       for shard, rows in groups.items()]
+            failed, error = [], None
+            for rows, future in pending:
+                try:
+                    future.result()
+                except Exception as e:
+                    failed += rows
+                    error = e
+            written += len(batch) - len(failed)
+            with _lock:
+                _stats["flushed"] += len(batch) - len(failed)
+                _stats["batches"] += 1
+            if failed:
+                # Put the failed rows back in order and let the next cycle retry
+                with _lock:
+                    _buffer.extendleft(reversed(failed))
+                    _stats["flush_errors"] += 1
+                print(f"⚠️ Failed to flush {len(failed)} audit rows: {error}")
+                return written
+
+
+def prune_expired(retention_days: int = AUDIT_RETENTION_DAYS, batch_size: int = AUDIT_PRUNE_BATCH) -> int:
+    """Delete at most one batch of rows older than the retention window from each shard"""
+    cutoff = (datetime.utcnow() - timedelta(days=retention_days)).strftime("%Y-%m-%d %H:%M:%S")
+    deleted = 0
+    for shard in range(device_registry.REGISTRY_SHARDS):
+        deleted += device_registry.shard_writer(shard).write(lambda conn: conn.execute(
+            """DELETE FROM connection_history WHERE id IN (
+                   SELECT id FROM connection_history WHERE timestamp < ? LIMIT ?
+               )""",
+            (cutoff, batch_size)
+        ).rowcount)
+    with _lock:
+        _stats["pruned"] += deleted
+    return deleted
+
+
+def _run():
+    global _last_prune
+    while True:
+        _wake.wait(AUDIT_FLUSH_INTERVAL)
+        _wake.clear()
+        flush()
+
+        now = time.monotonic()
+        if now - _last_prune >= AUDIT_PRUNE_INTERVAL:
+            try:
+                # A full batch means more expired rows remain; come back next cycle
+                if prune_expired() < AUDIT_PRUNE_BATCH:
+                    _last_prune = now
+            except Exception as e:
+                _last_prune = now
+                print(f"⚠️ Audit retention prune failed: {e}")
+
+
+def _ensure_thread():
+    global _thread
+    if _thread is not None:
+        return
+    with _lock:
+        if _thread is None:
+            _thread = threading.Thread(target=_run, daemon=True, name="audit-log-writer")
+            _thread.start()
+
+
+def stats() -> Dict:
+    with _lock:
+        return {**_stats, "pending": len(_buffer)}
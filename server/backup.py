@@ -0,0 +1,361 @@
+"""
+Online Backups
+Backs up every SQLite file the server owns (schedules/history storage,
+the device registry, server state) while it keeps running.
+
+Each file is copied with SQLite's online backup API a few pages per step,
+sleeping between steps, inside one read transaction on the source: under
+WAL that pins a consistent snapshot without taking any lock writers wait
+on, and writes committed meanwhile do not restart the copy. Several files
+are backed up at once by a small worker pool.
+
+The copy is split into fixed-size chunks stored gzip-compressed under
+their sha256, so a snapshot only writes the chunks that changed since any
+earlier one, and files untouched since the last snapshot are not read at
+all. Each snapshot is a JSON manifest listing the chunks of every file;
+restoring a manifest rebuilds the files as they were when it was taken.
+
+Usage: python backup.py [--full]
+       python backup.py --list
+       python backup.py --restore [SNAPSHOT] [--at ISO_TIME] (--dest DIR | --in-place)
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+import storage
+import device_registry
+import scheduler_lease
+import state_store
+
+BACKUP_DIR = os.environ.get("BACKUP_DIR", os.path.join(state_store.DB_DIR, "backups"))
+BACKUP_INTERVAL = float(os.environ.get("BACKUP_INTERVAL", "3600"))
+BACKUP_KEEP = int(os.environ.get("BACKUP_KEEP", "48"))
+BACKUP_WORKERS = max(1, int(os.environ.get("BACKUP_WORKERS", "2")))
+BACKUP_PAGES_PER_STEP = int(os.environ.get("BACKUP_PAGES_PER_STEP", "64"))
+BACKUP_STEP_SLEEP_SECONDS = float(os.environ.get("BACKUP_STEP_SLEEP_MS", "5")) / 1000
+BACKUP_CHUNK_BYTES = int(os.environ.get("BACKUP_CHUNK_KB", "64")) * 1024
+BACKUP_COMPRESS_LEVEL = int(os.environ.get("BACKUP_COMPRESS_LEVEL", "6"))
+
+CHUNK_DIR = os.path.join(BACKUP_DIR, "chunks")
+SNAPSHOT_DIR = os.path.join(BACKUP_DIR, "snapshots")
+WORK_DIR = os.path.join(BACKUP_DIR, "work")
+
+_run_lock = threading.Lock()
+_thread = None
+_stats = {"runs": 0, "failed_runs": 0, "files_copied": 0, "files_unchanged": 0, "files_failed": 0,
+          "bytes_copied": 0, "bytes_stored": 0, "chunks_written": 0, "chunks_reused": 0,
+          "chunks_pruned": 0, "last_snapshot": None, "last_run_ms": None}
+
+
+def database_files() -> Dict[str, str]:
+    """Backup name -> path of every database file currently on disk"""
+    files = {}
+    for path in storage.backend.database_paths():
+        files[f"storage/{os.path.basename(path)}"] = path
+    registry = device_registry.shard_paths()
+    if device_registry.is_sharded():
+        registry.append(device_registry.OWNER_INDEX_PATH)
+    for path in registry:
+        files[f"registry/{os.path.basename(path)}"] = path
+    files[f"state/{os.path.basename(state_store.STATE_DB_PATH)}"] = state_store.STATE_DB_PATH
+    return {name: path for name, path in files.items() if os.path.exists(path)}
+
+
+def _signature(path: str) -> List[int]:
+    """Size and mtime of the file and its WAL; any committed write changes one of them"""
+    signature = []
+    for part in (path, path + "-wal"):
+        try:
+            st = os.stat(part)
+            signature += [st.st_size, st.st_mtime_ns]
+        except FileNotFoundError:
+            signature += [0, 0]
+    return signature
+
+
+def _throttle(status, remaining, total):
+    time.sleep(BACKUP_STEP_SLEEP_SECONDS)
+
+
+def copy_database(path: str, dest: str) -> int:
+    """Online copy of path into dest in page steps; returns the pages copied"""
+    src = sqlite3.connect(path, timeout=10.0, isolation_level=None, check_same_thread=False)
+    dst = sqlite3.connect(dest, isolation_level=None)
+    try:
+        src.execute("PRAGMA busy_timeout=10000")
+        src.execute("PRAGMA query_only=ON")
+        # Hold one read transaction for the whole copy: every step reads the
+        # same WAL snapshot, so concurrent commits neither block nor restart it
+        src.execute("BEGIN")
+        src.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+        dst.execute("PRAGMA journal_mode=OFF")
+        dst.execute("PRAGMA synchronous=OFF")
+        src.backup(dst, pages=BACKUP_PAGES_PER_STEP, progress=_throttle)
+        src.execute("COMMIT")
+        return dst.execute("PRAGMA page_count").fetchone()[0]
+    finally:
+        dst.close()
+        src.close()
+
+
+def _chunk_path(digest: str) -> str:
+    return os.path.join(CHUNK_DIR, digest[:2], digest + ".gz")
+
+
+def _store_chunks(image: str, counts: Dict) -> Dict:
+    """Split a copied file into content-addressed gzip chunks"""
+    chunks = []
+    whole = hashlib.sha256()
+    size = 0
+    with open(image, "rb") as f:
+        while True:
+            data = f.read(BACKUP_CHUNK_BYTES)
+            if not data:
+                break
+            whole.update(data)
+            size += len(data)
+            digest = hashlib.sha256(data).hexdigest()
+            chunks.append(digest)
+            target = _chunk_path(digest)
+            if os.path.exists(target):
+                counts["chunks_reused"] += 1
+                continue
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            tmp = f"{target}.{threading.get_ident()}.tmp"
+            with open(tmp, "wb") as out:
+                out.write(gzip.compress(data, BACKUP_COMPRESS_LEVEL))
+            os.replace(tmp, target)
+            counts["chunks_written"] += 1
+            counts["bytes_stored"] += os.path.getsize(target)
+            time.sleep(BACKUP_STEP_SLEEP_SECONDS)
+    return {"size": size, "sha256": whole.hexdigest(), "chunks": chunks}
+
+
+def backup_file(name: str, path: str, previous: Optional[Dict], full: bool = False) -> Dict:
+    """Manifest entry for one file, reusing the previous one if the file has not changed"""
+    signature = _signature(path)
+    if previous and not full and previous.get("signature") == signature:
+        return {**previous, "unchanged": True}
+
+    counts = {"chunks_written": 0, "chunks_reused": 0, "bytes_stored": 0}
+    os.makedirs(WORK_DIR, exist_ok=True)
+    image = os.path.join(WORK_DIR, name.replace("/", "_"))
+    started = datetime.now(timezone.utc)
+    try:
+        pages = copy_database(path, image)
+        entry = _store_chunks(image, counts)
+    finally:
+        if os.path.exists(image):
+            os.remove(image)
+    return {**entry, "path": path, "pages": pages, "signature": signature,
+            "backed_up_at": started.isoformat(), "unchanged": False, **counts}
+
+
+def list_snapshots() -> List[Dict]:
+    """Every snapshot manifest, oldest first"""
+    if not os.path.isdir(SNAPSHOT_DIR):
+        return []
+    snapshots = []
+    for name in sorted(os.listdir(SNAPSHOT_DIR)):
+        if name.endswith(".json"):
+            with open(os.path.join(SNAPSHOT_DIR, name)) as f:
+                snapshots.append(json.load(f))
+    return snapshots
+
+
+def _write_manifest(manifest: Dict):
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    target = os.path.join(SNAPSHOT_DIR, manifest["id"] + ".json")
+    with open(target + ".tmp", "w") as f:
+        json.dump(manifest, f)
+    os.replace(target + ".tmp", target)
+
+
+def prune(keep: int = BACKUP_KEEP, started: Optional[float] = None) -> Dict:
+    """Drop all but the newest keep snapshots and every chunk none of them uses"""
+    snapshots = list_snapshots()
+    removed = snapshots[:-keep] if keep > 0 else []
+    for snapshot in removed:
+        os.remove(os.path.join(SNAPSHOT_DIR, snapshot["id"] + ".json"))
+
+    live = {digest for snapshot in snapshots[len(removed):]
+            for entry in snapshot["files"].values() for digest in entry["chunks"]}
+    started = started or time.time()
+    pruned = 0
+    if os.path.isdir(CHUNK_DIR):
+        for prefix in os.listdir(CHUNK_DIR):
+            directory = os.path.join(CHUNK_DIR, prefix)
+            for name in os.listdir(directory):
+                path = os.path.join(directory, name)
+                # Chunks written after this run started may belong to a snapshot still being taken
+                if name[:-len(".gz")] not in live and os.path.getmtime(path) < started:
+                    os.remove(path)
+                    pruned += 1
+    return {"snapshots": len(removed), "chunks": pruned}
+
+
+def run_backup(full: bool = False) -> Dict:
+    """Take one snapshot of every database file; returns its manifest"""
+    with _run_lock:
+        started = time.time()
+        snapshots = list_snapshots()
+        previous = snapshots[-1]["files"] if snapshots else {}
+        files = database_files()
+        snapshot_id = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%fZ")
+
+        entries, failed = {}, []
+        with ThreadPoolExecutor(max_workers=BACKUP_WORKERS, thread_name_prefix="backup") as pool:
+            futures = {name: pool.submit(backup_file, name, path, previous.get(name), full)
+                       for name, path in files.items()}
+            for name, future in futures.items():
+                try:
+                    entries[name] = future.result()
+                except Exception as e:
+                    print(f"⚠️ Backup of {name} failed: {e}")
+                    failed.append(name)
+                    if name in previous:
+                        entries[name] = {**previous[name], "unchanged": True}
+
+        manifest = {"id": snapshot_id, "created_at": datetime.fromtimestamp(started, timezone.utc).isoformat(),
+                    "files": entries, "failed": failed}
+        _write_manifest(manifest)
+        pruned = prune(BACKUP_KEEP, started)
+
+        copied = [e for e in entries.values() if not e["unchanged"]]
+        _stats["runs"] += 1
+        _stats["failed_runs"] += 1 if failed else 0
+        _stats["files_copied"] += len(copied)
+        _stats["files_unchanged"] += len(entries) - len(copied)
+        _stats["files_failed"] += len(failed)
+        _stats["bytes_copied"] += sum(e["size"] for e in copied)
+        _stats["bytes_stored"] += sum(e["bytes_stored"] for e in copied)
+        _stats["chunks_written"] += sum(e["chunks_written"] for e in copied)
+        _stats["chunks_reused"] += sum(e["chunks_reused"] for e in copied)
+        _stats["chunks_pruned"] += pruned["chunks"]
+        _stats["last_snapshot"] = snapshot_id
+        _stats["last_run_ms"] = round((time.time() - started) * 1000, 1)
+        print(f"💾 Backup {snapshot_id}: {len(copied)} copied, {len(entries) - len(copied)} unchanged, "
+              f"{len(failed)} failed, {sum(e['bytes_stored'] for e in copied)} bytes stored")
+        return manifest
+
+
+def find_snapshot(snapshot_id: Optional[str] = None, at: Optional[datetime] = None) -> Dict:
+    """The snapshot with this id, else the newest taken at or before at, else the newest"""
+    snapshots = list_snapshots()
+    if snapshot_id:
+        matches = [s for s in snapshots if s["id"] == snapshot_id]
+    elif at:
+        if at.tzinfo is None:
+            at = at.astimezone(timezone.utc)
+        matches = [s for s in snapshots if datetime.fromisoformat(s["created_at"]) <= at]
+    else:
+        matches = snapshots
+    if not matches:
+        raise ValueError("No matching backup snapshot")
+    return matches[-1]
+
+
+def restore_file(entry: Dict, target: str):
+    """Rebuild one file from its chunks, verified against the recorded sha256"""
+    os.makedirs(os.path.dirname(target) or ".", exist_ok=True)
+    tmp = target + ".restore"
+    whole = hashlib.sha256()
+    with open(tmp, "wb") as out:
+        for digest in entry["chunks"]:
+            with open(_chunk_path(digest), "rb") as f:
+                data = gzip.decompress(f.read())
+            whole.update(data)
+            out.write(data)
+    if whole.hexdigest() != entry["sha256"]:
+        os.remove(tmp)
+        raise ValueError(f"checksum mismatch restoring {target}")
+    # A leftover WAL from the replaced file would be replayed over the restored one
+    for suffix in ("-wal", "-shm"):
+        if os.path.exists(target + suffix):
+            os.remove(target + suffix)
+    os.replace(tmp, target)
+    conn = sqlite3.connect(target)
+    try:
+        result = conn.execute("PRAGMA quick_check").fetchone()[0]
+    finally:
+        conn.close()
+    if result != "ok":
+        raise ValueError(f"restored {target} failed quick_check: {result}")
+
+
+def restore_snapshot(snapshot_id: Optional[str] = None, at: Optional[datetime] = None,
+                     dest_dir: Optional[str] = None) -> Dict:
+    """
+    Restore every file of a snapshot, into dest_dir/<name> or (dest_dir None)
+    over the original paths - only with the server stopped.
+    """
+    snapshot = find_snapshot(snapshot_id, at)
+    for name, entry in snapshot["files"].items():
+        target = os.path.join(dest_dir, name) if dest_dir else entry["path"]
+        restore_file(entry, target)
+        print(f"✅ Restored {name} ({entry['size']} bytes, as of {entry['backed_up_at']}) -> {target}")
+    return snapshot
+
+
+def _run():
+    while True:
+        time.sleep(BACKUP_INTERVAL)
+        if not scheduler_lease.is_leader():
+            continue  # one worker backs up the shared files
+        try:
+            run_backup()
+        except Exception as e:
+            print(f"⚠️ Backup run failed: {e}")
+
+
+def start():
+    global _thread
+    if _thread is None and BACKUP_INTERVAL > 0:
+        _thread = threading.Thread(target=_run, daemon=True, name="backup")
+        _thread.start()
+
+
+def stats() -> Dict:
+    return {**_stats, "interval_seconds": BACKUP_INTERVAL, "keep": BACKUP_KEEP, "workers": BACKUP_WORKERS}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Online backups of the server's SQLite files")
+    parser.add_argument("--full", action="store_true", help="copy every file even if unchanged")
+    parser.add_argument("--list", action="store_true")
+    parser.add_argument("--restore", nargs="?", const="", metavar="SNAPSHOT")
+    parser.add_argument("--at", help="restore the newest snapshot taken at or before this ISO time")
+    parser.add_argument("--dest", help="restore into this directory")
+    parser.add_argument("--in-place", action="store_true", help="restore over the live files (server stopped)")
+    args = parser.parse_args()
+
+    if args.list:
+        for snapshot in list_snapshots():
+            changed = sum(1 for entry in snapshot["files"].values() if not entry["unchanged"])
+            print(f"{snapshot['id']}  {snapshot['created_at']}  {len(snapshot['files'])} files, "
+                  f"{changed} copied, {len(snapshot['failed'])} failed")
+        return
+    if args.restore is not None:
+        if not args.dest and not args.in_place:
+            parser.error("--restore needs --dest DIR or --in-place")
+        try:
+            at = datetime.fromisoformat(args.at) if args.at else None
+            restore_snapshot(args.restore or None, at, None if args.in_place else args.dest)
+        except ValueError as e:
+            parser.error(str(e))
+        return
+
+    manifest = run_backup(full=args.full)
+    print(f"📦 {manifest['id']}: {len(manifest['files'])} files")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+"""
+Benchmark: history write latency while a backup runs
+
+Seeds several devices' history files, then measures save_history_record
+latency from a paced writer thread three times: with no backup, during a
+full unthrottled backup (whole file per step, no sleeps) and during a full
+throttled one (the defaults). A second, incremental snapshot is then taken
+and both snapshots are restored into a scratch directory and checked
+against the row counts seen when each was taken. Exits 1 if a restore
+does not match.
+
+Usage: python benchmarks/bench_backup.py [devices] [rows_per_device]
+Default: 8 devices, 20000 rows each.
+"""
+import contextlib
+import io
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+SCRATCH = tempfile.mkdtemp(prefix="bench_backup_")
+os.environ["DB_DIR"] = SCRATCH
+os.environ["BACKUP_DIR"] = os.path.join(SCRATCH, "backups")
+os.environ["BACKUP_INTERVAL"] = "0"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import backup
+import storage
+from history.history import history_db_writer, init_history_db
+from history.history_writer import save_history_record
+
+WRITE_PACE_SECONDS = 0.005
+BASELINE_SECONDS = 3.0
+
+
+def seed(device_ids, rows: int):
+    for device_id in device_ids:
+        init_history_db(device_id)
+        history_db_writer(device_id).write(lambda conn, device_id=device_id: conn.executemany(
+            "INSERT INTO history (device_id, medicine_name, container_id, quantity, scheduled_time, "
+            "scheduled_days, datetime_taken, time_taken) VALUES (?, ?, ?, 1, '08:00 AM', 'Mon', ?, '08:00 AM')",
+            [(device_id, f"Medicine {n % 40}", n % 8 + 1, "2026-01-01 08:00:00") for n in range(rows)]
+        ))
+
+
+def measure_writes(device_id: str, during=None) -> dict:
+    """Paced writes for BASELINE_SECONDS, or for as long as during() runs"""
+    latencies, stop = [], threading.Event()
+
+    def write_loop():
+        while not stop.is_set():
+            started = time.perf_counter()
+            save_history_record(device_id, "Bench", 1, 1, "08:00 AM", "Mon", "2026-02-01 08:00:00", "08:00 AM")
+            latencies.append(time.perf_counter() - started)
+            time.sleep(WRITE_PACE_SECONDS)
+
+    thread = threading.Thread(target=write_loop)
+    with contextlib.redirect_stdout(io.StringIO()):
+        thread.start()
+        started = time.perf_counter()
+        result = during() if during else time.sleep(BASELINE_SECONDS)
+        elapsed = time.perf_counter() - started
+        stop.set()
+        thread.join()
+
+    latencies.sort()
+    return {
+        "writes": len(latencies),
+        "p50_ms": latencies[len(latencies) // 2] * 1000,
+        "p99_ms": latencies[int(len(latencies) * 0.99)] * 1000,
+        "max_ms": latencies[-1] * 1000,
+        "elapsed_s": elapsed,
+        "result": result,
+    }
+
+
+def row_counts(device_ids, root=None) -> dict:
+    counts = {}
+    for device_id in device_ids:
+        path = storage.history_path(device_id)
+        if root:
+            path = os.path.join(root, "storage", os.path.basename(path))
+        conn = sqlite3.connect(path)
+        try:
+            counts[device_id] = conn.execute("SELECT COUNT(*) FROM history").fetchone()[0]
+        finally:
+            conn.close()
+    return counts
+
+
+def main():
+    devices = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    rows = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+    storage.set_backend(storage.PerDeviceBackend(os.path.join(SCRATCH, "devices")))
+    os.makedirs(storage.backend.base_dir)
+    device_ids = [f"AA:BB:{i:05d}" for i in range(devices)]
+    ok = True
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            seed(device_ids, rows)
+        hot = device_ids[0]
+        print(f"devices={devices} rows_per_device={rows} "
+              f"pages_per_step={backup.BACKUP_PAGES_PER_STEP} step_sleep_ms={backup.BACKUP_STEP_SLEEP_SECONDS * 1000:g} "
+              f"workers={backup.BACKUP_WORKERS}")
+
+        runs = [("no backup", measure_writes(hot))]
+
+        pages, pause = backup.BACKUP_PAGES_PER_STEP, backup.BACKUP_STEP_SLEEP_SECONDS
+        backup.BACKUP_PAGES_PER_STEP, backup.BACKUP_STEP_SLEEP_SECONDS = -1, 0.0
+        runs.append(("unthrottled backup", measure_writes(hot, backup.run_backup)))
+        backup.BACKUP_PAGES_PER_STEP, backup.BACKUP_STEP_SLEEP_SECONDS = pages, pause
+        # Start the throttled run from an empty store too, so both compress every chunk
+        shutil.rmtree(backup.BACKUP_DIR)
+
+        # Writes are paced on the hot device, so its count is only final once the writer stops
+        throttled = measure_writes(hot, backup.run_backup)
+        first_counts = row_counts(device_ids)
+        runs.append(("throttled backup", throttled))
+
+        for label, run in runs:
+            print(f"{label:20s} writes={run['writes']:5d} p50={run['p50_ms']:7.2f}ms "
+                  f"p99={run['p99_ms']:7.2f}ms max={run['max_ms']:7.2f}ms backup={run['elapsed_s']:6.2f}s")
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            incremental_started = time.perf_counter()
+            incremental = backup.run_backup()
+        copied = [e for e in incremental["files"].values() if not e["unchanged"]]
+        print(f"incremental: {len(copied)} of {len(incremental['files'])} files copied, "
+              f"{sum(e['chunks_written'] for e in copied)} chunks written, "
+              f"{sum(e['chunks_reused'] for e in copied)} reused, "
+              f"{time.perf_counter() - incremental_started:.2f}s")
+
+        full = throttled["result"]
+        stored = sum(e["bytes_stored"] for e in full["files"].values())
+        size = sum(e["size"] for e in full["files"].values())
+        print(f"full snapshot: {size / 1e6:.1f} MB of databases stored as {stored / 1e6:.1f} MB")
+
+        for snapshot, expected in ((full, first_counts), (incremental, row_counts(device_ids))):
+            target = os.path.join(SCRATCH, "restore", snapshot["id"])
+            with contextlib.redirect_stdout(io.StringIO()):
+                backup.restore_snapshot(snapshot["id"], dest_dir=target)
+            restored = row_counts(device_ids, target)
+            # The hot device may gain rows between its copy and the writer stopping
+            matches = all(restored[d] == expected[d] for d in device_ids[1:]) and restored[hot] <= expected[hot]
+            print(f"restore {snapshot['id']}: {'ok' if matches else 'MISMATCH'}")
+            ok = ok and matches
+    finally:
+        shutil.rmtree(SCRATCH, ignore_errors=True)
+
+    if not ok:
+        print("❌ A restored snapshot did not match the databases it was taken from")
+        sys.exit(1)
+    print("✅ Every snapshot restored to the rows it was taken with")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""
+Benchmark: open-per-call SQLite connections vs the cached connection LRU
+
+Simulates schedule traffic spread over many devices (one insert + one
+indexed read per op) and reports ops/sec for both strategies.
+
+Usage: python benchmarks/bench_connection_cache.py [devices] [ops]
+"""
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database
+import storage
+
+def _insert(conn, container_id):
+    conn.execute(
+        "INSERT INTO schedules (container_id, name, time, days, quantity) VALUES (?, ?, ?, ?, ?)",
+        (container_id, "Bench", "08:00 AM", "Mon,Tue", 1)
+    )
+
+
+def _read(conn, container_id):
+    conn.execute("SELECT id FROM schedules WHERE container_id = ?", (container_id,)).fetchall()
+
+
+def bench_open_per_call(device_ids, ops):
+    """Baseline: new connection with default PRAGMAs on every call"""
+    start = time.perf_counter()
+    for _ in range(ops):
+        conn = sqlite3.connect(database.get_device_db_path(random.choice(device_ids), "", ""))
+        try:
+            container_id = random.randint(1, 4)
+            _insert(conn, container_id)
+            _read(conn, container_id)
+            conn.commit()
+        finally:
+            conn.close()
+    return ops / (time.perf_counter() - start)
+
+
+def bench_cached(device_ids, ops):
+    """Per-file writers for the insert, cached read connections for the read"""
+    start = time.perf_counter()
+    for _ in range(ops):
+        device_id = random.choice(device_ids)
+        container_id = random.randint(1, 4)
+        database.device_db_writer(device_id).write(_insert, container_id)
+        with database.device_connection(device_id) as conn:
+            _read(conn, container_id)
+    return ops / (time.perf_counter() - start)
+
+
+def main():
+    devices = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    ops = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database.BASE_DIR = tmp
+        storage.set_backend(storage.PerDeviceBackend(tmp))
+        device_ids = [f"bench-{i}" for i in range(devices)]
+        for device_id in device_ids:
+            conn = sqlite3.connect(database.get_device_db_path(device_id, "", ""))
+            database.ensure_schedules_schema(conn, device_id)
+            conn.close()
+
+        random.seed(1)
+        baseline = bench_open_per_call(device_ids, ops)
+        random.seed(1)
+        cached = bench_cached(device_ids, ops)
+        stats = database.connection_cache.stats()
+        database.connection_cache.close_all()
+
+    print(f"devices={devices} ops={ops}")
+    print(f"open-per-call : {baseline:10.1f} ops/sec")
+    print(f"cached LRU    : {cached:10.1f} ops/sec  ({cached / baseline:.1f}x)")
+    print(f"cache stats   : {stats}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""
+Benchmark: parallel QR scans against the device registry
+
+Many threads register, re-register (as another owner) and disconnect
+devices at once, the way simultaneous QR scans hit /register_firebase.
+Every operation goes through the registry's single writer, so none may
+fail; the writer's batch sizes show how much contention was absorbed.
+Exits 1 if any write failed.
+
+Usage: python benchmarks/bench_registration_concurrency.py [threads] [devices] [rounds]
+"""
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def scan(device_registry, device_id: str, email: str) -> str:
+    result = device_registry.register_device(device_id, email, "https://bench.firebaseio.com")
+    if result["success"]:
+        device_registry.disconnect_device(device_id, email)
+    return result.get("action") or result.get("error_code")
+
+
+def main():
+    threads = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    devices = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    rounds = int(sys.argv[3]) if len(sys.argv) > 3 else 50
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["DB_DIR"] = tmp
+        import device_registry
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            device_registry.init_registry_db()
+
+        # Several owners competing for the same few devices
+        jobs = [(f"AA:BB:{n % devices:05d}", f"user{n % 3}@example.com") for n in range(threads * rounds)]
+
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            with ThreadPoolExecutor(max_workers=threads) as pool:
+                outcomes = list(pool.map(lambda job: scan(device_registry, *job), jobs))
+        elapsed = time.perf_counter() - start
+
+        import audit_log
+        audit_log.flush()
+        with device_registry.get_db_connection() as conn:
+            audit_rows = conn.execute("SELECT COUNT(*) FROM connection_history").fetchone()[0]
+        writer = device_registry.registry_writer().stats()
+
+    counts = {outcome: outcomes.count(outcome) for outcome in set(outcomes)}
+    print(f"threads={threads} devices={devices} scans={len(jobs)}")
+    print(f"scans/s={len(jobs) / elapsed:8.1f} outcomes={counts} audit_rows={audit_rows}")
+    print(f"writer batches={writer['batches']} avg_batch={writer['avg_batch']} "
+          f"max_batch={writer['max_batch']} failed={writer['failed']}")
+
+    if writer["failed"] or writer["batch_failures"]:
+        print("❌ Registry writes failed")
+        sys.exit(1)
+    print("✅ Every registry write succeeded")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+"""
+Benchmark: registry write throughput at 1, 4 and 16 shards
+
+Several worker processes (like uvicorn workers) register devices, touch
+last_connected, write audit rows and disconnect every tenth device, each
+process on its own slice of the fleet. With one shard every write in the
+fleet contends for device_registry.db; with N shards writers in different
+processes mostly hit different files. Shards also split each process's
+writer batches (fewer writes share a commit), so they only pay off once
+workers on separate cores are waiting on the one file - run this on the
+deployment's core count before raising REGISTRY_SHARDS.
+
+Afterwards get_user_devices is checked for every owner against the
+expected active devices, so routing through the owner index is verified
+too. Exits 1 on a failed write or a wrong owner listing.
+
+Usage: python benchmarks/bench_registry_shards.py [workers] [devices_per_worker] [touches] [shards ...]
+Default: 4 workers, 500 devices each, 4 touches, shards 1 4 16.
+"""
+import contextlib
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_SHARDS = (1, 4, 16)
+THREADS_PER_WORKER = 8
+OWNERS = 50
+
+
+def _devices(worker: int, devices: int):
+    return [(f"AA:{worker:02d}:{n:05d}", f"user{n % OWNERS}@example.com", n % 10 == 0) for n in range(devices)]
+
+
+def run_worker(worker: int, devices: int, touches: int, start_at: float) -> dict:
+    import audit_log
+    import db_writer
+    import device_registry
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        device_registry.init_registry_db()
+
+    def lifecycle(device):
+        device_id, email, leaves = device
+        ops = 0
+        if device_registry.register_device(device_id, email, "https://bench.firebaseio.com")["success"]:
+            ops += 1
+        for _ in range(touches):
+            device_registry.update_last_connected(device_id)
+            device_registry.log_connection_attempt(device_id, email, "connect", True)
+            ops += 1
+        if leaves and device_registry.disconnect_device(device_id, email)["success"]:
+            ops += 1
+        return ops
+
+    time.sleep(max(0.0, start_at - time.time()))
+    started = time.time()
+    with ThreadPoolExecutor(max_workers=THREADS_PER_WORKER) as pool:
+        ops = sum(pool.map(lifecycle, _devices(worker, devices)))
+    audit_log.flush()
+    finished = time.time()
+
+    writers = db_writer.stats()
+    return {"ops": ops, "started": started, "finished": finished,
+            "failed": writers["failed"] + writers["batch_failures"], "avg_batch": writers["avg_batch"]}
+
+
+def verify(workers: int, devices: int) -> dict:
+    import device_registry
+
+    expected = {}
+    for worker in range(workers):
+        for device_id, email, leaves in _devices(worker, devices):
+            if not leaves:
+                expected.setdefault(email, set()).add(device_id)
+    wrong = [email for email, device_ids in expected.items()
+             if {d["device_id"] for d in device_registry.get_user_devices(email)} != device_ids]
+    audit_rows = 0
+    for path in device_registry.shard_paths():
+        with device_registry.read_connection(path) as conn:
+            audit_rows += conn.execute("SELECT COUNT(*) FROM connection_history").fetchone()[0]
+    return {"wrong_owners": len(wrong), "audit_rows": audit_rows}
+
+
+def measure(shards: int, workers: int, devices: int, touches: int) -> dict:
+    with tempfile.TemporaryDirectory() as tmp:
+        env = {**os.environ, "DB_DIR": tmp, "REGISTRY_SHARDS": str(shards)}
+        start_at = time.time() + 2.0  # after every worker has imported and initialized
+        children = [
+            subprocess.Popen(
+                [sys.executable, os.path.abspath(__file__), "--worker", str(worker), str(devices),
+                 str(touches), str(start_at)],
+                cwd=SERVER_DIR, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True,
+            )
+            for worker in range(workers)
+        ]
+        results = []
+        for child in children:
+            stdout, stderr = child.communicate()
+            if child.returncode != 0:
+                raise RuntimeError(f"worker failed:\n{stderr[-2000:]}")
+            results.append(json.loads(stdout.strip().splitlines()[-1]))
+
+        checked = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--verify", str(workers), str(devices)],
+            cwd=SERVER_DIR, env=env, capture_output=True, text=True,
+        )
+        if checked.returncode != 0:
+            raise RuntimeError(f"verify failed:\n{checked.stderr[-2000:]}")
+        verified = json.loads(checked.stdout.strip().splitlines()[-1])
+
+    elapsed = max(r["finished"] for r in results) - min(r["started"] for r in results)
+    ops = sum(r["ops"] for r in results)
+    return {
+        "shards": shards,
+        "ops": ops,
+        "ops_per_s": round(ops / elapsed, 1),
+        "elapsed_s": round(elapsed, 2),
+        "avg_batch": round(sum(r["avg_batch"] for r in results) / len(results), 2),
+        "failed": sum(r["failed"] for r in results),
+        **verified,
+    }
+
+
+def main():
+    args = sys.argv[1:]
+    if args[:1] == ["--worker"]:
+        sys.path.insert(0, SERVER_DIR)
+        print(json.dumps(run_worker(int(args[1]), int(args[2]), int(args[3]), float(args[4]))))
+        return
+    if args[:1] == ["--verify"]:
+        sys.path.insert(0, SERVER_DIR)
+        print(json.dumps(verify(int(args[1]), int(args[2]))))
+        return
+
+    workers = int(args[0]) if len(args) > 0 else 4
+    devices = int(args[1]) if len(args) > 1 else 500
+    touches = int(args[2]) if len(args) > 2 else 4
+    shard_counts = [int(arg) for arg in args[3:]] or list(DEFAULT_SHARDS)
+    # touches plus the register row of every device and the disconnect row of every tenth
+    expected_audit = workers * sum(touches + 1 + leaves for _, _, leaves in _devices(0, devices))
+
+    print(f"workers={workers} devices_per_worker={devices} touches={touches}")
+    ok = True
+    for shards in shard_counts:
+        result = measure(shards, workers, devices, touches)
+        print(f"shards={result['shards']:3d} ops/s={result['ops_per_s']:9.1f} elapsed={result['elapsed_s']:6.2f}s "
+              f"avg_batch={result['avg_batch']:5.2f} failed={result['failed']} "
+              f"wrong_owners={result['wrong_owners']} audit_rows={result['audit_rows']}")
+        if result["failed"] or result["wrong_owners"] or result["audit_rows"] != expected_audit:
+            ok = False
+
+    if not ok:
+        print("❌ Registry writes failed or owner listings were wrong")
+        sys.exit(1)
+    print("✅ Every write succeeded and every owner listing matched")
+
+
+if __name__ == "__main__":
+    main()
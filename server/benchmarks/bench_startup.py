@@ -0,0 +1,66 @@
+"""
+Startup-time benchmark
+
+Boots the app in a fresh interpreter (import + startup handlers) and
+measures how long until it serves /health and, when a saved device
+context exists, until Firebase and the scheduler are warm again.
+
+Usage: python benchmarks/bench_startup.py [runs]
+Run once after a QR registration to exercise the warm-restore path.
+"""
+import json
+import os
+import subprocess
+import sys
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_CHILD = r"""
+import json, time
+t0 = time.perf_counter()
+import app
+from fastapi.testclient import TestClient
+t_import = time.perf_counter() - t0
+with TestClient(app.app) as client:
+    client.get("/health")
+    t_serving = time.perf_counter() - t0
+    warm = None
+    if app.warm_restore_thread is not None:
+        app.warm_restore_thread.join(timeout=5)
+        if app.startup_timings["warm"] is not None:
+            warm = time.perf_counter() - t0
+print(json.dumps({"import": t_import, "serving": t_serving, "warm": warm}))
+"""
+
+
+def boot_once() -> dict:
+    result = subprocess.run(
+        [sys.executable, "-c", _CHILD],
+        cwd=SERVER_DIR,
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr[-2000:])
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    samples = [boot_once() for _ in range(runs)]
+
+    def fmt(key):
+        values = [s[key] for s in samples if s[key] is not None]
+        if not values:
+            return "n/a (no saved device context)"
+        values.sort()
+        return f"median {values[len(values) // 2] * 1000:7.1f} ms  max {values[-1] * 1000:7.1f} ms"
+
+    print(f"runs={runs}")
+    print(f"import app        : {fmt('import')}")
+    print(f"serving /health   : {fmt('serving')}")
+    print(f"firebase warm     : {fmt('warm')}")
+
+
+if __name__ == "__main__":
+    main()
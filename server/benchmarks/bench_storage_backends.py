@@ -0,0 +1,96 @@
+"""
+Benchmark: per-device files vs sharded storage
+
+For each layout, writes schedules and history for many devices through
+the real repositories, then measures per-device reads and one
+cross-device aggregate (total history rows).
+
+Usage: python benchmarks/bench_storage_backends.py [devices] [history_per_device] [shards]
+"""
+import contextlib
+import io
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import storage
+import database
+from database import connection_cache
+from history.history import init_history_db
+from history.history_writer import save_history_record
+from repositories import schedules as schedule_repo
+from repositories import history as history_repo
+
+
+def run(backend, devices: int, history_rows: int) -> dict:
+    storage.set_backend(backend)
+    device_ids = [f"AA:BB:{i:05d}" for i in range(devices)]
+
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for device_id in device_ids:
+            database.init_device_db(device_id, "", "")
+            init_history_db(device_id)
+            for container_id in range(1, 5):
+                schedule_repo.insert_schedule(device_id, container_id, "Bench", "08:00 AM", "Mon,Tue", 1)
+            for n in range(history_rows):
+                save_history_record(device_id, "Bench", n % 4 + 1, 1, "08:00 AM", "Mon",
+                                    "2026-01-01 08:00:00", "08:00 AM")
+    write_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for device_id in device_ids:
+        schedule_repo.list_all_schedules(device_id)
+        history_repo.list_history(device_id)
+    read_seconds = time.perf_counter() - start
+
+    # Cross-device aggregate: walk every file in the layout
+    start = time.perf_counter()
+    total = 0
+    for path in set(backend.database_paths()):
+        conn = sqlite3.connect(path)
+        try:
+            if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'history'").fetchone():
+                total += conn.execute("SELECT COUNT(*) FROM history").fetchone()[0]
+        finally:
+            conn.close()
+    scan_seconds = time.perf_counter() - start
+
+    connection_cache.close_all()
+    return {
+        "files": len(set(backend.database_paths())),
+        "writes_per_sec": (devices * (4 + history_rows)) / write_seconds,
+        "device_reads_per_sec": devices / read_seconds,
+        "cross_device_ms": scan_seconds * 1000,
+        "history_rows": total,
+    }
+
+
+def main():
+    devices = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    history_rows = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    shards = int(sys.argv[3]) if len(sys.argv) > 3 else 16
+
+    with tempfile.TemporaryDirectory() as tmp:
+        per_device = storage.PerDeviceBackend(os.path.join(tmp, "per_device"))
+        os.makedirs(per_device.base_dir)
+        sharded = storage.ShardedBackend(os.path.join(tmp, "shards"), shards)
+
+        print(f"devices={devices} history_per_device={history_rows} shards={shards}")
+        for backend in (per_device, sharded):
+            result = run(backend, devices, history_rows)
+            print(
+                f"{backend.name:11s} files={result['files']:5d} "
+                f"writes/s={result['writes_per_sec']:9.1f} "
+                f"device_reads/s={result['device_reads_per_sec']:8.1f} "
+                f"cross_device={result['cross_device_ms']:8.1f}ms "
+                f"rows={result['history_rows']}"
+            )
+
+
+if __name__ == "__main__":
+    main()
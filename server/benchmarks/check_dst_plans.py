@@ -0,0 +1,104 @@
+"""
+DST check for the schedule fire planner
+
+For every DST transition of a few zones in the given years, plans a
+schedule at each quarter hour of the transition day and asserts:
+
+- fall back: a time in the repeated hour fires once, at its first
+  occurrence (a second fire would double-dispense);
+- spring forward: a time in the skipped hour fires once, shifted forward
+  by the gap; every other time fires once at its own wall-clock time.
+
+Plans are checked both through occurrences_between (catch-up) and through
+get_plan ticking across the transition the way the scheduler does.
+
+Usage: python benchmarks/check_dst_plans.py [year ...]
+Exit code 1 on violation, so it can gate CI.
+"""
+import calendar
+import datetime
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytz
+import schedule_plan
+
+ZONES = ("America/New_York", "Europe/Berlin", "Australia/Sydney", "Australia/Lord_Howe", "America/Santiago")
+DAYS = "Mon,Tue,Wed,Thu,Fri,Sat,Sun"
+TICK_SECONDS = 60
+
+
+def quarter_hours():
+    for minutes in range(0, 24 * 60, 15):
+        hour, minute = divmod(minutes, 60)
+        yield datetime.time(hour, minute)
+
+
+def expected_fire(tz, date: datetime.date, wall: datetime.time) -> float:
+    """The one instant a wall time on date should fire at"""
+    naive = datetime.datetime.combine(date, wall)
+    try:
+        local = tz.localize(naive, is_dst=None)
+    except pytz.AmbiguousTimeError:
+        local = tz.localize(naive, is_dst=True)  # first occurrence
+    except pytz.NonExistentTimeError:
+        local = tz.normalize(tz.localize(naive, is_dst=False))  # shifted forward by the gap
+    return local.timestamp()
+
+
+def ticked(device_id: str, tz_name: str, rows, start: float, end: float):
+    """Fire instants popped by get_plan on a scheduler tick every TICK_SECONDS"""
+    schedule_plan.invalidate_local()
+    fired = []
+    now = start
+    while now <= end:
+        plan = schedule_plan.get_plan(device_id, now, lambda _: rows, tz_name)
+        fired.extend(plan.pop_due(now))
+        now += TICK_SECONDS
+    return fired
+
+
+def check_transition(tz_name: str, transition: float) -> list:
+    tz = pytz.timezone(tz_name)
+    date = datetime.datetime.fromtimestamp(transition, tz).date()
+    start = calendar.timegm(date.timetuple()) - 2 * 86400
+    end = start + 5 * 86400
+    problems = []
+    for wall in quarter_hours():
+        rows = [(1, "Check", wall.strftime("%I:%M %p"), DAYS, 1, 1)]
+        want = expected_fire(tz, date, wall)
+        day_start = want - 12 * 3600
+        day_end = want + 12 * 3600
+        for label, fired in (
+            ("catch-up", schedule_plan.occurrences_between("check", tz_name, rows, start, end)),
+            ("ticks", ticked("check", tz_name, rows, start, end)),
+        ):
+            got = sorted(o.fire_at for o in fired if day_start <= o.fire_at < day_end)
+            if got != [want]:
+                shown = [datetime.datetime.utcfromtimestamp(t).isoformat() + "Z" for t in got]
+                problems.append(f"{tz_name} {date} {wall.strftime('%H:%M')} ({label}): fired at {shown}, "
+                                f"expected {datetime.datetime.utcfromtimestamp(want).isoformat()}Z")
+    return problems
+
+
+def main():
+    years = [int(arg) for arg in sys.argv[1:]] or [2026]
+    problems, checked = [], 0
+    for tz_name in ZONES:
+        for transition in schedule_plan.transition_epochs(tz_name):
+            if datetime.datetime.utcfromtimestamp(transition).year in years:
+                problems += check_transition(tz_name, transition)
+                checked += 1
+
+    print(f"Checked {checked} transitions in {len(ZONES)} zones for {years}")
+    for problem in problems:
+        print(f"❌ {problem}")
+    if problems:
+        sys.exit(1)
+    print("✅ Every schedule fires exactly once on every transition day")
+
+
+if __name__ == "__main__":
+    main()
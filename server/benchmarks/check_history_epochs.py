@@ -0,0 +1,143 @@
+"""
+Check that history rows from the ESP32 get their taken_at/scheduled_at epochs
+
+The firmware posts datetime_taken and scheduled_time as bare times
+("08:05 AM", strftime "%I:%M %p"), so the epochs have to come from the time
+plus the local day the row was received. Checks:
+
+- history_epochs places a bare time on the device-local receipt day, and
+  across midnight when logged just before it and received just after;
+- a record saved with the firmware payload gets both epochs and is found
+  by search_history, counted in the last 7 days by get_history_stats and
+  included in a bounded export;
+- rows stored with NULL epochs (before bare times were parsed) are filled
+  by the per-batch background backfill, using their created_at.
+
+Usage: python benchmarks/check_history_epochs.py
+Exit code 1 on failure, so it can gate CI.
+"""
+import contextlib
+import io
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+SCRATCH = tempfile.mkdtemp(prefix="check_epochs_")
+os.environ["DB_DIR"] = SCRATCH
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytz
+import device_settings
+import storage
+from history import history as history_db
+from history.history_writer import save_history_record
+from repositories import history as history_repo
+
+DEVICE = "AA:BB:CC:DD:EE:01"
+# Exactly what logMedicineTaken in the firmware sends
+FIRMWARE_PAYLOAD = {
+    "medicine_name": "Paracetamol",
+    "container_id": 2,
+    "quantity": 1,
+    "scheduled_time": "08:00 AM",
+    "scheduled_days": "monday",
+    "datetime_taken": "08:05 AM",
+    "time_taken": "08:05 AM",
+}
+BACKFILL_ROWS = history_db.EPOCH_BACKFILL_BATCH * 2 + 7
+
+
+def utc(tz, local: str) -> datetime:
+    """Naive UTC datetime of a local wall-clock time in tz"""
+    return tz.localize(datetime.strptime(local, "%Y-%m-%d %H:%M")).astimezone(pytz.utc).replace(tzinfo=None)
+
+
+def check_parsing(problems: list):
+    tz = pytz.timezone("Asia/Manila")
+    cases = (
+        # (datetime_taken, scheduled_time, received local, expected taken local, expected scheduled local)
+        ("08:05 AM", "08:00 AM", "2026-03-10 08:05", "2026-03-10 08:05", "2026-03-10 08:00"),
+        ("11:58 PM", "11:30 PM", "2026-03-11 00:01", "2026-03-10 23:58", "2026-03-10 23:30"),
+        ("12:01 AM", "11:30 PM", "2026-03-10 23:59", "2026-03-11 00:01", "2026-03-10 23:30"),
+        ("2026-03-10 08:05 AM", "08:00 AM", "2026-03-12 09:00", "2026-03-10 08:05", "2026-03-10 08:00"),
+    )
+    for taken_text, scheduled_text, received, want_taken, want_scheduled in cases:
+        got = history_db.history_epochs(taken_text, scheduled_text, tz, utc(tz, received))
+        want = tuple(int(tz.localize(datetime.strptime(v, "%Y-%m-%d %H:%M")).timestamp())
+                     for v in (want_taken, want_scheduled))
+        if got != want:
+            problems.append(f"history_epochs({taken_text!r}, {scheduled_text!r}) received {received}: "
+                            f"got {got}, expected {want}")
+
+
+def check_saved_record(problems: list):
+    save_history_record(DEVICE, **FIRMWARE_PAYLOAD)
+    with history_db.history_connection(DEVICE) as conn:
+        taken_at, scheduled_at = conn.execute(
+            "SELECT taken_at, scheduled_at FROM history WHERE device_id = ? ORDER BY id DESC LIMIT 1", (DEVICE,)
+        ).fetchone()
+    if taken_at is None or scheduled_at is None:
+        problems.append(f"firmware payload stored with taken_at={taken_at}, scheduled_at={scheduled_at}")
+    if not history_repo.search_history(DEVICE, medicine="Para")["results"]:
+        problems.append("search_history found nothing for the firmware payload")
+    if history_repo.get_history_stats(DEVICE)["recent_7_days"] < 1:
+        problems.append("get_history_stats did not count the firmware payload in recent_7_days")
+    week_ago = datetime.now() - timedelta(days=7)
+    if not list(history_repo.iter_history(DEVICE, start=week_ago)):
+        problems.append("a bounded iter_history export left out the firmware payload")
+
+
+def check_backfill(problems: list):
+    tz = device_settings.get_timezone(DEVICE)
+    received = datetime.utcnow() - timedelta(days=2)
+    path = storage.history_path(DEVICE)
+    conn = sqlite3.connect(path)
+    with conn:
+        conn.executemany(
+            "INSERT INTO history (device_id, medicine_name, container_id, quantity, scheduled_time, "
+            "scheduled_days, datetime_taken, time_taken, created_at) VALUES (?, 'Old', 1, 1, '08:00 AM', "
+            "'monday', ?, ?, ?)",
+            [(DEVICE, "08:05 AM", "08:05 AM", received.strftime(history_db.CREATED_AT_FORMAT))] * BACKFILL_ROWS
+        )
+        conn.execute("PRAGMA user_version = 0")
+    conn.close()
+
+    filled = history_db.backfill_file_epochs(path)
+    conn = sqlite3.connect(path)
+    try:
+        missing = conn.execute("SELECT COUNT(*) FROM history WHERE taken_at IS NULL").fetchone()[0]
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        taken_at = conn.execute("SELECT taken_at FROM history WHERE medicine_name = 'Old' LIMIT 1").fetchone()[0]
+    finally:
+        conn.close()
+    expected_day = received.replace(tzinfo=pytz.utc).astimezone(tz).date()
+    if filled != BACKFILL_ROWS or missing:
+        problems.append(f"backfill filled {filled} of {BACKFILL_ROWS} rows, {missing} still NULL")
+    if version != history_db.HISTORY_EPOCHS_VERSION:
+        problems.append(f"backfill left user_version at {version}")
+    if taken_at and datetime.fromtimestamp(taken_at, tz).date() != expected_day:
+        problems.append(f"backfilled row dated {datetime.fromtimestamp(taken_at, tz).date()}, expected {expected_day}")
+
+
+def main():
+    problems = []
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            check_parsing(problems)
+            check_saved_record(problems)
+            check_backfill(problems)
+    finally:
+        shutil.rmtree(SCRATCH, ignore_errors=True)
+
+    for problem in problems:
+        print(f"❌ {problem}")
+    if problems:
+        sys.exit(1)
+    print("✅ Firmware history rows get taken_at/scheduled_at and are searchable")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+Import-time budget check for the API entry point
+
+Imports app in IMPORT_RUNS fresh interpreters with -X importtime and
+fails when the median total exceeds the budget or when a heavy dependency
+that should be deferred (Firebase, requests) is imported eagerly. A single
+run varies by tens of milliseconds, so only the median is gated.
+
+Usage: python benchmarks/check_import_budget.py [budget_ms]
+Exit code 1 on violation, so it can gate CI.
+"""
+import os
+import subprocess
+import sys
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+IMPORT_BUDGET_MS = float(os.environ.get("IMPORT_BUDGET_MS", "1100"))
+IMPORT_RUNS = int(os.environ.get("IMPORT_RUNS", "5"))
+
+# Must not be imported until first used
+DEFERRED_MODULES = ("firebase", "firebase_admin", "requests", "google.cloud", "google.auth")
+
+
+def measure_imports():
+    """Run `import app` under -X importtime; returns {module: cumulative_us}"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import app"],
+        cwd=SERVER_DIR,
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"import app failed:\n{result.stderr[-2000:]}")
+
+    modules = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative_us, name = line.split("|")
+        modules[name.strip()] = int(cumulative_us)
+    return modules
+
+
+def main():
+    budget_ms = float(sys.argv[1]) if len(sys.argv) > 1 else IMPORT_BUDGET_MS
+    runs = sorted((measure_imports() for _ in range(max(1, IMPORT_RUNS))), key=lambda m: m.get("app", 0))
+    modules = runs[len(runs) // 2]
+    total_ms = modules.get("app", 0) / 1000
+    eager = sorted({
+        name for run in runs for name in run
+        if any(name == d or name.startswith(d + ".") for d in DEFERRED_MODULES)
+    })
+
+    print(f"import app: median {total_ms:.1f} ms of {len(runs)} runs "
+          f"({runs[0].get('app', 0) / 1000:.1f}-{runs[-1].get('app', 0) / 1000:.1f} ms, budget {budget_ms:.0f} ms)")
+    heaviest = sorted(modules.items(), key=lambda item: item[1], reverse=True)[1:11]
+    for name, cumulative_us in heaviest:
+        print(f"  {cumulative_us / 1000:8.1f} ms  {name}")
+
+    failed = False
+    if total_ms > budget_ms:
+        print(f"❌ Median import time over budget by {total_ms - budget_ms:.1f} ms")
+        failed = True
+    if eager:
+        print(f"❌ Deferred modules imported eagerly: {', '.join(eager)}")
+        failed = True
+    if not failed:
+        print("✅ Import budget OK")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,398 @@
+"""
+Query-plan regression check for the server's SQL
+
+For each scale, builds the registry, state and storage databases with
+realistic row counts (all devices in one shard, so every per-device query
+has to filter on device_id), then drives the real repository and module
+functions with statement tracing on. Every distinct statement they issue
+is run through EXPLAIN QUERY PLAN, and each step is timed against the
+row count.
+
+A plan fails when it scans a table (with or without an index) or builds a
+temp B-tree, unless EXPECTED lists that statement and table with a reason.
+New statements are picked up automatically because the list of what to
+check comes from the trace, not from a hand-kept catalog.
+
+Usage: python benchmarks/check_query_plans.py [rows ...] [--output results.json]
+Default scales: 1000 10000 100000. Exit code 1 on violation, so it can gate CI.
+"""
+import contextlib
+import io
+import json
+import os
+import re
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_SCALES = (1000, 10000, 100000)
+STEP_REPEATS = 3
+
+DEVICE = "AA:BB:00000"
+OWNER = "owner0@example.com"
+
+# Statements allowed to scan or sort a given table, with the reason it is
+# acceptable. Patterns match the normalized statement (literals become ?).
+EXPECTED = [
+    (r"^SELECT DISTINCT device_id FROM history$", "history",
+     "retention lists the devices in a file once per pass (covering index scan)"),
+    (r"FROM sqlite_master WHERE type = \? AND name = \?", "sqlite_master",
+     "schema lookup; sqlite_master is never indexed"),
+    (r"^SELECT scope, version FROM change_versions$", "change_versions",
+     "shared_state polls the whole table by design; one row per changed scope"),
+    (r"^DELETE FROM device_registrations WHERE is_active = \? AND last_connected < ", "device_registrations",
+     "admin cleanup of inactive devices, run by hand"),
+    (r"FROM history_daily WHERE device_id = \? GROUP BY container_id", r"history_daily|\(subquery",
+     "history stats group one device's daily rollups and merge at most two rows per container"),
+    (r"^SELECT k, v FROM \?\.\?$", r"main\.\w+_fts_config$",
+     "FTS5 reads its few config rows once per connection"),
+]
+
+_PLAN_SOURCE = re.compile(r"^(?:SCAN|SEARCH) (\S+)")
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+
+
+def normalize(sql: str) -> str:
+    """Statement text with literals replaced, so bound values dedupe"""
+    return " ".join(_LITERALS.sub("?", sql).split())
+
+
+def plan_problems(plan_rows):
+    """(table, detail) for each table scan or temp B-tree in an EXPLAIN QUERY PLAN result"""
+    problems = []
+    source = None
+    for _, _, _, detail in plan_rows:
+        match = _PLAN_SOURCE.match(detail)
+        if match:
+            source = match.group(1)
+            if (detail.startswith("SCAN ") and source != "CONSTANT"
+                    and "VIRTUAL TABLE" not in detail):
+                problems.append((source, detail))
+        elif "USE TEMP B-TREE" in detail:
+            # A sort belongs to the table (or subquery) read just before it
+            problems.append((source, detail))
+    return problems
+
+
+def unexpected(statement: str, problems):
+    """Problems not covered by an EXPECTED entry for this statement"""
+    allowed = [(table, reason) for pattern, table, reason in EXPECTED if re.search(pattern, statement)]
+    return [
+        (source, detail) for source, detail in problems
+        if not any(re.match(table, source or "") for table, _ in allowed)
+    ], [reason for _, reason in allowed]
+
+
+# ---- Child: seed one scale, trace the workload, report as JSON ----
+
+_connect = sqlite3.connect
+_traced = []
+_step = None
+
+
+class TracedConnection(sqlite3.Connection):
+    """Records (db path, step, expanded SQL) for every statement executed"""
+
+    def __init__(self, database, *args, **kwargs):
+        super().__init__(database, *args, **kwargs)
+        path = str(database)
+        if path.startswith("file:"):
+            path = path[len("file:"):].split("?", 1)[0]
+        self.set_trace_callback(lambda sql: _traced.append((path, _step, sql)))
+
+
+def _traced_connect(*args, **kwargs):
+    kwargs.setdefault("factory", TracedConnection)
+    return _connect(*args, **kwargs)
+
+
+def _seed(rows: int):
+    """Bulk-load every table through its real schema"""
+    import device_registry
+    import database
+    import state_store
+    import event_stream
+    import fire_log
+    from history.history import init_history_db, history_db_writer
+
+    devices = max(20, rows // 100)
+    device_ids = [f"AA:BB:{i:05d}" for i in range(devices)]
+    now = datetime.utcnow()
+
+    def spread(n):
+        """n (device_id, datetime) pairs over a year; DEVICE gets 10% of them"""
+        for i in range(n):
+            device_id = DEVICE if i % 10 == 0 else device_ids[i % devices]
+            yield device_id, now - timedelta(minutes=(i * 524_160) // n)
+
+    device_registry.init_registry_db()
+    database.init_device_db(DEVICE, "", "")
+    init_history_db(DEVICE)
+    event_stream.publish(DEVICE, "seed", {})
+    fire_log.claim(DEVICE, 0, 0)
+
+    def seed_registry(conn):
+        conn.executemany(
+            "INSERT OR IGNORE INTO device_registrations (device_id, owner_email, firebase_url, last_connected, is_active) "
+            "VALUES (?, ?, ?, ?, ?)",
+            [(d, f"owner{i % max(1, devices // 2)}@example.com", "https://x.firebaseio.com",
+              (now - timedelta(hours=i)).strftime("%Y-%m-%d %H:%M:%S"), int(i % 7 != 6))
+             for i, d in enumerate(device_ids)]
+        )
+        conn.executemany(
+            "INSERT INTO connection_history (device_id, email, action, timestamp, success, notes) "
+            "VALUES (?, ?, 'register', ?, 1, '')",
+            [(d, OWNER, t.strftime("%Y-%m-%d %H:%M:%S")) for d, t in spread(rows)]
+        )
+    device_registry.registry_writer().write(seed_registry)
+
+    def seed_schedules(conn):
+        conn.executemany(
+            "INSERT INTO schedules (device_id, container_id, name, time, days, quantity) VALUES (?, ?, ?, ?, ?, 1)",
+            [(d, i % 8 + 1, f"Medicine {i % 50}", f"{i % 12 + 1:02d}:{i % 60:02d} {'AM' if i % 2 else 'PM'}",
+              "Mon,Wed,Fri") for i, (d, _) in enumerate(spread(max(50, rows // 10)))]
+        )
+        conn.executemany(
+            "INSERT OR IGNORE INTO inventory (device_id, container_id, pills, low_stock_threshold) VALUES (?, ?, 30, 5)",
+            [(d, c) for d in device_ids for c in range(1, 9)]
+        )
+        conn.executemany(
+            "INSERT INTO inventory_events (device_id, container_id, kind, amount, pills_after, created_at) "
+            "VALUES (?, ?, 'refill', 30, 30, ?)",
+            [(d, i % 8 + 1, t.strftime("%Y-%m-%d %H:%M:%S")) for i, (d, t) in enumerate(spread(rows // 10))]
+        )
+    database.device_db_writer(DEVICE).write(seed_schedules)
+
+    def seed_history(conn):
+        conn.executemany(
+            "INSERT INTO history (device_id, medicine_name, container_id, quantity, scheduled_time, scheduled_days, "
+            "datetime_taken, time_taken, created_at, taken_at, scheduled_at) "
+            "VALUES (?, ?, ?, 1, '08:00 AM', 'Mon', ?, ?, ?, ?, ?)",
+            [(d, f"Medicine {i % 50}", i % 8 + 1, t.strftime("%Y-%m-%d %H:%M:%S"), t.strftime("%I:%M %p"),
+              t.strftime("%Y-%m-%d %H:%M:%S"), int(t.timestamp()), int(t.timestamp()) - 600)
+             for i, (d, t) in enumerate(spread(rows))]
+        )
+        conn.executemany(
+            "INSERT OR IGNORE INTO history_daily (device_id, day, container_id, doses, quantity) VALUES (?, ?, ?, 4, 4)",
+            [(d, (now - timedelta(days=400 + i // 8)).strftime("%Y-%m-%d"), i % 8 + 1)
+             for i, (d, _) in enumerate(spread(rows // 10))]
+        )
+    history_db_writer(DEVICE).write(seed_history)
+
+    with state_store.transaction() as conn:
+        conn.executemany(
+            "INSERT OR IGNORE INTO fire_log (device_id, schedule_id, occurrence_at, fired_at) VALUES (?, ?, ?, ?)",
+            [(d, i % 500, int(t.timestamp()), t.timestamp()) for i, (d, t) in enumerate(spread(rows))]
+        )
+        conn.executemany(
+            "INSERT INTO event_log (device_id, event, data, timestamp) VALUES (?, 'dispense-fired', '{}', ?)",
+            [(d, time.time() - i * 3600 / rows) for i, (d, _) in enumerate(spread(rows))]
+        )
+    return devices
+
+
+def _workload():
+    """(step name, callable) pairs covering the statements the server issues"""
+    import audit_log
+    import device_registry
+    import device_settings
+    import event_stream
+    import fire_log
+    import scheduler_lease
+    import shared_state
+    import state_store
+    import storage
+    from history import history_retention
+    from history.history_writer import save_history_record
+    from repositories import history as history_repo
+    from repositories import inventory as inventory_repo
+    from repositories import registry as registry_repo
+    from repositories import schedules as schedule_repo
+
+    now = time.time()
+    week_ago = datetime.now() - timedelta(days=7)
+    taken_from = datetime.now() - timedelta(days=365)
+    taken_until = datetime.now() - timedelta(days=7)
+    counter = iter(range(10**9))
+
+    return [
+        ("schedules.list_container", lambda: schedule_repo.list_container_schedules(DEVICE, 3)),
+        ("schedules.list_all", lambda: schedule_repo.list_all_schedules(DEVICE)),
+        ("schedules.dispatch_rows", lambda: schedule_repo.list_dispatch_rows(DEVICE)),
+        ("schedules.get", lambda: schedule_repo.get_schedule(DEVICE, 11)),
+        ("schedules.insert", lambda: schedule_repo.insert_schedule(DEVICE, 9, "Bench", "08:00 AM", "Mon", 1)),
+        ("schedules.update", lambda: schedule_repo.update_schedule(DEVICE, 11, 0, "Bench", "09:00 AM", "Tue", 1)),
+        ("schedules.delete", lambda: schedule_repo.delete_schedule(DEVICE, -1)),
+        ("schedules.delete_container", lambda: schedule_repo.delete_container_schedules(DEVICE, 99)),
+        ("history.list", lambda: history_repo.list_history(DEVICE)),
+        ("history.stats", lambda: history_repo.get_history_stats(DEVICE)),
+        ("history.export_range", lambda: list(history_repo.iter_history(DEVICE, week_ago, None, 3))),
+        ("history.export_all", lambda: list(history_repo.iter_history(DEVICE))),
+        ("history.search_medicine", lambda: history_repo.search_history(DEVICE, medicine="medicine 4")),
+        ("history.search_filters", lambda: history_repo.search_history(
+            DEVICE, medicine="med", container_id=3, start=taken_from, end=taken_until)),
+        ("history.search_container", lambda: history_repo.search_history(DEVICE, container_id=3, start=taken_from)),
+        ("history.search_next_page", lambda: history_repo.search_history(
+            DEVICE, scheduled_time="08:00 AM", after=(int(now) - 7 * 86400, 10**9))),
+        ("history.save", lambda: save_history_record(DEVICE, "Bench", 1, 1, "08:00 AM", "Mon",
+                                                     "2026-01-01 08:00:00", "08:00 AM")),
+        ("history.delete_entry", lambda: history_repo.delete_history_entry(DEVICE, -1)),
+        ("history.delete_all", lambda: history_repo.delete_all_history("AA:BB:00001")),
+        ("history.retention", lambda: history_retention.compact_file(
+            storage.history_path(DEVICE), "2000-01-01 00:00:00", time.monotonic() + 5)),
+        ("inventory.list", lambda: inventory_repo.list_inventory(DEVICE)),
+        ("inventory.refill", lambda: inventory_repo.refill(DEVICE, 2, 30)),
+        ("inventory.dispensed", lambda: inventory_repo.record_dispensed(DEVICE, 2, 1)),
+        ("inventory.taken", lambda: inventory_repo.record_taken(DEVICE, 2, 1)),
+        ("inventory.events", lambda: inventory_repo.list_events(DEVICE)),
+        ("inventory.container_events", lambda: inventory_repo.list_events(DEVICE, 2)),
+        ("inventory.remove", lambda: inventory_repo.remove_container(DEVICE, 99)),
+        ("registry.is_registered", lambda: device_registry.is_device_registered(DEVICE)),
+        ("registry.owner", lambda: device_registry.get_device_owner(DEVICE)),
+        ("registry.info", lambda: device_registry.get_device_info(DEVICE)),
+        ("registry.user_devices", lambda: device_registry.get_user_devices(OWNER)),
+        ("registry.touch", lambda: device_registry.update_last_connected(DEVICE)),
+        ("registry.register", lambda: device_registry.register_device(
+            f"CC:DD:{next(counter):05d}", OWNER, "https://x.firebaseio.com")),
+        ("registry.disconnect", lambda: device_registry.disconnect_device("AA:BB:00002", "owner2@example.com")),
+        ("registry.cleanup", lambda: device_registry.cleanup_old_connections(3650)),
+        ("registry.connection_history", lambda: registry_repo.get_connection_history(DEVICE, 50)),
+        ("registry.by_ids", lambda: registry_repo.get_devices_by_ids([DEVICE, "AA:BB:00003"])),
+        ("registry.by_owners", lambda: registry_repo.get_devices_by_owners([OWNER, "owner3@example.com"])),
+        ("audit.flush", lambda: (audit_log.record(DEVICE, OWNER, "bench", True), audit_log.flush())),
+        ("audit.prune", lambda: audit_log.prune_expired(3650)),
+        ("fire_log.claim", lambda: fire_log.claim(DEVICE, 1, now + next(counter))),
+        ("fire_log.release", lambda: fire_log.release(DEVICE, 1, now)),
+        ("fire_log.between", lambda: fire_log.fired_between(DEVICE, now - 86400, now)),
+        ("fire_log.prune", lambda: fire_log.prune(3650)),
+        ("events.publish", lambda: event_stream.publish(DEVICE, "bench", {})),
+        ("events.poll", event_stream.poll),
+        ("events.replay", lambda: event_stream.replay(DEVICE, 1)),
+        ("events.prune", lambda: event_stream.prune(86400)),
+        ("settings.update", lambda: device_settings.update_settings(DEVICE, notify_taken=bool(next(counter) % 2))),
+        ("settings.load", lambda: (device_settings.invalidate(DEVICE), device_settings.get_settings(DEVICE))),
+        ("shared_state.bump", lambda: shared_state.bump("bench")),
+        ("shared_state.poll", lambda: shared_state.poll(notify=False)),
+        ("lease.maintain", lambda: scheduler_lease.maintain(time.time() + next(counter) * 60)),
+        ("lease.status", scheduler_lease.status),
+        ("state.save", lambda: state_store.save_state("bench", {"n": 1})),
+        ("state.load", lambda: state_store.load_state("bench")),
+    ]
+
+
+def run_scale(rows: int) -> dict:
+    global _step
+    import storage
+
+    sqlite3.connect = _traced_connect
+    storage.set_backend(storage.ShardedBackend(os.path.join(os.environ["DB_DIR"], "shards"), 1))
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        devices = _seed(rows)
+        del _traced[:]
+        timings = {}
+        for name, step in _workload():
+            _step = name
+            samples = []
+            for _ in range(STEP_REPEATS):
+                start = time.perf_counter()
+                step()
+                samples.append(time.perf_counter() - start)
+            timings[name] = round(min(samples) * 1000, 3)
+        _step = None
+
+    statements = {}
+    for path, step, sql in _traced:
+        if not re.match(r"\s*(SELECT|INSERT|UPDATE|DELETE|WITH|REPLACE)\b", sql, re.IGNORECASE):
+            continue
+        statements.setdefault(normalize(sql), (path, step, sql))
+
+    checked = []
+    for statement, (path, step, sql) in sorted(statements.items()):
+        conn = _connect(path)
+        try:
+            plan = conn.execute("EXPLAIN QUERY PLAN " + sql).fetchall()
+        finally:
+            conn.close()
+        problems, reasons = unexpected(statement, plan_problems(plan))
+        checked.append({
+            "step": step,
+            "statement": statement,
+            "plan": [row[3] for row in plan],
+            "problems": [detail for _, detail in problems],
+            "accepted": reasons if len(problems) < len(plan_problems(plan)) else [],
+        })
+    return {"rows": rows, "devices": devices, "timings_ms": timings, "statements": checked}
+
+
+# ---- Parent: one fresh interpreter and data directory per scale ----
+
+def measure(rows: int) -> dict:
+    with tempfile.TemporaryDirectory() as tmp:
+        result = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--child", str(rows)],
+            cwd=SERVER_DIR,
+            env={**os.environ, "DB_DIR": tmp},
+            capture_output=True,
+            text=True,
+        )
+    if result.returncode != 0:
+        raise RuntimeError(f"scale {rows} failed:\n{result.stderr[-2000:]}")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    args = sys.argv[1:]
+    if args[:1] == ["--child"]:
+        sys.path.insert(0, SERVER_DIR)
+        print(json.dumps(run_scale(int(args[1]))))
+        return
+
+    output = None
+    if "--output" in args:
+        index = args.index("--output")
+        output = args[index + 1]
+        del args[index:index + 2]
+    scales = [int(arg) for arg in args] or list(DEFAULT_SCALES)
+
+    results = [measure(rows) for rows in scales]
+
+    violations = {}
+    for result in results:
+        for item in result["statements"]:
+            if item["problems"]:
+                violations.setdefault(item["statement"], item)
+
+    largest = results[-1]
+    print(f"{len(largest['statements'])} distinct statements checked at {', '.join(str(r['rows']) for r in results)} rows")
+    print(f"{'step':30s}" + "".join(f"{r['rows']:>12d}" for r in results))
+    for name in largest["timings_ms"]:
+        print(f"{name:30s}" + "".join(f"{r['timings_ms'][name]:>10.2f}ms" for r in results))
+
+    accepted = [item for item in largest["statements"] if item["accepted"]]
+    if accepted:
+        print("\nAccepted scans/sorts:")
+        for item in accepted:
+            print(f"  {item['step']}: {'; '.join(item['accepted'])}")
+
+    if output:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"\nResults written to {output}")
+
+    if violations:
+        print(f"\n❌ {len(violations)} statement(s) with unexpected scans or temp B-trees:")
+        for statement, item in violations.items():
+            print(f"  [{item['step']}] {statement}")
+            for problem in item["problems"]:
+                print(f"      {problem}")
+        sys.exit(1)
+    print("\n✅ Every query plan uses an index")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,8 @@
 import pytz
+import state_store
+import shared_state
 
+# Server-wide default for devices that have no timezone of their own
 selected_timezone = pytz.timezone("Asia/Manila")
 # Stores the Firebase config received from the Flutter QR scan
 firebase_config_store = {}
@@ -8,10 +11,28 @@ firebase_config_store = {}
 # Tracks whether QR config has been received (wrapped in dict for mutability)
 qr_state = {"received": False}
 
-def set_selected_timezone(tz_name: str):
-    global selected_timezone
+def persist_context():
+    """Save the device context so a restart does not require a new QR scan"""
     try:
-        selected_timezone = pytz.timezone(tz_name)
-        print(f"🌐 Timezone updated to: {tz_name}")
-    except pytz.UnknownTimeZoneError:
-        print(f"❌ Invalid timezone: {tz_name}, keeping previous timezone.")
\ No newline at end of file
+        state_store.save_state("firebase_config", dict(firebase_config_store))
+        state_store.save_state("qr_state", dict(qr_state))
+        # Other workers reload the context when they see this
+        shared_state.bump("context")
+    except Exception as e:
+        print(f"⚠️ Failed to persist device context: {e}")
+
+def restore_context() -> bool:
+    """Load the persisted device context. Returns True if a device was restored."""
+    try:
+        config = state_store.load_state("firebase_config", {})
+        saved_qr_state = state_store.load_state("qr_state", {"received": False})
+    except Exception as e:
+        print(f"⚠️ Failed to restore device context: {e}")
+        return False
+
+    # Update in place without emptying it first: other threads read it concurrently
+    for key in [key for key in firebase_config_store if key not in config]:
+        firebase_config_store.pop(key, None)
+    firebase_config_store.update(config)
+    qr_state.update(saved_qr_state)
+    return bool(config.get("device_id")) and qr_state["received"]
\ No newline at end of file
@@ -1,35 +1,287 @@
 import sqlite3
 import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Optional
+import storage
+import db_writer
 
-BASE_DIR = "/tmp/devices"
-os.makedirs(BASE_DIR, exist_ok=True)
+BASE_DIR = storage.BASE_DIR
 
-def get_device_db_path(device_id: str, firebase_url: str, auth_token: str) -> str:
-    # sanitize filename
-    safe_device_id = device_id.replace(":", "_").replace("/", "_")
-    return os.path.join(BASE_DIR, f"{safe_device_id}.db")
+# Each open WAL database holds up to three descriptors (db, -wal, -shm);
+# the budget is shared with the write connections in db_writer
+FDS_PER_CONNECTION = db_writer.FDS_PER_CONNECTION
+DB_FD_BUDGET = db_writer.DB_FD_BUDGET
+READ_FD_BUDGET = DB_FD_BUDGET - db_writer.WRITER_FD_BUDGET
+DB_IDLE_TIMEOUT = float(os.environ.get("DB_IDLE_TIMEOUT", "300"))
 
-def get_db_connection_for_device(device_id: str, firebase_url: str, auth_token: str):
-    db_path = get_device_db_path(device_id, firebase_url, auth_token)
-    return sqlite3.connect(db_path)
+# Applied once when a cached connection is opened
+TUNED_PRAGMAS = (
+    # Only takes effect on new files, and only before WAL is enabled;
+    # lets history maintenance return freed pages with incremental_vacuum
+    "PRAGMA auto_vacuum=INCREMENTAL",
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-4096",      # 4 MiB page cache
+    "PRAGMA mmap_size=67108864",    # 64 MiB memory-mapped I/O
+    "PRAGMA busy_timeout=10000",
+)
 
-def init_device_db(device_id: str, firebase_url: str, auth_token: str):
-    conn = get_db_connection_for_device(device_id, firebase_url, auth_token)
+
+def open_tuned_connection(db_path: str) -> sqlite3.Connection:
+    """Open a connection and apply the tuned PRAGMAs"""
+    conn = sqlite3.connect(db_path, timeout=10.0, check_same_thread=False)
+    for pragma in TUNED_PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+class _CachedConnection:
+    __slots__ = ("conn", "lock", "users", "last_used", "opened", "error")
+
+    def __init__(self):
+        # conn is set once the opener has finished; until then the entry
+        # only reserves the path's slot and other borrowers wait on opened
+        self.conn: Optional[sqlite3.Connection] = None
+        self.lock = threading.Lock()
+        self.users = 0
+        self.last_used = time.monotonic()
+        self.opened = threading.Event()
+        self.error: Optional[BaseException] = None
+
+
+class ConnectionCache:
+    """
+    Bounded LRU of open read connections keyed by file path. Writes go
+    through the file's db_writer, so these are opened query_only.
+    Connections are closed when idle too long or when the descriptor
+    budget is exceeded; a connection in use is never closed.
+    """
+
+    def __init__(self, fd_budget: int = READ_FD_BUDGET, idle_timeout: float = DB_IDLE_TIMEOUT):
+        self.max_open = max(1, fd_budget // FDS_PER_CONNECTION)
+        self.idle_timeout = idle_timeout
+        self._entries: "OrderedDict[str, _CachedConnection]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._sweeper_started = False
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _checkout(self, db_path: str) -> _CachedConnection:
+        """
+        Reserve the path's entry under the cache lock, then open the
+        connection outside it, so a slow open (busy_timeout) only holds up
+        borrowers of the same file.
+        """
+        with self._lock:
+            entry = self._entries.get(db_path)
+            opener = entry is None
+            if opener:
+                self.misses += 1
+                entry = _CachedConnection()
+                self._entries[db_path] = entry
+                self._start_sweeper()
+            else:
+                self.hits += 1
+                self._entries.move_to_end(db_path)
+            entry.users += 1
+
+        if opener:
+            try:
+                conn = open_tuned_connection(db_path)
+                conn.execute("PRAGMA query_only=ON")
+            except BaseException as exc:
+                with self._lock:
+                    if self._entries.get(db_path) is entry:
+                        del self._entries[db_path]
+                entry.error = exc
+                entry.opened.set()
+                self._checkin(entry)
+                raise
+            entry.conn = conn
+            entry.opened.set()
+        else:
+            entry.opened.wait()
+            if entry.error is not None:
+                self._checkin(entry)
+                raise entry.error
+        return entry
+
+    def _checkin(self, entry: _CachedConnection):
+        with self._lock:
+            entry.users -= 1
+            entry.last_used = time.monotonic()
+            self._evict_locked()
+
+    def _evict_locked(self):
+        """Close idle or over-budget connections, least recently used first"""
+        now = time.monotonic()
+        for path in list(self._entries):
+            entry = self._entries[path]
+            over_budget = len(self._entries) > self.max_open
+            idle = now - entry.last_used > self.idle_timeout
+            if not over_budget and not idle:
+                break
+            if entry.users:
+                continue
+            del self._entries[path]
+            if entry.conn is not None:
+                entry.conn.close()
+            self.evictions += 1
+
+    def _start_sweeper(self):
+        if self._sweeper_started or self.idle_timeout <= 0:
+            return
+
+        def sweep():
+            while True:
+                time.sleep(self.idle_timeout / 2)
+                with self._lock:
+                    self._evict_locked()
+
+        threading.Thread(target=sweep, daemon=True).start()
+        self._sweeper_started = True
+
+    @contextmanager
+    def connection(self, db_path: str):
+        """
+        Borrow the cached connection for a path. Use is exclusive for the
+        duration of the block; commits on success and rolls back on error.
+        """
+        entry = self._checkout(db_path)
+        try:
+            with entry.lock:
+                try:
+                    yield entry.conn
+                    if entry.conn.in_transaction:
+                        entry.conn.commit()
+                except Exception:
+                    entry.conn.rollback()
+                    raise
+        finally:
+            self._checkin(entry)
+
+    def invalidate(self, db_path: str):
+        """Close a path's connection (e.g. before the file is removed)"""
+        with self._lock:
+            entry = self._entries.get(db_path)
+            if entry is not None and not entry.users:
+                del self._entries[db_path]
+                if entry.conn is not None:
+                    entry.conn.close()
+
+    def close_all(self):
+        with self._lock:
+            for entry in self._entries.values():
+                if entry.conn is not None:
+                    entry.conn.close()
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "open": len(self._entries),
+                "max_open": self.max_open,
+                "in_use": sum(1 for e in self._entries.values() if e.users),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+connection_cache = ConnectionCache()
+
+
+SCHEDULES_TABLE = """
+    CREATE TABLE IF NOT EXISTS schedules (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        device_id TEXT,
+        container_id INTEGER,
+        name TEXT,
+        time TEXT,
+        days TEXT,
+        quantity INTEGER
+    )
+"""
+
+# Pills left per container; pending_dispensed counts doses pushed to the
+# device whose /push_history confirmation has not arrived yet
+INVENTORY_TABLE = """
+    CREATE TABLE IF NOT EXISTS inventory (
+        device_id TEXT NOT NULL,
+        container_id INTEGER NOT NULL,
+        pills INTEGER NOT NULL DEFAULT 0,
+        pending_dispensed INTEGER NOT NULL DEFAULT 0,
+        low_stock_threshold INTEGER NOT NULL,
+        low_stock_alerted INTEGER NOT NULL DEFAULT 0,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (device_id, container_id)
+    ) WITHOUT ROWID
+"""
+
+INVENTORY_EVENTS_TABLE = """
+    CREATE TABLE IF NOT EXISTS inventory_events (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        device_id TEXT NOT NULL,
+        container_id INTEGER NOT NULL,
+        kind TEXT NOT NULL,
+        amount INTEGER NOT NULL,
+        pills_after INTEGER NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+"""
+
+
+def add_device_id_column(conn, table: str, device_id: Optional[str] = None):
+    """Add device_id to tables created before it existed and backfill it"""
+    columns = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+    if "device_id" not in columns:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN device_id TEXT")
+    if device_id is not None:
+        conn.execute(f"UPDATE {table} SET device_id = ? WHERE device_id IS NULL", (device_id,))
+
+
+def ensure_schedules_schema(conn, device_id: Optional[str] = None):
+    """Create/upgrade the schedules table (per-device file or shard)"""
+    conn.execute(SCHEDULES_TABLE)
+    add_device_id_column(conn, "schedules", device_id)
+    # Covers per-device and per-container lookups and their ORDER BY container_id, time
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_schedules_device_container_time
+        ON schedules(device_id, container_id, time)
+    """)
+    conn.execute("DROP INDEX IF EXISTS idx_schedules_device_container")
+    conn.execute(INVENTORY_TABLE)
+    conn.execute(INVENTORY_EVENTS_TABLE)
     conn.execute("""
-        CREATE TABLE IF NOT EXISTS schedules (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            container_id INTEGER,
-            name TEXT,
-            time TEXT,
-            days TEXT,
-            quantity INTEGER
-        )
+        CREATE INDEX IF NOT EXISTS idx_inventory_events_device_container
+        ON inventory_events(device_id, container_id, id)
     """)
-    conn.commit()
-    conn.close()
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_inventory_events_device
+        ON inventory_events(device_id, id)
+    """)
+
+
+def get_device_db_path(device_id: str, firebase_url: str, auth_token: str) -> str:
+    """Path of the per-device schedules file (per_device layout)"""
+    return os.path.join(BASE_DIR, f"{storage.safe_device_id(device_id)}.db")
+
+def device_connection(device_id: str):
+    """Borrow the cached (read-only) schedules connection for a device (backend-routed)"""
+    return connection_cache.connection(storage.schedules_path(device_id))
+
+def device_db_writer(device_id: str) -> db_writer.DatabaseWriter:
+    """The writer of a device's schedules file (backend-routed)"""
+    return db_writer.writer_for(storage.schedules_path(device_id), open_tuned_connection)
+
+def init_device_db(device_id: str, firebase_url: str, auth_token: str):
+    device_db_writer(device_id).write(ensure_schedules_schema, device_id)
 
 def close_db_connection(conn):
     """Safely closes the DB connection if it exists."""
     if conn:
         conn.close()
-
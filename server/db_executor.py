@@ -0,0 +1,113 @@
+"""
+Database Executors
+Dedicated worker threads for blocking SQLite calls so async routes never
+occupy the shared anyio threadpool
+"""
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict
+import profiling
+
+DB_EXECUTOR_WORKERS = int(os.environ.get("DB_EXECUTOR_WORKERS", "4"))
+
+
+class DBExecutor:
+    """A named thread pool for one database with occupancy/queue-wait metrics"""
+
+    def __init__(self, name: str, max_workers: int = DB_EXECUTOR_WORKERS):
+        self.name = name
+        self.max_workers = max_workers
+        self._pool = ThreadPoolExecutor(
+            max_workers=max_workers,
+            thread_name_prefix=f"db-{name}"
+        )
+        self._lock = threading.Lock()
+        self._queued = 0
+        self._active = 0
+        self._submitted = 0
+        self._completed = 0
+        self._failed = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+        self._total_run = 0.0
+
+    def _wrap(self, fn: Callable, args, kwargs):
+        enqueued_at = time.perf_counter()
+        # Read in the caller's context: a profiled request follows its work here
+        capture = profiling.current()
+
+        def task():
+            started_at = time.perf_counter()
+            wait = started_at - enqueued_at
+            with self._lock:
+                self._queued -= 1
+                self._active += 1
+                self._total_wait += wait
+                self._max_wait = max(self._max_wait, wait)
+            ok = False
+            try:
+                if capture is not None:
+                    result = profiling.run_captured(capture, fn, *args, **kwargs)
+                else:
+                    result = fn(*args, **kwargs)
+                ok = True
+                return result
+            finally:
+                with self._lock:
+                    self._active -= 1
+                    self._completed += 1
+                    if not ok:
+                        self._failed += 1
+                    self._total_run += time.perf_counter() - started_at
+
+        return task
+
+    def submit(self, fn: Callable, *args, **kwargs) -> Future:
+        """Queue a blocking call and return a concurrent Future"""
+        with self._lock:
+            self._queued += 1
+            self._submitted += 1
+        return self._pool.submit(self._wrap(fn, args, kwargs))
+
+    async def run(self, fn: Callable, *args, **kwargs):
+        """Await a blocking call on this executor's threads"""
+        return await asyncio.wrap_future(self.submit(fn, *args, **kwargs))
+
+    def call(self, fn: Callable, *args, **kwargs):
+        """Run a blocking call on this executor from another (non-async) thread"""
+        return self.submit(fn, *args, **kwargs).result()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            completed = self._completed or 1
+            return {
+                "workers": self.max_workers,
+                "active": self._active,
+                "queued": self._queued,
+                "occupancy": round(self._active / self.max_workers, 3),
+                "submitted": self._submitted,
+                "completed": self._completed,
+                "failed": self._failed,
+                "avg_queue_wait_ms": round(self._total_wait / completed * 1000, 3),
+                "max_queue_wait_ms": round(self._max_wait * 1000, 3),
+                "avg_run_ms": round(self._total_run / completed * 1000, 3),
+            }
+
+    def shutdown(self):
+        self._pool.shutdown(wait=True)
+
+
+# One executor per database so a slow/locked DB only backs up its own queue
+SCHEDULES_EXECUTOR = DBExecutor("schedules")
+HISTORY_EXECUTOR = DBExecutor("history")
+REGISTRY_EXECUTOR = DBExecutor("registry")
+
+_EXECUTORS = [SCHEDULES_EXECUTOR, HISTORY_EXECUTOR, REGISTRY_EXECUTOR]
+
+
+def get_executor_stats() -> Dict:
+    """Occupancy and queue-wait metrics for every DB executor"""
+    return {executor.name: executor.stats() for executor in _EXECUTORS}
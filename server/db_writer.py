@@ -0,0 +1,450 @@
+"""
+Database Writers
+One writer per SQLite file. Every write to a file is queued to its
+writer, which runs whatever is queued back to back in one transaction
+(each operation under its own savepoint, so a failing one is rolled back
+alone) and resolves the callers' futures once the batch has committed.
+
+With a single writing connection per file, writes in this process never
+compete for SQLite's lock; readers use their own WAL connections and see
+a batch as soon as it commits. Between worker processes busy_timeout
+still applies, since each process has its own writer.
+
+Writers do not own threads: a shared pool of DB_WRITER_THREADS runs one
+batch at a time for whichever writers have work, so a file runs on at
+most one thread at a time. Write connections share DB_FD_BUDGET with the
+read cache in database.py (DB_WRITER_FD_SHARE of it). Past that the least
+recently used idle write connection is closed, idle ones are closed after
+DB_WRITER_IDLE_SECONDS, and writers idle with no connection are dropped
+from the registry, so a layout with a file per device keeps neither a
+thread nor a descriptor per device.
+
+An operation is fn(conn, *args) and must not commit or roll back itself.
+"""
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional
+import profiling
+
+DB_WRITER_BATCH = int(os.environ.get("DB_WRITER_BATCH", "64"))
+DB_WRITER_IDLE_SECONDS = float(os.environ.get("DB_WRITER_IDLE_SECONDS", "30"))
+# Each open WAL database holds up to three descriptors (db, -wal, -shm)
+FDS_PER_CONNECTION = 3
+DB_FD_BUDGET = int(os.environ.get("DB_FD_BUDGET", "384"))
+DB_WRITER_FD_SHARE = float(os.environ.get("DB_WRITER_FD_SHARE", "0.25"))
+WRITER_FD_BUDGET = int(DB_FD_BUDGET * DB_WRITER_FD_SHARE)
+MAX_WRITER_CONNECTIONS = max(1, WRITER_FD_BUDGET // FDS_PER_CONNECTION)
+DB_WRITER_THREADS = min(int(os.environ.get("DB_WRITER_THREADS", "8")), MAX_WRITER_CONNECTIONS)
+
+# The writer whose batch is running on this thread, for nested writes
+_local = threading.local()
+
+
+def _default_connect(path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, timeout=10.0, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout=10000")
+    return conn
+
+
+class _Operation:
+    __slots__ = ("fn", "args", "kwargs", "exclusive", "future", "enqueued_at", "capture")
+
+    def __init__(self, fn: Callable, args, kwargs, exclusive: bool):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.exclusive = exclusive
+        self.future = Future()
+        self.enqueued_at = time.perf_counter()
+        self.capture = profiling.current()
+
+
+class DatabaseWriter:
+    """The single writer of one database file"""
+
+    def __init__(self, path: str, connect: Optional[Callable[[str], sqlite3.Connection]] = None,
+                 row_factory=None, batch_size: int = DB_WRITER_BATCH):
+        self.path = path
+        self.batch_size = max(1, batch_size)
+        self._connect = connect or _default_connect
+        self._row_factory = row_factory
+        self._pending: "deque[_Operation]" = deque()
+        self._cond = threading.Condition()
+        # Queued on or running in the pool; a writer is never queued twice
+        self._scheduled = False
+        self._runner: Optional[threading.Thread] = None
+        self._conn: Optional[sqlite3.Connection] = None
+        self._last_used = time.monotonic()
+        # Dropped from the registry; later writes go to its replacement
+        self._retired = False
+        self._stats = {"operations": 0, "batches": 0, "failed": 0, "batch_failures": 0,
+                       "max_batch": 0, "max_queued": 0, "total_wait": 0.0, "connections_opened": 0}
+
+    def submit(self, fn: Callable, *args, **kwargs) -> Future:
+        """Queue fn(conn, *args) to run in the next batch"""
+        return self._enqueue(_Operation(fn, args, kwargs, exclusive=False))
+
+    def submit_exclusive(self, fn: Callable, *args, **kwargs) -> Future:
+        """Queue fn(conn, *args) to run alone, outside a transaction (VACUUM, pragmas)"""
+        return self._enqueue(_Operation(fn, args, kwargs, exclusive=True))
+
+    def write(self, fn: Callable, *args, **kwargs):
+        """Run a write and wait for its commit; returns fn's result or raises its error"""
+        if getattr(_local, "writer", None) is self:
+            # Nested write from an operation already running in this batch
+            return fn(self._conn, *args, **kwargs)
+        future = self.submit(fn, *args, **kwargs)
+        with _pool.blocked():
+            return future.result()
+
+    def write_exclusive(self, fn: Callable, *args, **kwargs):
+        future = self.submit_exclusive(fn, *args, **kwargs)
+        with _pool.blocked():
+            return future.result()
+
+    def _enqueue(self, op: _Operation) -> Future:
+        with self._cond:
+            retired = self._retired
+            if not retired:
+                self._pending.append(op)
+                self._stats["max_queued"] = max(self._stats["max_queued"], len(self._pending))
+                schedule = not self._scheduled
+                self._scheduled = True
+        if retired:
+            return writer_for(self.path, self._connect, self._row_factory)._enqueue(op)
+        if schedule:
+            _pool.schedule(self)
+        return op.future
+
+    def _take_batch(self) -> List[_Operation]:
+        """The next batch to run (caller holds _cond)"""
+        if self._pending[0].exclusive:
+            return [self._pending.popleft()]
+        batch = []
+        while self._pending and len(batch) < self.batch_size and not self._pending[0].exclusive:
+            batch.append(self._pending.popleft())
+        return batch
+
+    def _open(self) -> sqlite3.Connection:
+        conn = self._connect(self.path)
+        conn.isolation_level = None  # transactions are managed here
+        if self._row_factory is not None:
+            conn.row_factory = self._row_factory
+        with self._cond:
+            self._conn = conn
+            self._stats["connections_opened"] += 1
+        _pool.opened(self)
+        return conn
+
+    def _run_next(self):
+        """Run one batch on the calling pool thread, then requeue if more is pending"""
+        with self._cond:
+            batch = self._take_batch()
+            self._runner = threading.current_thread()
+        _local.writer = self
+        try:
+            try:
+                conn = self._conn or self._open()
+            except Exception as e:
+                # Nothing queued can run without a connection
+                with self._cond:
+                    batch, self._pending = batch + list(self._pending), deque()
+                for op in batch:
+                    op.future.set_exception(e)
+                return
+            started = time.perf_counter()
+            with self._cond:
+                self._stats["total_wait"] += sum(started - op.enqueued_at for op in batch)
+            run = self._run_exclusive if batch[0].exclusive else self._run_batch
+            work = batch[0] if batch[0].exclusive else batch
+            # A batch holding a profiled write is profiled whole, commit included
+            capture = next((op.capture for op in batch if op.capture is not None), None)
+            if capture is not None:
+                profiling.run_captured(capture, run, conn, work)
+            else:
+                run(conn, work)
+        finally:
+            _local.writer = None
+            with self._cond:
+                self._runner = None
+                self._last_used = time.monotonic()
+                requeue = bool(self._pending)
+                self._scheduled = requeue
+            _pool.used(self)
+            # Back of the queue, so one busy file cannot starve the others
+            if requeue:
+                _pool.schedule(self)
+
+    def close_if_idle(self, idle_seconds: float = 0.0) -> bool:
+        """Close the write connection unless a batch is running; True if closed"""
+        with self._cond:
+            conn = self._conn
+            if conn is None or self._runner is not None:
+                return False
+            if time.monotonic() - self._last_used < idle_seconds:
+                return False
+            self._conn = None
+        conn.close()
+        return True
+
+    def retire_if_idle(self, idle_seconds: float) -> bool:
+        """Mark a writer with no work and no connection as dropped; True if retired"""
+        with self._cond:
+            if self._scheduled or self._pending or self._conn is not None:
+                return False
+            if time.monotonic() - self._last_used < idle_seconds:
+                return False
+            self._retired = True
+            return True
+
+    def _run_exclusive(self, conn: sqlite3.Connection, op: _Operation):
+        try:
+            result = op.fn(conn, *op.args, **op.kwargs)
+        except BaseException as e:
+            self._record(1, failed=1)
+            op.future.set_exception(e)
+        else:
+            self._record(1)
+            op.future.set_result(result)
+
+    def _run_batch(self, conn: sqlite3.Connection, batch: List[_Operation]):
+        outcomes = []
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for op in batch:
+                conn.execute("SAVEPOINT op")
+                try:
+                    result = op.fn(conn, *op.args, **op.kwargs)
+                except Exception as e:
+                    conn.execute("ROLLBACK TO op")
+                    conn.execute("RELEASE op")
+                    outcomes.append((op, None, e))
+                else:
+                    conn.execute("RELEASE op")
+                    outcomes.append((op, result, None))
+            conn.execute("COMMIT")
+        except BaseException as e:
+            # The batch as a whole failed (e.g. BEGIN or COMMIT): nothing was written
+            try:
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+            except Exception:
+                pass
+            with self._cond:
+                self._stats["batch_failures"] += 1
+            self._record(len(batch), failed=len(batch))
+            for op in batch:
+                if not op.future.done():
+                    op.future.set_exception(e)
+            return
+
+        self._record(len(batch), failed=sum(1 for _, _, error in outcomes if error))
+        for op, result, error in outcomes:
+            if error is not None:
+                op.future.set_exception(error)
+            else:
+                op.future.set_result(result)
+
+    def _record(self, operations: int, failed: int = 0):
+        with self._cond:
+            self._stats["operations"] += operations
+            self._stats["batches"] += 1
+            self._stats["failed"] += failed
+            self._stats["max_batch"] = max(self._stats["max_batch"], operations)
+
+    def flush(self, timeout: Optional[float] = None):
+        """Wait until everything queued so far has been written"""
+        self.submit(lambda conn: None).result(timeout)
+
+    def stats(self) -> Dict:
+        with self._cond:
+            stats = dict(self._stats)
+            stats["queued"] = len(self._pending)
+            stats["running"] = self._runner is not None
+            stats["connected"] = self._conn is not None
+        total_wait = stats.pop("total_wait")
+        stats["avg_batch"] = round(stats["operations"] / (stats["batches"] or 1), 2)
+        stats["avg_queue_wait_ms"] = round(total_wait / (stats["operations"] or 1) * 1000, 3)
+        return stats
+
+
+class _WriterPool:
+    """The threads that run writer batches, and the budget of open write connections"""
+
+    def __init__(self, max_threads: int = DB_WRITER_THREADS, max_connections: int = MAX_WRITER_CONNECTIONS,
+                 idle_seconds: float = DB_WRITER_IDLE_SECONDS):
+        self.max_threads = max(1, max_threads)
+        self.max_connections = max(1, max_connections)
+        self.idle_seconds = idle_seconds
+        self._ready: "deque[DatabaseWriter]" = deque()
+        self._cond = threading.Condition()
+        self._threads = 0
+        self._idle_threads = 0
+        # Pool threads waiting on another writer from inside a batch
+        self._blocked = 0
+        # Writers with an open connection, least recently opened or used first
+        self._open: "OrderedDict[DatabaseWriter, None]" = OrderedDict()
+        self._stats = {"thread_starts": 0, "connections_closed": 0, "writers_retired": 0}
+        self._next_sweep = time.monotonic() + idle_seconds
+
+    def schedule(self, writer: DatabaseWriter):
+        with self._cond:
+            self._ready.append(writer)
+            if self._idle_threads:
+                self._cond.notify()
+            elif self._threads < self.max_threads + self._blocked:
+                self._start_thread()
+
+    def _start_thread(self):
+        self._threads += 1
+        self._stats["thread_starts"] += 1
+        threading.Thread(target=self._work, daemon=True, name=f"db-writer-{self._stats['thread_starts']}").start()
+
+    @contextmanager
+    def blocked(self):
+        """Let another thread run batches while a pool thread waits on a write"""
+        if getattr(_local, "writer", None) is None:
+            yield
+            return
+        with self._cond:
+            self._blocked += 1
+            if self._ready and not self._idle_threads and self._threads < self.max_threads + self._blocked:
+                self._start_thread()
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._blocked -= 1
+
+    def _work(self):
+        while True:
+            with self._cond:
+                # Threads started for blocked ones leave once those are done
+                if self._threads > self.max_threads + self._blocked:
+                    self._threads -= 1
+                    return
+                while not self._ready:
+                    self._idle_threads += 1
+                    woken = self._cond.wait(self.idle_seconds)
+                    self._idle_threads -= 1
+                    if not woken and not self._ready:
+                        break
+                if self._ready:
+                    writer = self._ready.popleft()
+                else:
+                    writer = None
+                    # One thread stays to close connections and drop idle writers
+                    if self._threads > 1 or not (self._open or _writers):
+                        self._threads -= 1
+                        return
+            if writer is not None:
+                try:
+                    writer._run_next()
+                except BaseException as e:
+                    # Keep the pool running; the batch's callers were already failed
+                    print(f"❌ Writer thread error on {os.path.basename(writer.path)}: {e}")
+            # Also while busy, so a pool that never idles still closes idle files
+            if writer is None or time.monotonic() >= self._next_sweep:
+                self.sweep()
+
+    def opened(self, writer: DatabaseWriter):
+        """Count a new connection, closing least recently used idle ones past the budget"""
+        with self._cond:
+            self._open[writer] = None
+            candidates = [w for w in self._open if w is not writer]
+            excess = len(self._open) - self.max_connections
+        for other in candidates:
+            if excess <= 0:
+                break
+            if other.close_if_idle():
+                self._closed(other)
+                excess -= 1
+
+    def used(self, writer: DatabaseWriter):
+        with self._cond:
+            if writer in self._open:
+                self._open.move_to_end(writer)
+
+    def _closed(self, writer: DatabaseWriter):
+        with self._cond:
+            self._open.pop(writer, None)
+            self._stats["connections_closed"] += 1
+
+    def sweep(self):
+        """Close idle connections and drop writers that have been idle with none"""
+        with self._cond:
+            self._next_sweep = time.monotonic() + self.idle_seconds
+            connected = list(self._open)
+        for writer in connected:
+            if writer.close_if_idle(self.idle_seconds):
+                self._closed(writer)
+        with _writers_lock:
+            for path, writer in list(_writers.items()):
+                if writer.retire_if_idle(self.idle_seconds):
+                    del _writers[path]
+                    self._stats["writers_retired"] += 1
+
+    def stats(self) -> Dict:
+        with self._cond:
+            return {
+                "threads": self._threads,
+                "max_threads": self.max_threads,
+                "ready": len(self._ready),
+                "open_connections": len(self._open),
+                "max_connections": self.max_connections,
+                **self._stats,
+            }
+
+
+_pool = _WriterPool()
+_writers: Dict[str, DatabaseWriter] = {}
+_writers_lock = threading.Lock()
+
+
+def writer_for(path: str, connect: Optional[Callable[[str], sqlite3.Connection]] = None,
+               row_factory=None) -> DatabaseWriter:
+    """The writer for a file (created on first use; later arguments are ignored)"""
+    writer = _writers.get(path)
+    if writer is None:
+        with _writers_lock:
+            writer = _writers.get(path)
+            if writer is None:
+                writer = _writers[path] = DatabaseWriter(path, connect, row_factory)
+    return writer
+
+
+def flush_all(timeout: Optional[float] = None):
+    """Wait for every queued write (shutdown)"""
+    with _writers_lock:
+        writers = list(_writers.values())
+    for writer in writers:
+        stats = writer.stats()
+        if stats["queued"] or stats["running"]:
+            writer.flush(timeout)
+
+
+def stats() -> Dict:
+    with _writers_lock:
+        writers = list(_writers.values())
+    per_writer = [writer.stats() for writer in writers]
+    operations = sum(s["operations"] for s in per_writer)
+    batches = sum(s["batches"] for s in per_writer)
+    return {
+        "writers": len(per_writer),
+        "running": sum(1 for s in per_writer if s["running"]),
+        "queued": sum(s["queued"] for s in per_writer),
+        "operations": operations,
+        "batches": batches,
+        "avg_batch": round(operations / (batches or 1), 2),
+        "max_batch": max((s["max_batch"] for s in per_writer), default=0),
+        "failed": sum(s["failed"] for s in per_writer),
+        "batch_failures": sum(s["batch_failures"] for s in per_writer),
+        "pool": _pool.stats(),
+    }
@@ -1,73 +1,131 @@
 """
 Device Registry Management
 Handles device-email associations and QR code access control
+
+With REGISTRY_SHARDS > 1 the registry is split into shard files by
+device_id (registrations and their connection history live in the
+device's shard) plus an owner index file mapping owners to devices for
+get_user_devices. A single shard keeps the original device_registry.db;
+migrate_registry.py moves an existing file into shards.
 """
 import sqlite3
 import os
+import json
+import zlib
+from concurrent.futures import Future
 from datetime import datetime
 from typing import Optional, List, Dict
 from contextlib import contextmanager
-import time
+import audit_log
+import db_writer
 
 # Use /tmp directory or current directory with proper permissions
 DB_DIR = os.environ.get('DB_DIR', '/tmp')
 DB_PATH = os.path.join(DB_DIR, "device_registry.db")
+REGISTRY_SHARDS = max(1, int(os.environ.get("REGISTRY_SHARDS", "1")))
+OWNER_INDEX_PATH = os.path.join(DB_DIR, "device_registry_owners.db")
+
+def is_sharded() -> bool:
+    return REGISTRY_SHARDS > 1
+
+def shard_for(device_id: str) -> int:
+    # crc32 is stable across processes, unlike hash()
+    return zlib.crc32(device_id.encode("utf-8")) % REGISTRY_SHARDS
+
+def shard_path(shard: int) -> str:
+    if not is_sharded():
+        return DB_PATH
+    return os.path.join(DB_DIR, f"device_registry_{shard:03d}.db")
+
+def shard_paths() -> List[str]:
+    return [shard_path(shard) for shard in range(REGISTRY_SHARDS)]
+
+def group_by_shard(device_ids: List[str]) -> Dict[int, List[str]]:
+    groups: Dict[int, List[str]] = {}
+    for device_id in device_ids:
+        groups.setdefault(shard_for(device_id), []).append(device_id)
+    return groups
 
 @contextmanager
-def get_db_connection():
-    """Context manager for database connections with retry logic"""
-    # Ensure directory exists
+def read_connection(path: str):
+    """
+    A read-only WAL connection. Readers never wait on the writer; every
+    write goes through the file's writer instead.
+    """
     os.makedirs(DB_DIR, exist_ok=True)
-    
-    # Retry logic for locked database
-    max_retries = 5
-    retry_delay = 0.1  # 100ms
-    
-    for attempt in range(max_retries):
-        try:
-            # Enable WAL mode and set timeout for better concurrency
-            conn = sqlite3.connect(
-                DB_PATH,
-                timeout=10.0,  # Wait up to 10 seconds for locks
-                check_same_thread=False
-            )
-            conn.row_factory = sqlite3.Row
-            
-            # Enable Write-Ahead Logging for better concurrency
-            conn.execute("PRAGMA journal_mode=WAL")
-            conn.execute("PRAGMA busy_timeout=10000")  # 10 seconds
-            
-            try:
-                yield conn
-                conn.commit()
-                break  # Success, exit retry loop
-            except sqlite3.OperationalError as e:
-                if "database is locked" in str(e).lower() and attempt < max_retries - 1:
-                    print(f"⚠️ Database locked, retrying ({attempt + 1}/{max_retries})...")
-                    conn.rollback()
-                    conn.close()
-                    time.sleep(retry_delay * (attempt + 1))  # Exponential backoff
-                    continue
-                else:
-                    conn.rollback()
-                    raise e
-            except Exception as e:
-                conn.rollback()
-                raise e
-            finally:
-                conn.close()
-                
-        except sqlite3.OperationalError as e:
-            if "database is locked" in str(e).lower() and attempt < max_retries - 1:
-                print(f"⚠️ Database locked on connect, retrying ({attempt + 1}/{max_retries})...")
-                time.sleep(retry_delay * (attempt + 1))
-                continue
-            else:
-                raise e
+    conn = sqlite3.connect(path, timeout=10.0, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA busy_timeout=10000")
+        conn.execute("PRAGMA query_only=ON")
+        yield conn
+    finally:
+        conn.close()
+
+def get_db_connection(device_id: Optional[str] = None):
+    """Read-only connection to the device's shard (the first shard when no device is given)"""
+    return read_connection(shard_path(shard_for(device_id) if device_id else 0))
+
+def shard_writer(shard: int) -> db_writer.DatabaseWriter:
+    os.makedirs(DB_DIR, exist_ok=True)
+    return db_writer.writer_for(shard_path(shard), row_factory=sqlite3.Row)
+
+def registry_writer(device_id: Optional[str] = None) -> db_writer.DatabaseWriter:
+    """The single writer of the device's shard (the first shard when no device is given)"""
+    return shard_writer(shard_for(device_id) if device_id else 0)
+
+def _owner_index_writer() -> db_writer.DatabaseWriter:
+    os.makedirs(DB_DIR, exist_ok=True)
+    return db_writer.writer_for(OWNER_INDEX_PATH, row_factory=sqlite3.Row)
+
+def _set_owner(device_id: str, owner_email: Optional[str]) -> Optional[Future]:
+    """
+    Queue an owner index change (None removes the device). Called from
+    inside the shard operation, so a device's index changes are queued in
+    the same order as its registration writes.
+    """
+    if not is_sharded():
+        return None
+    if owner_email is None:
+        return _owner_index_writer().submit(lambda conn: conn.execute(
+            "DELETE FROM device_owners WHERE device_id = ?", (device_id,)
+        ))
+    return _owner_index_writer().submit(lambda conn: conn.execute(
+        """INSERT INTO device_owners (device_id, owner_email) VALUES (?, ?)
+           ON CONFLICT(device_id) DO UPDATE SET owner_email = excluded.owner_email""",
+        (device_id, owner_email)
+    ))
+
+def _wait_for_index(update: Optional[Future]):
+    # The shard row is authoritative and owner lookups re-check it, so a
+    # failed index write only hides the device until the next startup
+    # fills the index in again
+    if update is None:
+        return
+    try:
+        update.result()
+    except Exception as e:
+        print(f"⚠️ Owner index update failed: {e}")
+
+def owned_device_ids(emails: List[str]) -> List[str]:
+    """Candidate devices of the given owners from the owner index (sharded layout only)"""
+    with read_connection(OWNER_INDEX_PATH) as conn:
+        return [row["device_id"] for row in conn.execute(
+            "SELECT device_id FROM device_owners WHERE owner_email IN (SELECT value FROM json_each(?))",
+            (json.dumps(emails),)
+        )]
 
 def init_registry_db():
     """Initialize the device registry database"""
-    with get_db_connection() as conn:
+    active = create_registry_schema()
+    if is_sharded() and active == 0 and os.path.exists(DB_PATH):
+        print(f"⚠️ {DB_PATH} exists but the registry shards are empty - run migrate_registry.py")
+    print(f"✅ Device registry database initialized ({REGISTRY_SHARDS} shard(s))")
+
+def create_registry_schema() -> Optional[int]:
+    """Create every shard (and the owner index); returns the active device count when sharded"""
+    def create_schema(conn):
         cursor = conn.cursor()
         
         # Device registrations table
@@ -98,21 +156,64 @@ def init_registry_db():
         ''')
         
         # Create indexes for faster lookups
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_connection_history_device_time
+            ON connection_history(device_id, timestamp)
+        ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_connection_history_timestamp
+            ON connection_history(timestamp)
+        ''')
         cursor.execute('''
             CREATE INDEX IF NOT EXISTS idx_device_id 
             ON device_registrations(device_id)
         ''')
+        # Serves owner lookups and their ORDER BY last_connected
         cursor.execute('''
-            CREATE INDEX IF NOT EXISTS idx_owner_email 
-            ON device_registrations(owner_email)
+            CREATE INDEX IF NOT EXISTS idx_owner_active_connected
+            ON device_registrations(owner_email, is_active, last_connected)
         ''')
-        
-        conn.commit()
-        print("✅ Device registry database initialized")
+        cursor.execute("DROP INDEX IF EXISTS idx_owner_email")
+
+    for shard in range(REGISTRY_SHARDS):
+        shard_writer(shard).write(create_schema)
+    return fill_owner_index() if is_sharded() else None
+
+def fill_owner_index() -> int:
+    """
+    Create the owner index and add any active device it is missing.
+    Returns the number of active devices across the shards.
+    """
+    def create_schema(conn):
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS device_owners (
+                device_id TEXT PRIMARY KEY,
+                owner_email TEXT NOT NULL
+            )
+        ''')
+        conn.execute('''
+            CREATE INDEX IF NOT EXISTS idx_device_owners_owner
+            ON device_owners(owner_email, device_id)
+        ''')
+
+    writer = _owner_index_writer()
+    writer.write(create_schema)
+
+    owners = []
+    for path in shard_paths():
+        with read_connection(path) as conn:
+            owners += [tuple(row) for row in conn.execute(
+                "SELECT device_id, owner_email FROM device_registrations WHERE is_active = 1"
+            )]
+    # Only fills gaps: an existing entry may be newer than this snapshot
+    writer.write(lambda conn: conn.executemany(
+        "INSERT OR IGNORE INTO device_owners (device_id, owner_email) VALUES (?, ?)", owners
+    ))
+    return len(owners)
 
 def is_device_registered(device_id: str) -> bool:
     """Check if a device is already registered"""
-    with get_db_connection() as conn:
+    with get_db_connection(device_id) as conn:
         cursor = conn.cursor()
         cursor.execute(
             "SELECT COUNT(*) as count FROM device_registrations WHERE device_id = ? AND is_active = 1",
@@ -123,28 +224,33 @@ def is_device_registered(device_id: str) -> bool:
 
 def get_device_owner(device_id: str) -> Optional[str]:
     """Get the owner email of a device"""
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute(
-            "SELECT owner_email FROM device_registrations WHERE device_id = ? AND is_active = 1",
-            (device_id,)
-        )
-        result = cursor.fetchone()
-        return result['owner_email'] if result else None
+    with get_db_connection(device_id) as conn:
+        return _active_owner(conn.cursor(), device_id)
+
+def _active_owner(cursor, device_id: str) -> Optional[str]:
+    cursor.execute(
+        "SELECT owner_email FROM device_registrations WHERE device_id = ? AND is_active = 1",
+        (device_id,)
+    )
+    result = cursor.fetchone()
+    return result['owner_email'] if result else None
 
 def register_device(device_id: str, owner_email: str, firebase_url: str) -> Dict:
     """
     Register a device to an email account
     Returns success status and message
     """
-    with get_db_connection() as conn:
+    # Ownership check and write run as one operation on the registry writer,
+    # so parallel QR scans are applied one after another; audit rows go to
+    # the write-behind buffer
+    def register(conn):
         cursor = conn.cursor()
         
         # Check if device is already registered to another email
-        existing_owner = get_device_owner(device_id)
+        existing_owner = _active_owner(cursor, device_id)
         if existing_owner and existing_owner != owner_email:
-            log_connection_attempt(device_id, owner_email, "register_denied", False, 
-                                  f"Device already owned by {existing_owner}")
+            audit_log.record(device_id, owner_email, "register_denied", False,
+                             f"Device already owned by {existing_owner}")
             return {
                 "success": False,
                 "message": f"Access denied: This device is already registered to another account",
@@ -166,7 +272,7 @@ def register_device(device_id: str, owner_email: str, firebase_url: str) -> Dict
                    WHERE device_id = ?""",
                 (owner_email, datetime.now(), firebase_url, device_id)
             )
-            log_connection_attempt(device_id, owner_email, "reactivate", True, "Device reactivated")
+            audit_log.record(device_id, owner_email, "reactivate", True, "Device reactivated")
             return {
                 "success": True,
                 "message": "Device reconnected successfully",
@@ -183,7 +289,7 @@ def register_device(device_id: str, owner_email: str, firebase_url: str) -> Dict
                    firebase_url = ?""",
                 (device_id, owner_email, firebase_url, datetime.now(), datetime.now(), firebase_url)
             )
-            log_connection_attempt(device_id, owner_email, "register", True, "Device registered successfully")
+            audit_log.record(device_id, owner_email, "register", True, "Device registered successfully")
             
             return {
                 "success": True,
@@ -191,23 +297,33 @@ def register_device(device_id: str, owner_email: str, firebase_url: str) -> Dict
                 "action": "registered"
             }
         except sqlite3.IntegrityError as e:
-            log_connection_attempt(device_id, owner_email, "register_error", False, str(e))
+            audit_log.record(device_id, owner_email, "register_error", False, str(e))
             return {
                 "success": False,
                 "message": "Failed to register device",
                 "error_code": "DATABASE_ERROR"
             }
 
+    def register_and_index(conn):
+        # A re-scan by the current owner leaves the owner index as it is
+        unchanged = is_sharded() and _active_owner(conn.cursor(), device_id) == owner_email
+        result = register(conn)
+        return result, _set_owner(device_id, owner_email) if result["success"] and not unchanged else None
+
+    result, index_update = registry_writer(device_id).write(register_and_index)
+    _wait_for_index(index_update)
+    return result
+
 def disconnect_device(device_id: str, owner_email: str) -> Dict:
     """
     Disconnect a device from an account
     Marks the device as inactive instead of deleting
     """
-    with get_db_connection() as conn:
+    def disconnect(conn):
         cursor = conn.cursor()
         
         # Verify ownership
-        current_owner = get_device_owner(device_id)
+        current_owner = _active_owner(cursor, device_id)
         if not current_owner:
             return {
                 "success": False,
@@ -216,8 +332,8 @@ def disconnect_device(device_id: str, owner_email: str) -> Dict:
             }
         
         if current_owner != owner_email:
-            log_connection_attempt(device_id, owner_email, "disconnect_denied", False, 
-                                  f"Not owner. Actual owner: {current_owner}")
+            audit_log.record(device_id, owner_email, "disconnect_denied", False,
+                             f"Not owner. Actual owner: {current_owner}")
             return {
                 "success": False,
                 "message": "Access denied: You don't own this device",
@@ -230,64 +346,86 @@ def disconnect_device(device_id: str, owner_email: str) -> Dict:
             (device_id,)
         )
         
-        log_connection_attempt(device_id, owner_email, "disconnect", True, "Device disconnected")
+        audit_log.record(device_id, owner_email, "disconnect", True, "Device disconnected")
         
         return {
             "success": True,
             "message": "Device disconnected successfully"
         }
 
+    def disconnect_and_index(conn):
+        result = disconnect(conn)
+        return result, _set_owner(device_id, None) if result["success"] else None
+
+    result, index_update = registry_writer(device_id).write(disconnect_and_index)
+    _wait_for_index(index_update)
+    return result
+
 def get_user_devices(owner_email: str) -> List[Dict]:
     """Get all active devices for a user"""
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute(
-            """SELECT device_id, firebase_url, registered_at, last_connected
-               FROM device_registrations 
-               WHERE owner_email = ? AND is_active = 1
-               ORDER BY last_connected DESC""",
-            (owner_email,)
-        )
-        
-        devices = []
-        for row in cursor.fetchall():
-            devices.append({
-                "device_id": row['device_id'],
-                "firebase_url": row['firebase_url'],
-                "registered_at": row['registered_at'],
-                "last_connected": row['last_connected']
-            })
-        
-        return devices
-
-def log_connection_attempt(device_id: str, email: str, action: str, 
-                          success: bool, notes: str = ""):
-    """Log all connection attempts for audit purposes"""
-    # Use a separate connection to avoid nested transactions
-    try:
+    if is_sharded():
+        rows = []
+        for shard, device_ids in group_by_shard(owned_device_ids([owner_email])).items():
+            with read_connection(shard_path(shard)) as conn:
+                # The index only names candidates; the shard decides ownership
+                rows += conn.execute(
+                    """SELECT device_id, firebase_url, registered_at, last_connected
+                       FROM device_registrations
+                       WHERE device_id IN (SELECT value FROM json_each(?))
+                       AND owner_email = ? AND is_active = 1""",
+                    (json.dumps(device_ids), owner_email)
+                ).fetchall()
+        rows.sort(key=lambda row: row['last_connected'] or "", reverse=True)
+    else:
         with get_db_connection() as conn:
             cursor = conn.cursor()
             cursor.execute(
-                """INSERT INTO connection_history (device_id, email, action, success, notes)
-                   VALUES (?, ?, ?, ?, ?)""",
-                (device_id, email, action, success, notes)
+                """SELECT device_id, firebase_url, registered_at, last_connected
+                   FROM device_registrations 
+                   WHERE owner_email = ? AND is_active = 1
+                   ORDER BY last_connected DESC""",
+                (owner_email,)
             )
-    except Exception as e:
-        # Don't fail the main operation if logging fails
-        print(f"⚠️ Failed to log connection attempt: {e}")
+            rows = cursor.fetchall()
+    
+    devices = []
+    for row in rows:
+        devices.append({
+            "device_id": row['device_id'],
+            "firebase_url": row['firebase_url'],
+            "registered_at": row['registered_at'],
+            "last_connected": row['last_connected']
+        })
+    
+    return devices
+
+def list_device_ids() -> List[str]:
+    """Every registered device ID, active or not, across all shards"""
+    device_ids = []
+    for path in shard_paths():
+        with read_connection(path) as conn:
+            device_ids += [row["device_id"] for row in conn.execute("SELECT device_id FROM device_registrations")]
+    return device_ids
+
+def log_connection_attempt(device_id: str, email: str, action: str, 
+                          success: bool, notes: str = ""):
+    """Log all connection attempts for audit purposes (buffered, written in batches)"""
+    audit_log.record(device_id, email, action, success, notes)
 
 def update_last_connected(device_id: str):
     """Update the last connected timestamp for a device"""
-    with get_db_connection() as conn:
+    def touch(conn):
         cursor = conn.cursor()
         cursor.execute(
             "UPDATE device_registrations SET last_connected = ? WHERE device_id = ?",
             (datetime.now(), device_id)
         )
 
+    registry_writer(device_id).write(touch)
+
 def get_device_info(device_id: str) -> Optional[Dict]:
     """Get detailed information about a device"""
-    with get_db_connection() as conn:
+    with get_db_connection(device_id) as conn:
         cursor = conn.cursor()
         cursor.execute(
             """SELECT * FROM device_registrations 
@@ -313,7 +451,7 @@ def cleanup_old_connections(days: int = 90):
     Clean up old inactive device registrations
     (Optional maintenance function)
     """
-    with get_db_connection() as conn:
+    def cleanup(conn):
         cursor = conn.cursor()
         cursor.execute(
             """DELETE FROM device_registrations 
@@ -321,6 +459,16 @@ def cleanup_old_connections(days: int = 90):
                AND last_connected < datetime('now', '-' || ? || ' days')""",
             (days,)
         )
-        deleted_count = cursor.rowcount
-        print(f"🧹 Cleaned up {deleted_count} old device registrations")
-        return deleted_count
\ No newline at end of file
+        return cursor.rowcount
+
+    deleted_count = sum(shard_writer(shard).write(cleanup) for shard in range(REGISTRY_SHARDS))
+    print(f"🧹 Cleaned up {deleted_count} old device registrations")
+    return deleted_count
+
+def stats() -> Dict:
+    """Shard layout and how writes spread over the shards"""
+    return {
+        "shards": REGISTRY_SHARDS,
+        "owner_index": is_sharded(),
+        "writes_per_shard": [shard_writer(shard).stats()["operations"] for shard in range(REGISTRY_SHARDS)],
+    }
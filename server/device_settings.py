@@ -0,0 +1,225 @@
+"""
+Device Settings
+Per-device settings (timezone, dispensing message, notification
+preferences, quiet hours) persisted in the server state DB behind a
+read-through cache. Every write bumps the row version and drops the
+cached copy (in other workers via shared_state), so the scheduler and
+notifier read settings from memory and only the first read after a
+change touches the DB.
+"""
+import datetime
+import re
+import threading
+from dataclasses import dataclass, fields, replace
+from typing import Dict, Optional
+import pytz
+import state_store
+import shared_state
+import context
+
+QUIET_TIME_REGEX = re.compile(r'^([01]\d|2[0-3]):[0-5]\d$')
+NOTIFICATION_KINDS = ("dispensing", "taken", "errors", "low_stock")
+# Error notifications are safety-relevant and still go out during quiet hours
+QUIET_EXEMPT_KINDS = ("errors",)
+
+
+@dataclass(frozen=True)
+class DeviceSettings:
+    device_id: str
+    timezone: Optional[str] = None
+    dispensing_message: Optional[str] = None
+    notify_dispensing: bool = True
+    notify_taken: bool = True
+    notify_errors: bool = True
+    notify_low_stock: bool = True
+    quiet_start: Optional[str] = None  # "HH:MM" local time
+    quiet_end: Optional[str] = None
+    version: int = 0
+
+    def to_dict(self) -> Dict:
+        return {f.name: getattr(self, f.name) for f in fields(self)}
+
+
+# Columns a client may change; device_id and version are managed here
+SETTING_FIELDS = tuple(f.name for f in fields(DeviceSettings) if f.name not in ("device_id", "version"))
+_BOOL_FIELDS = tuple(name for name in SETTING_FIELDS if name.startswith("notify_"))
+
+_lock = threading.Lock()
+_cache: Dict[str, DeviceSettings] = {}
+# Bumped on every write so a read that raced with the write cannot cache the old row
+_generations: Dict[str, int] = {}
+_stats = {"hits": 0, "misses": 0, "writes": 0}
+_initialized = False
+
+
+def _ensure_table():
+    global _initialized
+    if _initialized:
+        return
+    with state_store.transaction() as conn:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS device_settings (
+                device_id TEXT PRIMARY KEY,
+                timezone TEXT,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        # Tables created when only the timezone was stored gain the new columns
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(device_settings)")}
+        for name, ddl in (
+            ("dispensing_message", "TEXT"),
+            ("notify_dispensing", "INTEGER NOT NULL DEFAULT 1"),
+            ("notify_taken", "INTEGER NOT NULL DEFAULT 1"),
+            ("notify_errors", "INTEGER NOT NULL DEFAULT 1"),
+            ("notify_low_stock", "INTEGER NOT NULL DEFAULT 1"),
+            ("quiet_start", "TEXT"),
+            ("quiet_end", "TEXT"),
+            ("version", "INTEGER NOT NULL DEFAULT 1"),
+        ):
+            if name not in columns:
+                conn.execute(f"ALTER TABLE device_settings ADD COLUMN {name} {ddl}")
+    _initialized = True
+
+
+def validate_timezone(tz_name: str) -> str:
+    """Return the canonical zone name or raise ValueError"""
+    try:
+        return pytz.timezone(tz_name).zone
+    except pytz.UnknownTimeZoneError:
+        raise ValueError(f"Unknown timezone: {tz_name}")
+
+
+def _validate(current: DeviceSettings, changes: Dict) -> Dict:
+    unknown = set(changes) - set(SETTING_FIELDS)
+    if unknown:
+        raise ValueError(f"Unknown settings: {', '.join(sorted(unknown))}")
+
+    if changes.get("timezone") is not None:
+        changes["timezone"] = validate_timezone(changes["timezone"])
+    if "dispensing_message" in changes and changes["dispensing_message"] is not None:
+        message = changes["dispensing_message"].strip()
+        changes["dispensing_message"] = message or None
+    for name in _BOOL_FIELDS:
+        if name in changes:
+            changes[name] = bool(changes[name])
+    for name in ("quiet_start", "quiet_end"):
+        value = changes.get(name)
+        if value is not None and not QUIET_TIME_REGEX.match(value):
+            raise ValueError(f"{name} must be HH:MM (24-hour)")
+
+    merged = replace(current, **changes)
+    if (merged.quiet_start is None) != (merged.quiet_end is None):
+        raise ValueError("quiet_start and quiet_end must be set together")
+    return changes
+
+
+def _load(device_id: str) -> DeviceSettings:
+    _ensure_table()
+    columns = ", ".join(SETTING_FIELDS + ("version",))
+    with state_store.transaction() as conn:
+        row = conn.execute(
+            f"SELECT {columns} FROM device_settings WHERE device_id = ?", (device_id,)
+        ).fetchone()
+    if not row:
+        return DeviceSettings(device_id)
+    values = dict(zip(SETTING_FIELDS + ("version",), row))
+    for name in _BOOL_FIELDS:
+        values[name] = bool(values[name])
+    return DeviceSettings(device_id, **values)
+
+
+def get_settings(device_id: str) -> DeviceSettings:
+    """A device's settings, from the cache when it is current"""
+    with _lock:
+        cached = _cache.get(device_id)
+        if cached is not None:
+            _stats["hits"] += 1
+            return cached
+        _stats["misses"] += 1
+        generation = _generations.get(device_id, 0)
+
+    settings = _load(device_id)
+    with _lock:
+        if _generations.get(device_id, 0) == generation:
+            _cache[device_id] = settings
+    return settings
+
+
+def update_settings(device_id: str, **changes) -> DeviceSettings:
+    """
+    Persist the given settings and invalidate the cached copy. Unknown
+    names, zones or quiet-hour formats raise ValueError.
+    """
+    changes = _validate(get_settings(device_id), changes)
+    if not changes:
+        return get_settings(device_id)
+
+    names = list(changes)
+    assignments = ", ".join(f"{name} = excluded.{name}" for name in names)
+    with state_store.transaction() as conn:
+        conn.execute(
+            f"""INSERT INTO device_settings (device_id, {', '.join(names)}, updated_at)
+                VALUES (?, {', '.join('?' for _ in names)}, CURRENT_TIMESTAMP)
+                ON CONFLICT(device_id) DO UPDATE SET {assignments},
+                version = version + 1, updated_at = CURRENT_TIMESTAMP""",
+            (device_id, *changes.values())
+        )
+    invalidate(device_id)
+    shared_state.bump(f"settings:{device_id}")
+    with _lock:
+        _stats["writes"] += 1
+    return get_settings(device_id)
+
+
+def invalidate(device_id: str):
+    """Drop a device's cached settings (after a write here or in another worker)"""
+    with _lock:
+        _generations[device_id] = _generations.get(device_id, 0) + 1
+        _cache.pop(device_id, None)
+
+
+shared_state.on_change("settings:", lambda scope: invalidate(scope.split(":", 1)[1]))
+
+
+def set_timezone(device_id: str, tz_name: str) -> str:
+    """Store a device's timezone. Raises ValueError for unknown zones."""
+    return update_settings(device_id, timezone=tz_name).timezone
+
+
+def get_timezone_name(device_id: Optional[str]) -> str:
+    """A device's timezone name, falling back to the server default"""
+    default = context.selected_timezone.zone
+    if not device_id:
+        return default
+    return get_settings(device_id).timezone or default
+
+
+def get_timezone(device_id: Optional[str]):
+    """A device's pytz timezone object"""
+    return pytz.timezone(get_timezone_name(device_id))
+
+
+def in_quiet_hours(settings: DeviceSettings, now: Optional[datetime.datetime] = None) -> bool:
+    """True inside the device's quiet window (which may wrap past midnight)"""
+    if not settings.quiet_start or not settings.quiet_end:
+        return False
+    now = now or datetime.datetime.now(get_timezone(settings.device_id))
+    current = now.strftime("%H:%M")
+    if settings.quiet_start <= settings.quiet_end:
+        return settings.quiet_start <= current < settings.quiet_end
+    return current >= settings.quiet_start or current < settings.quiet_end
+
+
+def should_notify(device_id: Optional[str], kind: str) -> bool:
+    """Whether a notification of this kind may be sent now (no DB hit when cached)"""
+    if not device_id:
+        return True
+    settings = get_settings(device_id)
+    if not getattr(settings, f"notify_{kind}", True):
+        return False
+    return kind in QUIET_EXEMPT_KINDS or not in_quiet_hours(settings)
+
+
+def stats() -> Dict:
+    with _lock:
+        return {**_stats, "cached_devices": len(_cache)}
@@ -0,0 +1,108 @@
+"""
+Dispatch Executor
+Runs dose dispatches on a thread pool with one lane per (device, container).
+Jobs in the same lane run strictly in order; different containers and
+devices dispatch in parallel, so a slow Firebase push or Pushbullet call
+only delays later doses for that same container.
+"""
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, Optional, Tuple
+
+DISPATCH_WORKERS = int(os.environ.get("DISPATCH_WORKERS", "8"))
+
+Lane = Tuple[str, int]
+
+
+class _LaneState:
+    __slots__ = ("pending", "running", "started_at")
+
+    def __init__(self):
+        self.pending = deque()
+        self.running: Optional[Dict] = None
+        self.started_at: Optional[float] = None
+
+
+class DispatchExecutor:
+    """Thread pool that serializes jobs per (device_id, container_id) lane"""
+
+    def __init__(self, max_workers: int = DISPATCH_WORKERS):
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="dispatch")
+        self._lock = threading.Lock()
+        self._lanes: Dict[Lane, _LaneState] = {}
+        self._completed = 0
+        self._failed = 0
+
+    def submit(self, device_id: str, container_id: int, fn: Callable, *args,
+               info: Optional[Dict] = None) -> Future:
+        """Queue fn(*args) behind earlier jobs for the same container"""
+        future = Future()
+        job = (fn, args, future, info or {})
+        lane = (device_id, container_id)
+        with self._lock:
+            state = self._lanes.get(lane)
+            if state is None:
+                state = self._lanes[lane] = _LaneState()
+            state.pending.append(job)
+            if state.running is None:
+                self._start_next(lane, state)
+        return future
+
+    def _start_next(self, lane: Lane, state: _LaneState):
+        """Start the lane's next job (caller holds the lock)"""
+        fn, args, future, info = state.pending.popleft()
+        state.running = info
+        state.started_at = time.time()
+        self._pool.submit(self._run, lane, fn, args, future)
+
+    def _run(self, lane: Lane, fn: Callable, args, future: Future):
+        ok = False
+        try:
+            result = fn(*args)
+            ok = True
+            future.set_result(result)
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            with self._lock:
+                self._completed += 1
+                if not ok:
+                    self._failed += 1
+                state = self._lanes[lane]
+                if state.pending:
+                    self._start_next(lane, state)
+                else:
+                    # Idle lanes are dropped so the table only holds active containers
+                    del self._lanes[lane]
+
+    def device_status(self, device_id: str) -> Dict[int, Dict]:
+        """In-flight and queued dispatches per container for one device"""
+        with self._lock:
+            return {
+                container_id: {
+                    "in_flight": state.running,
+                    "running_seconds": round(time.time() - state.started_at, 1) if state.started_at else None,
+                    "queued": len(state.pending),
+                }
+                for (lane_device, container_id), state in self._lanes.items()
+                if lane_device == device_id
+            }
+
+    def is_busy(self, device_id: Optional[str] = None) -> bool:
+        with self._lock:
+            return any(device_id is None or lane[0] == device_id for lane in self._lanes)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "active_lanes": len(self._lanes),
+                "queued": sum(len(state.pending) for state in self._lanes.values()),
+                "completed": self._completed,
+                "failed": self._failed,
+            }
+
+
+dispatcher = DispatchExecutor()
@@ -0,0 +1,221 @@
+"""
+Device Event Stream
+Per-device publish/subscribe for server-sent events. Events are appended
+to a log in the server state DB and every worker tails that log, so a
+client gets dispenses fired by the scheduler leader whichever worker it
+is connected to, and can resume after its Last-Event-ID on any worker.
+Publishing is safe from any thread (scheduler, executors).
+"""
+import asyncio
+import json
+import os
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+import state_store
+
+EVENT_BUFFER_SIZE = int(os.environ.get("EVENT_BUFFER_SIZE", "500"))
+EVENT_RETENTION_SECONDS = float(os.environ.get("EVENT_RETENTION_SECONDS", "3600"))
+EVENT_POLL_SECONDS = float(os.environ.get("EVENT_POLL_SECONDS", "0.25"))
+EVENT_PRUNE_INTERVAL = 60
+SUBSCRIBER_QUEUE_SIZE = 100
+
+DISPENSE_FIRED = "dispense-fired"
+COMMAND_DELIVERED = "command-delivered"
+# Every delivery attempt of an occurrence failed
+DOSE_MISSED = "dose-missed"
+MEDICINE_TAKEN = "medicine-taken"
+ERROR = "error"
+INVENTORY_CHANGED = "inventory-changed"
+LOW_STOCK = "low-stock"
+
+_lock = threading.Lock()
+_subscribers: Dict[str, List["Subscription"]] = {}
+# Highest log ID already fanned out by this worker
+_cursor: Optional[int] = None
+_thread = None
+_initialized = False
+_stats = {"published": 0, "delivered": 0, "dropped_subscribers": 0, "pruned": 0}
+
+
+def _ensure_table():
+    global _initialized
+    if _initialized:
+        return
+    with state_store.transaction() as conn:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS event_log (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                device_id TEXT NOT NULL,
+                event TEXT NOT NULL,
+                data TEXT NOT NULL,
+                timestamp REAL NOT NULL
+            )
+        """)
+        conn.execute("""
+            CREATE INDEX IF NOT EXISTS idx_event_log_device
+            ON event_log(device_id, id)
+        """)
+        conn.execute("""
+            CREATE INDEX IF NOT EXISTS idx_event_log_timestamp
+            ON event_log(timestamp)
+        """)
+    _initialized = True
+
+
+def _row_to_event(row) -> Dict:
+    return {"id": row[0], "event": row[2], "data": json.loads(row[3]), "timestamp": row[4]}
+
+
+class Subscription:
+    """One connected client; events are handed to its event loop thread-safely"""
+
+    def __init__(self, device_id: str, loop: asyncio.AbstractEventLoop):
+        self.device_id = device_id
+        self.loop = loop
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        self.overflowed = False
+
+    def _deliver(self, event: Dict):
+        if self.overflowed:
+            return
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # Slow client: end its stream; it resumes from the log on reconnect
+            self.overflowed = True
+            _stats["dropped_subscribers"] += 1
+
+    def push(self, event: Dict):
+        try:
+            self.loop.call_soon_threadsafe(self._deliver, event)
+        except RuntimeError:
+            pass  # loop already closed
+
+
+def publish(device_id: Optional[str], event_type: str, data: Dict) -> Optional[Dict]:
+    """Append an event to the shared log; every worker's tail delivers it"""
+    if not device_id:
+        return None
+    _ensure_table()
+    timestamp = time.time()
+    with state_store.transaction() as conn:
+        cursor = conn.execute(
+            "INSERT INTO event_log (device_id, event, data, timestamp) VALUES (?, ?, ?, ?)",
+            (device_id, event_type, json.dumps(data, default=str), timestamp)
+        )
+        event_id = cursor.lastrowid
+    with _lock:
+        _stats["published"] += 1
+    return {"id": event_id, "event": event_type, "data": data, "timestamp": timestamp}
+
+
+def poll() -> int:
+    """Fan out events logged since the last poll (by any worker) to local subscribers"""
+    global _cursor
+    _ensure_table()
+    with state_store.transaction() as conn:
+        if _cursor is None:
+            _cursor = conn.execute("SELECT COALESCE(MAX(id), 0) FROM event_log").fetchone()[0]
+            return 0
+        rows = conn.execute(
+            "SELECT id, device_id, event, data, timestamp FROM event_log WHERE id > ? ORDER BY id",
+            (_cursor,)
+        ).fetchall()
+    if not rows:
+        return 0
+    _cursor = rows[-1][0]
+    delivered = 0
+    for row in rows:
+        with _lock:
+            subscribers = list(_subscribers.get(row[1], ()))
+        if subscribers:
+            event = _row_to_event(row)
+            for subscription in subscribers:
+                subscription.push(event)
+            delivered += len(subscribers)
+    with _lock:
+        _stats["delivered"] += delivered
+    return delivered
+
+
+def prune(retention_seconds: float = EVENT_RETENTION_SECONDS) -> int:
+    """Drop events older than the retention window"""
+    _ensure_table()
+    with state_store.transaction() as conn:
+        cursor = conn.execute(
+            "DELETE FROM event_log WHERE timestamp < ?", (time.time() - retention_seconds,)
+        )
+    with _lock:
+        _stats["pruned"] += cursor.rowcount
+    return cursor.rowcount
+
+
+def subscribe(device_id: str) -> "Subscription":
+    """Register a live subscriber (call from the client's event loop)"""
+    subscription = Subscription(device_id, asyncio.get_running_loop())
+    with _lock:
+        _subscribers.setdefault(device_id, []).append(subscription)
+    return subscription
+
+
+def replay(device_id: str, last_event_id: int) -> Tuple[List[Dict], bool]:
+    """
+    Events after last_event_id still in the log (blocking), and gap: True
+    when some were already pruned or there are more than EVENT_BUFFER_SIZE,
+    so the client should re-fetch state instead of relying on the replay.
+    """
+    _ensure_table()
+    with state_store.transaction() as conn:
+        rows = conn.execute(
+            "SELECT id, device_id, event, data, timestamp FROM event_log WHERE device_id = ? AND id > ? "
+            "ORDER BY id DESC LIMIT ?",
+            (device_id, last_event_id, EVENT_BUFFER_SIZE + 1)
+        ).fetchall()
+        oldest = conn.execute("SELECT MIN(id) FROM event_log").fetchone()[0]
+        if oldest is None:
+            sequence = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'event_log'").fetchone()
+            oldest = (sequence[0] if sequence else 0) + 1
+    truncated = len(rows) > EVENT_BUFFER_SIZE
+    missed = [_row_to_event(row) for row in reversed(rows[:EVENT_BUFFER_SIZE])]
+    return missed, truncated or last_event_id < oldest - 1
+
+
+def unsubscribe(subscription: "Subscription"):
+    with _lock:
+        subscribers = _subscribers.get(subscription.device_id, [])
+        if subscription in subscribers:
+            subscribers.remove(subscription)
+        if not subscribers:
+            _subscribers.pop(subscription.device_id, None)
+
+
+def _run():
+    last_prune = 0.0
+    while True:
+        time.sleep(EVENT_POLL_SECONDS)
+        try:
+            poll()
+            if time.monotonic() - last_prune > EVENT_PRUNE_INTERVAL:
+                prune()
+                last_prune = time.monotonic()
+        except Exception as e:
+            print(f"⚠️ Event stream poll failed: {e}")
+
+
+def start():
+    global _thread
+    if _thread is None:
+        poll()  # start tailing from the current end of the log
+        _thread = threading.Thread(target=_run, daemon=True, name="event-stream")
+        _thread.start()
+
+
+def stats() -> Dict:
+    with _lock:
+        return {
+            **_stats,
+            "subscribers": sum(len(s) for s in _subscribers.values()),
+            "subscribed_devices": len(_subscribers),
+            "cursor": _cursor,
+        }
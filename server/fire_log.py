@@ -0,0 +1,93 @@
+"""
+Fire Log
+Persistent record of dispatched schedule occurrences, keyed by
+(device_id, schedule_id, occurrence_at), so each dose is dispatched
+exactly once across restarts
+"""
+import os
+import time
+from typing import Set, Tuple
+import state_store
+
+# Occurrences missed by at most this much (downtime, slow tick) are still dispatched
+CATCH_UP_GRACE_SECONDS = int(os.environ.get("CATCH_UP_GRACE_SECONDS", "900"))
+FIRE_LOG_RETENTION_DAYS = int(os.environ.get("FIRE_LOG_RETENTION_DAYS", "30"))
+PRUNE_BATCH_SIZE = 500
+
+_initialized = False
+
+
+def _ensure_table():
+    global _initialized
+    if _initialized:
+        return
+    with state_store.transaction() as conn:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS fire_log (
+                device_id TEXT NOT NULL,
+                schedule_id INTEGER NOT NULL,
+                occurrence_at INTEGER NOT NULL,
+                fired_at REAL NOT NULL,
+                PRIMARY KEY (device_id, schedule_id, occurrence_at)
+            ) WITHOUT ROWID
+        """)
+        conn.execute("""
+            CREATE INDEX IF NOT EXISTS idx_fire_log_occurrence
+            ON fire_log(occurrence_at, device_id)
+        """)
+    _initialized = True
+
+
+def claim(device_id: str, schedule_id: int, occurrence_at: float) -> bool:
+    """
+    Record an occurrence as fired. Returns False if it was already
+    claimed, in which case it must not be dispatched again.
+    """
+    _ensure_table()
+    with state_store.transaction() as conn:
+        cursor = conn.execute(
+            "INSERT OR IGNORE INTO fire_log (device_id, schedule_id, occurrence_at, fired_at) VALUES (?, ?, ?, ?)",
+            (device_id, schedule_id, int(occurrence_at), time.time())
+        )
+        return cursor.rowcount == 1
+
+
+def release(device_id: str, schedule_id: int, occurrence_at: float):
+    """Forget a claim whose dispatch failed so catch-up can retry it"""
+    _ensure_table()
+    with state_store.transaction() as conn:
+        conn.execute(
+            "DELETE FROM fire_log WHERE device_id = ? AND schedule_id = ? AND occurrence_at = ?",
+            (device_id, schedule_id, int(occurrence_at))
+        )
+
+
+def fired_between(device_id: str, start: float, end: float) -> Set[Tuple[int, int]]:
+    """(schedule_id, occurrence_at) pairs already fired in [start, end]"""
+    _ensure_table()
+    with state_store.transaction() as conn:
+        rows = conn.execute(
+            """SELECT schedule_id, occurrence_at FROM fire_log
+               WHERE occurrence_at BETWEEN ? AND ? AND device_id = ?""",
+            (int(start), int(end), device_id)
+        ).fetchall()
+    return {(row[0], row[1]) for row in rows}
+
+
+def prune(retention_days: int = FIRE_LOG_RETENTION_DAYS) -> int:
+    """Delete entries older than the retention window in small batches"""
+    _ensure_table()
+    cutoff = int(time.time() - retention_days * 86400)
+    deleted = 0
+    while True:
+        with state_store.transaction() as conn:
+            cursor = conn.execute(
+                """DELETE FROM fire_log WHERE (device_id, schedule_id, occurrence_at) IN (
+                       SELECT device_id, schedule_id, occurrence_at FROM fire_log
+                       WHERE occurrence_at < ? LIMIT ?
+                   )""",
+                (cutoff, PRUNE_BATCH_SIZE)
+            )
+        deleted += cursor.rowcount
+        if cursor.rowcount < PRUNE_BATCH_SIZE:
+            return deleted
@@ -0,0 +1,125 @@
+"""
+Health Monitor
+Background thread that probes each component and keeps an in-memory
+snapshot. /health and /system_status read the snapshot only, so load
+balancer polling never touches the databases.
+"""
+import os
+import threading
+import time
+from datetime import datetime
+from typing import Dict
+import device_registry
+import scheduler_lease
+from context import firebase_config_store
+from database import device_connection
+from lazy_firebase import is_firebase_initialized
+from routes import matched
+from routes.notification import notification_stats
+
+HEALTH_REFRESH_SECONDS = float(os.environ.get("HEALTH_REFRESH_SECONDS", "5"))
+# A snapshot this old means the monitor itself has died
+HEALTH_STALE_SECONDS = HEALTH_REFRESH_SECONDS * 3
+# More notifications than this blocked on Pushbullet at once counts as a backlog
+NOTIFICATION_BACKLOG = 5
+
+_snapshot: Dict = {}
+_lock = threading.Lock()
+_wake = threading.Event()
+_thread = None
+
+
+def _mask(email):
+    return email[:3] + "***@" + email.split('@')[1] if email and "@" in email else None
+
+
+def _check_database(device_id) -> Dict:
+    started = time.perf_counter()
+    result = {"ok": True, "registry": True, "device_storage": None, "error": None,
+              "registered": False, "owner": None}
+    try:
+        if device_id:
+            info = device_registry.get_device_info(device_id)
+            result["registered"] = info is not None
+            result["owner"] = _mask(info["owner_email"]) if info else None
+        else:
+            with device_registry.get_db_connection() as conn:
+                conn.execute("SELECT 1").fetchone()
+    except Exception as e:
+        result.update(ok=False, registry=False, error=f"registry: {e}")
+
+    if device_id:
+        try:
+            with device_connection(device_id) as conn:
+                conn.execute("SELECT 1").fetchone()
+            result["device_storage"] = True
+        except Exception as e:
+            result.update(ok=False, device_storage=False, error=f"device storage: {e}")
+
+    result["latency_ms"] = round((time.perf_counter() - started) * 1000, 2)
+    return result
+
+
+def refresh() -> Dict:
+    """Probe every component once and publish a new snapshot"""
+    device_id = firebase_config_store.get("device_id")
+    heartbeat_age = time.time() - matched.last_tick if matched.last_tick else None
+    notifications = notification_stats()
+    lease = scheduler_lease.status()
+
+    snapshot = {
+        "checked_at": datetime.now().isoformat(),
+        "checked_monotonic": time.monotonic(),
+        "device_id": device_id,
+        "database": _check_database(device_id),
+        "firebase": {"ok": is_firebase_initialized()},
+        "scheduler": {
+            # This worker's loop is running and some worker holds the lease
+            "ok": matched.scheduler_alive() and lease["held"],
+            "leader": lease["leader"],
+            "lease_holder": lease["holder"],
+            "lease_expires_in": lease["expires_in"],
+            "heartbeat_age_seconds": round(heartbeat_age, 1) if heartbeat_age is not None else None,
+            "firebase_ready": matched.firebase_ready,
+        },
+        "notifications": {**notifications, "ok": notifications["in_flight"] <= NOTIFICATION_BACKLOG},
+    }
+    with _lock:
+        _snapshot.clear()
+        _snapshot.update(snapshot)
+    return snapshot
+
+
+def get_snapshot() -> Dict:
+    """Latest snapshot plus its age; never does I/O"""
+    with _lock:
+        snapshot = dict(_snapshot)
+    if not snapshot:
+        return {"age_seconds": None, "stale": True}
+    age = time.monotonic() - snapshot["checked_monotonic"]
+    snapshot["age_seconds"] = round(age, 1)
+    snapshot["stale"] = age > HEALTH_STALE_SECONDS
+    return snapshot
+
+
+def request_refresh():
+    """Refresh soon after a state change (registration, disconnect, reset)"""
+    _wake.set()
+
+
+def _run():
+    while True:
+        _wake.wait(HEALTH_REFRESH_SECONDS)
+        _wake.clear()
+        try:
+            refresh()
+        except Exception as e:
+            print(f"⚠️ Health monitor refresh failed: {e}")
+
+
+def start():
+    global _thread
+    if _thread is None:
+        refresh()
+        _thread = threading.Thread(target=_run, daemon=True, name="health-monitor")
+        _thread.start()
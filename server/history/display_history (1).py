@@ -1,17 +1,18 @@
-from history.history import get_history_db_connection
-from database import get_db_connection_for_device
+from history.history import history_connection
+from database import device_connection
 
 def get_schedule_history_matches(device_id: str):
-    sched_conn = get_db_connection_for_device(device_id, "", "")
-    hist_conn = get_history_db_connection(device_id)
-
-    schedules = sched_conn.execute(
-        "SELECT id, container_id, name, time, days, quantity FROM schedules"
-    ).fetchall()
-
-    history = hist_conn.execute(
-        "SELECT container_id, datetime, scheduled_time, scheduled_days FROM history ORDER BY datetime ASC"
-    ).fetchall()
+    with device_connection(device_id) as sched_conn:
+        schedules = sched_conn.execute(
+            "SELECT id, container_id, name, time, days, quantity FROM schedules WHERE device_id = ?",
+            (device_id,)
+        ).fetchall()
+
+    with history_connection(device_id) as hist_conn:
+        history = hist_conn.execute(
+            "SELECT container_id, datetime, scheduled_time, scheduled_days FROM history WHERE device_id = ? ORDER BY datetime ASC",
+            (device_id,)
+        ).fetchall()
 
     results = []
     used_history = set()
@@ -43,6 +44,4 @@ def get_schedule_history_matches(device_id: str):
                 used_history.add(datetime_str)
                 break
 
-    sched_conn.close()
-    hist_conn.close()
     return results
@@ -1,32 +1,315 @@
 import sqlite3
 import os
+import threading
+from datetime import datetime, timedelta, timezone
+from typing import Optional, Tuple
+import storage
+from database import connection_cache, add_device_id_column, open_tuned_connection
+import db_writer
+import device_settings
 
-BASE_DIR = "/tmp/devices"
-os.makedirs(BASE_DIR, exist_ok=True)
+BASE_DIR = storage.BASE_DIR
 
-def get_history_db_path(device_id: str) -> str:
-    safe_device_id = device_id.replace(":", "_").replace("/", "_")
-    return os.path.join(BASE_DIR, f"{safe_device_id}_history.db")
+HISTORY_TABLE = """
+    CREATE TABLE IF NOT EXISTS history (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        device_id TEXT,
+        medicine_name TEXT,
+        container_id INTEGER,
+        quantity INTEGER,
+        scheduled_time TEXT,
+        scheduled_days TEXT,
+        datetime_taken TEXT,
+        time_taken TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        taken_at INTEGER,
+        scheduled_at INTEGER
+    )
+"""
 
-def get_history_db_connection(device_id: str):
-    db_path = get_history_db_path(device_id)
-    return sqlite3.connect(db_path)
+# The ESP32 sends local wall-clock text; these are parsed once at ingest
+# into UTC epoch seconds (taken_at, scheduled_at) in the device's timezone.
+# The firmware sends datetime_taken as a bare time ("08:05 AM"); it is put
+# on the local day the server received it (created_at)
+TAKEN_FORMATS = ("%Y-%m-%d %I:%M %p", "%Y-%m-%d %I:%M:%S %p", "%d/%m/%Y %H:%M:%S", "%d/%m/%Y %H:%M")
+SCHEDULED_FORMATS = ("%I:%M %p", "%H:%M", "%I:%M:%S %p", "%H:%M:%S")
+CREATED_AT_FORMAT = "%Y-%m-%d %H:%M:%S"
+EPOCH_BACKFILL_BATCH = 1000
+# Bumped when history_epochs learns to parse rows it left NULL before, so
+# existing files are backfilled again (stored in PRAGMA user_version)
+HISTORY_EPOCHS_VERSION = 1
+_backfill_lock = threading.Lock()
+_backfills_started = set()
 
-def init_history_db(device_id: str):
-    conn = get_history_db_connection(device_id)
+# Daily per-container totals of history rows removed by retention
+HISTORY_DAILY_TABLE = """
+    CREATE TABLE IF NOT EXISTS history_daily (
+        device_id TEXT NOT NULL,
+        day TEXT NOT NULL,
+        container_id INTEGER NOT NULL,
+        doses INTEGER NOT NULL,
+        quantity INTEGER NOT NULL,
+        PRIMARY KEY (device_id, day, container_id)
+    ) WITHOUT ROWID
+"""
+
+# Distinct medicine names per device, filled by a trigger on history. The
+# search resolves a typed prefix against these few names (through the
+# FTS5 index below) and then reads history by (device_id, medicine_name)
+HISTORY_MEDICINES_TABLE = """
+    CREATE TABLE IF NOT EXISTS history_medicines (
+        id INTEGER PRIMARY KEY,
+        device_id TEXT NOT NULL,
+        medicine_name TEXT NOT NULL,
+        UNIQUE (device_id, medicine_name)
+    )
+"""
+
+HISTORY_MEDICINES_FTS = """
+    CREATE VIRTUAL TABLE IF NOT EXISTS history_medicines_fts USING fts5(
+        medicine_name, content='history_medicines', content_rowid='id', prefix='2 3'
+    )
+"""
+
+def _fts5_available() -> bool:
+    conn = sqlite3.connect(":memory:")
+    try:
+        conn.execute("CREATE VIRTUAL TABLE probe USING fts5(text)")
+        return True
+    except sqlite3.OperationalError:
+        return False
+    finally:
+        conn.close()
+
+# Without FTS5 in the linked SQLite, search falls back to LIKE on the names
+FTS5_AVAILABLE = _fts5_available()
+
+def _parse(text: Optional[str], formats) -> Optional[datetime]:
+    text = (text or "").strip()
+    if not text:
+        return None
+    try:
+        return datetime.fromisoformat(text)
+    except ValueError:
+        pass
+    for fmt in formats:
+        try:
+            return datetime.strptime(text, fmt)
+        except ValueError:
+            continue
+    return None
+
+def local_epoch(value: datetime, tz) -> int:
+    """Epoch seconds of a wall-clock time in tz (aware values keep their own zone)"""
+    if value.tzinfo is None:
+        value = tz.localize(value)
+    return int(value.timestamp())
+
+def taken_wall_clock(datetime_taken: Optional[str], received_at: Optional[datetime], tz) -> Optional[datetime]:
+    """
+    Local wall-clock datetime of a taken time. A time without a date goes
+    on the device-local day of received_at (naive UTC, default now), moved
+    a day either way when that puts it more than 12 hours from receipt
+    (a dose logged just before midnight and received just after).
+    """
+    taken = _parse(datetime_taken, TAKEN_FORMATS)
+    if taken is not None:
+        return taken
+    clock = _parse(datetime_taken, SCHEDULED_FORMATS)
+    if clock is None:
+        return None
+    received = (received_at or datetime.utcnow()).replace(tzinfo=timezone.utc).astimezone(tz).replace(tzinfo=None)
+    taken = datetime.combine(received.date(), clock.time())
+    if taken - received > timedelta(hours=12):
+        taken -= timedelta(days=1)
+    elif received - taken > timedelta(hours=12):
+        taken += timedelta(days=1)
+    return taken
+
+def history_epochs(datetime_taken: Optional[str], scheduled_time: Optional[str], tz,
+                   received_at: Optional[datetime] = None) -> Tuple[Optional[int], Optional[int]]:
+    """
+    (taken_at, scheduled_at) for a history row; None where the text does
+    not parse. received_at (naive UTC, the row's created_at) dates a bare
+    time. The schedule falls on the taken date, or the day before when a
+    late dose was taken after midnight.
+    """
+    taken = taken_wall_clock(datetime_taken, received_at, tz)
+    if taken is None:
+        return None, None
+    taken_at = local_epoch(taken, tz)
+
+    slot = _parse(scheduled_time, SCHEDULED_FORMATS)
+    if slot is None:
+        return taken_at, None
+    scheduled = taken.replace(hour=slot.hour, minute=slot.minute, second=slot.second, microsecond=0)
+    if scheduled - taken > timedelta(hours=12):
+        scheduled -= timedelta(days=1)
+    return taken_at, local_epoch(scheduled, tz)
+
+def backfill_epochs_batch(conn, after_id: int = 0, zones: Optional[dict] = None) -> Tuple[Optional[int], int]:
+    """
+    Fill taken_at/scheduled_at for up to EPOCH_BACKFILL_BATCH rows after
+    after_id; returns (last id looked at, or None when done, rows filled)
+    """
+    zones = {} if zones is None else zones
+    rows = conn.execute("""
+        SELECT id, device_id, datetime_taken, scheduled_time, created_at FROM history
+        WHERE id > ? AND taken_at IS NULL AND datetime_taken IS NOT NULL
+        ORDER BY id LIMIT ?
+    """, (after_id, EPOCH_BACKFILL_BATCH)).fetchall()
+    if not rows:
+        return None, 0
+    updates = []
+    for history_id, device_id, datetime_taken, scheduled_time, created_at in rows:
+        if device_id not in zones:
+            zones[device_id] = device_settings.get_timezone(device_id)
+        try:
+            received_at = datetime.strptime(created_at, CREATED_AT_FORMAT) if created_at else None
+        except (TypeError, ValueError):
+            received_at = None
+        if received_at is None and _parse(datetime_taken, TAKEN_FORMATS) is None:
+            continue  # a bare time with no receipt date cannot be placed
+        taken_at, scheduled_at = history_epochs(datetime_taken, scheduled_time, zones[device_id], received_at)
+        if taken_at is not None:
+            updates.append((taken_at, scheduled_at, history_id))
+    conn.executemany("UPDATE history SET taken_at = ?, scheduled_at = ? WHERE id = ?", updates)
+    return rows[-1][0], len(updates)
+
+def backfill_epochs(conn, after_id: int = 0) -> int:
+    """Fill every row stored without taken_at on conn, in the caller's transaction; returns rows filled"""
+    filled, zones = 0, {}
+    while True:
+        after_id, batch_filled = backfill_epochs_batch(conn, after_id, zones)
+        if after_id is None:
+            return filled
+        filled += batch_filled
+
+def _add_epoch_columns(conn) -> bool:
+    """Add taken_at/scheduled_at to tables created before them; True if added"""
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(history)")}
+    if "taken_at" in columns:
+        return False
+    conn.execute("ALTER TABLE history ADD COLUMN taken_at INTEGER")
+    conn.execute("ALTER TABLE history ADD COLUMN scheduled_at INTEGER")
+    return True
+
+def ensure_medicine_index(conn):
+    """Create the medicine name list and its FTS5 index, backfilling existing history"""
+    def missing(table: str) -> bool:
+        return conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)
+        ).fetchone() is None
+
+    backfill = missing("history_medicines")
+    reindex = FTS5_AVAILABLE and not backfill and missing("history_medicines_fts")
+    conn.execute(HISTORY_MEDICINES_TABLE)
     conn.execute("""
-        CREATE TABLE IF NOT EXISTS history (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            medicine_name TEXT,
-            container_id INTEGER,
-            quantity INTEGER,
-            scheduled_time TEXT,
-            scheduled_days TEXT,
-            datetime_taken TEXT,
-            time_taken TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
+        CREATE TRIGGER IF NOT EXISTS history_medicines_collect AFTER INSERT ON history
+        WHEN new.medicine_name IS NOT NULL BEGIN
+            INSERT OR IGNORE INTO history_medicines (device_id, medicine_name)
+            VALUES (new.device_id, new.medicine_name);
+        END
     """)
-    conn.commit()
-    conn.close()
+    if FTS5_AVAILABLE:
+        conn.execute(HISTORY_MEDICINES_FTS)
+        conn.execute("""
+            CREATE TRIGGER IF NOT EXISTS history_medicines_fts_insert AFTER INSERT ON history_medicines BEGIN
+                INSERT INTO history_medicines_fts (rowid, medicine_name) VALUES (new.id, new.medicine_name);
+            END
+        """)
+        conn.execute("""
+            CREATE TRIGGER IF NOT EXISTS history_medicines_fts_delete AFTER DELETE ON history_medicines BEGIN
+                INSERT INTO history_medicines_fts (history_medicines_fts, rowid, medicine_name)
+                VALUES ('delete', old.id, old.medicine_name);
+            END
+        """)
+    if backfill:
+        conn.execute("""
+            INSERT OR IGNORE INTO history_medicines (device_id, medicine_name)
+            SELECT DISTINCT device_id, medicine_name FROM history WHERE medicine_name IS NOT NULL
+        """)
+    elif reindex:
+        # Names collected while FTS5 was unavailable
+        conn.execute("INSERT INTO history_medicines_fts (history_medicines_fts) VALUES ('rebuild')")
+
+def ensure_history_schema(conn, device_id: Optional[str] = None):
+    """Create/upgrade the history table (per-device file or shard)"""
+    conn.execute(HISTORY_TABLE)
+    add_device_id_column(conn, "history", device_id)
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_history_device_created
+        ON history(device_id, created_at)
+    """)
+    _add_epoch_columns(conn)
+    # Search and stats range-scan taken_at within each filter; the container
+    # index also serves the per-container counts in /history/stats
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_history_device_taken_at
+        ON history(device_id, taken_at)
+    """)
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_history_device_container_taken_at
+        ON history(device_id, container_id, taken_at)
+    """)
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_history_device_medicine_taken_at
+        ON history(device_id, medicine_name, taken_at)
+    """)
+    for superseded in ("idx_history_device_container", "idx_history_device_taken",
+                       "idx_history_device_container_taken", "idx_history_device_medicine_taken"):
+        conn.execute(f"DROP INDEX IF EXISTS {superseded}")
+    ensure_medicine_index(conn)
+    conn.execute(HISTORY_DAILY_TABLE)
+    # True while rows written by an older history_epochs may still need epochs
+    return conn.execute("PRAGMA user_version").fetchone()[0] < HISTORY_EPOCHS_VERSION
+
+def get_history_db_path(device_id: str) -> str:
+    """Path of the per-device history file (per_device layout)"""
+    return os.path.join(BASE_DIR, f"{storage.safe_device_id(device_id)}_history.db")
+
+def history_connection(device_id: str):
+    """Borrow the cached (read-only) history connection for a device (backend-routed)"""
+    return connection_cache.connection(storage.history_path(device_id))
+
+def history_db_writer(device_id: str) -> db_writer.DatabaseWriter:
+    """The writer of a device's history file (backend-routed)"""
+    return db_writer.writer_for(storage.history_path(device_id), open_tuned_connection)
+
+def init_history_db(device_id: str):
+    if history_db_writer(device_id).write(ensure_history_schema, device_id):
+        start_epoch_backfill(storage.history_path(device_id))
+
+def start_epoch_backfill(path: str):
+    """Backfill a history file's epochs in the background (once per file per process)"""
+    with _backfill_lock:
+        if path in _backfills_started:
+            return
+        _backfills_started.add(path)
+    threading.Thread(target=backfill_file_epochs, args=(path,), daemon=True,
+                     name=f"epoch-backfill-{os.path.basename(path)}").start()
+
+def backfill_file_epochs(path: str) -> int:
+    """
+    Fill missing epochs one EPOCH_BACKFILL_BATCH at a time, each batch its
+    own writer operation and commit, so inserts to the file interleave
+    with the backfill instead of waiting for the whole table
+    """
+    writer = db_writer.writer_for(path, open_tuned_connection)
+    after_id, filled, zones = 0, 0, {}
+    try:
+        while True:
+            after_id, batch_filled = writer.write(backfill_epochs_batch, after_id, zones)
+            if after_id is None:
+                break
+            filled += batch_filled
+        writer.write(lambda conn: conn.execute(f"PRAGMA user_version = {HISTORY_EPOCHS_VERSION}"))
+    except Exception as e:
+        print(f"⚠️ Epoch backfill of {os.path.basename(path)} stopped at id {after_id}: {e}")
+        with _backfill_lock:
+            _backfills_started.discard(path)
+        return filled
+    if filled:
+        print(f"🕒 Backfilled taken_at/scheduled_at for {filled} history rows in {os.path.basename(path)}")
+    return filled
 
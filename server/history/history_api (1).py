@@ -1,7 +1,17 @@
 from fastapi import APIRouter, HTTPException
+from fastapi.responses import StreamingResponse
 from context import firebase_config_store
-from history.history import get_history_db_connection
+from repositories import history as history_repo
+from datetime import datetime, timedelta
+from typing import Optional
+from db_executor import HISTORY_EXECUTOR
+import asyncio
+import csv
+import io
+import json
 import logging
+import re
+import zlib
 
 logger = logging.getLogger(__name__)
 router = APIRouter()
@@ -17,34 +27,15 @@ def get_device_id_or_fail():
     return device_id
 
 @router.get("/history")
-def get_history(email: str):
+async def get_history(email: str):
     """
     Fetch all history entries - email required as query parameter
     Email is validated by middleware
     """
     device_id = get_device_id_or_fail()
     
-    conn = get_history_db_connection(device_id)
     try:
-        history = conn.execute("""
-            SELECT id, medicine_name, container_id, quantity, 
-                   scheduled_time, scheduled_days, datetime_taken, time_taken
-            FROM history 
-            ORDER BY created_at DESC
-        """).fetchall()
-        
-        results = []
-        for row in history:
-            results.append({
-                "id": row[0],
-                "medicine_name": row[1],
-                "container_id": row[2],
-                "quantity": row[3],
-                "scheduled_time": row[4],
-                "scheduled_days": row[5],
-                "datetime_taken": row[6],
-                "time_taken": row[7]
-            })
+        results = await history_repo.alist_history(device_id)
         
         logger.info(f"✅ Fetched {len(results)} history entries for device {device_id}")
         return results
@@ -55,22 +46,17 @@ def get_history(email: str):
             status_code=500, 
             detail=f"❌ Failed to fetch history: {e}"
         )
-    finally:
-        conn.close()
 
 @router.delete("/delete_all_history")
-def delete_all_history(email: str):
+async def delete_all_history(email: str):
     """
     Delete all history entries - email required as query parameter
     Email is validated by middleware
     """
     device_id = get_device_id_or_fail()
     
-    conn = get_history_db_connection(device_id)
     try:
-        cursor = conn.execute("DELETE FROM history")
-        deleted_count = cursor.rowcount
-        conn.commit()
+        deleted_count = await history_repo.adelete_all_history(device_id)
         
         logger.info(f"✅ Deleted {deleted_count} history entries for device {device_id}")
         return {
@@ -84,32 +70,24 @@ def delete_all_history(email: str):
             status_code=500, 
             detail=f"❌ Failed to delete all history: {e}"
         )
-    finally:
-        conn.close()
 
 @router.delete("/delete_history/{history_id}")
-def delete_history(history_id: int, email: str):
+async def delete_history(history_id: int, email: str):
     """
     Delete specific history entry - email required as query parameter
     Email is validated by middleware
     """
     device_id = get_device_id_or_fail()
     
-    conn = get_history_db_connection(device_id)
     try:
-        cursor = conn.execute(
-            "DELETE FROM history WHERE id = ?", 
-            (history_id,)
-        )
+        deleted = await history_repo.adelete_history_entry(device_id, history_id)
         
-        if cursor.rowcount == 0:
+        if not deleted:
             raise HTTPException(
                 status_code=404, 
                 detail="❌ History entry not found"
             )
         
-        conn.commit()
-        
         logger.info(f"✅ Deleted history entry {history_id} for device {device_id}")
         return {
             "message": f"✅ History entry {history_id} deleted"
@@ -123,42 +101,21 @@ def delete_history(history_id: int, email: str):
             status_code=500, 
             detail=f"❌ Failed to delete history: {e}"
         )
-    finally:
-        conn.close()
 
 @router.get("/history/stats")
-def get_history_stats(email: str):
+async def get_history_stats(email: str):
     """
     Get history statistics - email required as query parameter
     Email is validated by middleware
     """
     device_id = get_device_id_or_fail()
     
-    conn = get_history_db_connection(device_id)
     try:
-        # Total entries
-        total = conn.execute("SELECT COUNT(*) FROM history").fetchone()[0]
-        
-        # Entries by container
-        by_container = conn.execute("""
-            SELECT container_id, COUNT(*) as count
-            FROM history
-            GROUP BY container_id
-        """).fetchall()
-        
-        # Recent entries (last 7 days)
-        recent = conn.execute("""
-            SELECT COUNT(*) FROM history
-            WHERE datetime(datetime_taken) >= datetime('now', '-7 days')
-        """).fetchone()[0]
-        
-        container_stats = {row[0]: row[1] for row in by_container}
+        stats = await history_repo.aget_history_stats(device_id)
         
         logger.info(f"✅ Fetched history stats for device {device_id}")
         return {
-            "total_entries": total,
-            "by_container": container_stats,
-            "recent_7_days": recent,
+            **stats,
             "device_id": device_id
         }
     
@@ -168,5 +125,147 @@ def get_history_stats(email: str):
             status_code=500,
             detail=f"❌ Failed to fetch history stats: {e}"
         )
+
+@router.get("/history/search")
+async def search_history(email: str, medicine: Optional[str] = None, container_id: Optional[int] = None,
+                         scheduled_time: Optional[str] = None, start: Optional[str] = None,
+                         end: Optional[str] = None, cursor: Optional[str] = None,
+                         limit: int = history_repo.SEARCH_LIMIT):
+    """
+    Search history, newest dose first - email required as query parameter
+    medicine matches each word as a prefix ("met 500" finds "Metformin 500mg");
+    start/end filter on the taken time in the device's timezone (YYYY-MM-DD
+    or ISO datetime). Pass
+    next_cursor back as cursor to get the following page
+    """
+    device_id = get_device_id_or_fail()
+
+    if medicine is not None and not re.search(r"\w", medicine):
+        raise HTTPException(status_code=400, detail="❌ medicine must contain letters or digits")
+    after = None
+    if cursor:
+        try:
+            after = history_repo.decode_search_cursor(cursor)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="❌ Invalid cursor")
+    taken_from = parse_bound(start, "start")
+    taken_until = parse_bound(end, "end", is_end=True)
+
+    try:
+        page = await history_repo.asearch_history(
+            device_id,
+            medicine=medicine,
+            container_id=container_id,
+            scheduled_time=scheduled_time,
+            start=taken_from,
+            end=taken_until,
+            after=after,
+            limit=max(1, min(limit, history_repo.SEARCH_MAX_LIMIT)),
+        )
+    except Exception as e:
+        logger.error(f"❌ Failed to search history for device {device_id}: {e}")
+        raise HTTPException(
+            status_code=500,
+            detail=f"❌ Failed to search history: {e}"
+        )
+
+    logger.info(f"🔎 History search for device {device_id}: {len(page['results'])} result(s)")
+    return {**page, "device_id": device_id}
+
+EXPORT_MEDIA_TYPES = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+
+def parse_bound(value: Optional[str], name: str, is_end: bool = False) -> Optional[datetime]:
+    """ISO date/datetime query parameter; a date-only end includes that day"""
+    if not value:
+        return None
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"❌ Invalid {name}: {value} (use YYYY-MM-DD)")
+    if is_end and len(value) == 10:
+        parsed += timedelta(days=1)
+    return parsed
+
+def export_chunks(rows, fmt: str, rows_per_chunk: int = history_repo.EXPORT_BATCH_SIZE):
+    """Encode rows as CSV or NDJSON, yielding one bytes chunk per batch of rows"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer) if fmt == "csv" else None
+    if writer:
+        writer.writerow(history_repo.EXPORT_COLUMNS)
+
+    pending = 0
+    for row in rows:
+        if writer:
+            writer.writerow(row)
+        else:
+            buffer.write(json.dumps(dict(zip(history_repo.EXPORT_COLUMNS, row))) + "\n")
+        pending += 1
+        if pending >= rows_per_chunk:
+            yield buffer.getvalue().encode("utf-8")
+            buffer.seek(0)
+            buffer.truncate()
+            pending = 0
+
+    if buffer.tell():
+        yield buffer.getvalue().encode("utf-8")
+
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits 31 = gzip container
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+async def executor_chunks(chunks):
+    """
+    Pull each chunk of a blocking generator on the history executor, so a
+    slow client holds no threadpool thread between chunks
+    """
+    pending = None
+    try:
+        while True:
+            pending = HISTORY_EXECUTOR.submit(next, chunks, None)
+            chunk = await asyncio.wrap_future(pending)
+            if chunk is None:
+                return
+            yield chunk
     finally:
-        conn.close()
\ No newline at end of file
+        # Close the generator (and its connection) once no chunk is being read
+        if pending is not None and not pending.done():
+            pending.add_done_callback(lambda _: chunks.close())
+        else:
+            chunks.close()
+
+@router.get("/history/export")
+async def export_history(email: str, format: str = "csv", start: Optional[str] = None,
+                         end: Optional[str] = None, container_id: Optional[int] = None,
+                         gzip: bool = False):
+    """
+    Stream the full history as CSV or NDJSON - email required as query parameter
+    start/end filter on the taken time like /history/search (YYYY-MM-DD or ISO
+    datetime, device local time unless an offset is given); rows are read in
+    batches from a cursor so memory stays flat for any history size
+    """
+    device_id = get_device_id_or_fail()
+
+    if format not in EXPORT_MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail="❌ format must be csv or ndjson")
+    taken_from = parse_bound(start, "start")
+    taken_until = parse_bound(end, "end", is_end=True)
+
+    rows = history_repo.iter_history(device_id, taken_from, taken_until, container_id)
+    chunks = export_chunks(rows, format)
+    filename = f"history_{device_id.replace(':', '')}.{format}"
+    media_type = EXPORT_MEDIA_TYPES[format]
+    if gzip:
+        chunks = gzip_chunks(chunks)
+        filename += ".gz"
+        media_type = "application/gzip"
+
+    logger.info(f"📤 Exporting history for device {device_id} as {format}{' (gzip)' if gzip else ''}")
+    return StreamingResponse(
+        executor_chunks(chunks),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
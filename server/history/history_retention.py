@@ -0,0 +1,185 @@
+"""
+History Retention
+Background maintenance that rolls history rows older than the retention
+window into device-local daily per-container totals (history_daily),
+deletes them in small batches, and returns freed pages with
+incremental_vacuum. Every run stops at a time budget and continues where
+it left off on the next run.
+"""
+import json
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional
+import storage
+import scheduler_lease
+from database import connection_cache, open_tuned_connection
+import db_writer
+import device_settings
+from history.history import CREATED_AT_FORMAT, HISTORY_DAILY_TABLE
+
+HISTORY_RETENTION_DAYS = int(os.environ.get("HISTORY_RETENTION_DAYS", "365"))
+MAINTENANCE_INTERVAL = float(os.environ.get("HISTORY_MAINTENANCE_INTERVAL", "3600"))
+MAINTENANCE_BUDGET_SECONDS = float(os.environ.get("HISTORY_MAINTENANCE_BUDGET_MS", "500")) / 1000
+ROLLUP_BATCH_SIZE = 1000
+VACUUM_PAGES_PER_STEP = 256
+# Existing files without auto_vacuum are converted with one full VACUUM only if this small
+CONVERT_MAX_BYTES = 64 * 1024 * 1024
+
+_thread = None
+_next_path = 0
+_stats = {"runs": 0, "rolled_up": 0, "vacuumed_pages": 0, "converted_files": 0, "last_run_at": None,
+          "last_run_ms": None, "budget_exhausted": 0}
+
+
+def _has_history(conn) -> bool:
+    """True for files holding history; adds the rollup table to older files"""
+    if not conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'history'"
+    ).fetchone():
+        return False
+    conn.execute(HISTORY_DAILY_TABLE)
+    return True
+
+
+def _local_day(taken_at: Optional[int], created_at: str, tz) -> str:
+    """Device-local day of a row: its taken time, else when it was received"""
+    if taken_at is not None:
+        return datetime.fromtimestamp(taken_at, tz).date().isoformat()
+    try:
+        received = datetime.strptime(created_at, CREATED_AT_FORMAT).replace(tzinfo=timezone.utc)
+    except (TypeError, ValueError):
+        return created_at[:10]
+    return received.astimezone(tz).date().isoformat()
+
+
+def _roll_up_batch(conn, device_id: str, cutoff: str, tz) -> int:
+    rows = conn.execute(
+        "SELECT id, taken_at, created_at, container_id, quantity FROM history "
+        "WHERE device_id = ? AND created_at < ? LIMIT ?",
+        (device_id, cutoff, ROLLUP_BATCH_SIZE)
+    ).fetchall()
+    if not rows:
+        return 0
+    # Grouped here rather than by date(created_at), which is the UTC day
+    totals: Dict[tuple, List[int]] = {}
+    for _, taken_at, created_at, container_id, quantity in rows:
+        total = totals.setdefault((_local_day(taken_at, created_at, tz), container_id), [0, 0])
+        total[0] += 1
+        total[1] += quantity or 0
+    conn.executemany("""
+        INSERT INTO history_daily (device_id, day, container_id, doses, quantity)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(device_id, day, container_id) DO UPDATE SET
+            doses = doses + excluded.doses,
+            quantity = quantity + excluded.quantity
+    """, [(device_id, day, container_id, doses, quantity)
+          for (day, container_id), (doses, quantity) in totals.items()])
+    conn.execute("DELETE FROM history WHERE id IN (SELECT value FROM json_each(?))",
+                 (json.dumps([row[0] for row in rows]),))
+    return len(rows)
+
+
+def compact_file(path: str, cutoff: str, deadline: float) -> int:
+    """Roll up and delete rows older than cutoff, one batch per writer operation"""
+    writer = db_writer.writer_for(path, open_tuned_connection)
+    if not writer.write(_has_history):
+        return 0
+    with connection_cache.connection(path) as conn:
+        device_ids = [row[0] for row in conn.execute("SELECT DISTINCT device_id FROM history")]
+
+    rolled = 0
+    for device_id in device_ids:
+        tz = device_settings.get_timezone(device_id)
+        while time.monotonic() < deadline:
+            batch = writer.write(_roll_up_batch, device_id, cutoff, tz)
+            if not batch:
+                break
+            rolled += batch
+    return rolled
+
+
+def _vacuum(conn, path: str, deadline: float) -> int:
+    mode = conn.execute("PRAGMA auto_vacuum").fetchone()[0]
+    if mode == 0:
+        # Files created before incremental vacuum support: convert once if cheap
+        if os.path.getsize(path) > CONVERT_MAX_BYTES:
+            return 0
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("VACUUM")
+        _stats["converted_files"] += 1
+        return 0
+
+    released = 0
+    while time.monotonic() < deadline:
+        free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        if not free:
+            break
+        step = min(free, VACUUM_PAGES_PER_STEP)
+        # execute() steps the pragma once (one page); executescript runs it to completion
+        conn.executescript(f"PRAGMA incremental_vacuum({step});")
+        released += step
+    return released
+
+
+def vacuum_file(path: str, deadline: float) -> int:
+    """Release free pages in small steps until none are left or time runs out"""
+    # Pragmas and VACUUM cannot run inside the writer's batch transaction
+    return db_writer.writer_for(path, open_tuned_connection).write_exclusive(_vacuum, path, deadline)
+
+
+def run_maintenance(retention_days: int = HISTORY_RETENTION_DAYS,
+                    budget_seconds: float = MAINTENANCE_BUDGET_SECONDS) -> Dict:
+    """One budgeted pass over the storage files, resuming from the last file reached"""
+    global _next_path
+    started = time.monotonic()
+    deadline = started + budget_seconds
+    cutoff = (datetime.utcnow() - timedelta(days=retention_days)).strftime("%Y-%m-%d %H:%M:%S")
+    paths: List[str] = [p for p in storage.backend.database_paths() if os.path.exists(p)]
+
+    rolled = released = 0
+    visited = 0
+    while paths and visited < len(paths) and time.monotonic() < deadline:
+        path = paths[_next_path % len(paths)]
+        try:
+            rolled += compact_file(path, cutoff, deadline)
+            released += vacuum_file(path, deadline)
+        except Exception as e:
+            print(f"⚠️ History maintenance failed for {os.path.basename(path)}: {e}")
+        if time.monotonic() >= deadline:
+            _stats["budget_exhausted"] += 1
+            break  # resume this file next run
+        _next_path += 1
+        visited += 1
+
+    _stats["runs"] += 1
+    _stats["rolled_up"] += rolled
+    _stats["vacuumed_pages"] += released
+    _stats["last_run_at"] = datetime.now().isoformat()
+    _stats["last_run_ms"] = round((time.monotonic() - started) * 1000, 1)
+    if rolled or released:
+        print(f"🧹 History maintenance: rolled up {rolled} rows, released {released} pages")
+    return {"rolled_up": rolled, "vacuumed_pages": released}
+
+
+def _run():
+    while True:
+        time.sleep(MAINTENANCE_INTERVAL)
+        if not scheduler_lease.is_leader():
+            continue  # one worker maintains the shared files
+        try:
+            run_maintenance()
+        except Exception as e:
+            print(f"⚠️ History maintenance run failed: {e}")
+
+
+def start():
+    global _thread
+    if _thread is None and HISTORY_RETENTION_DAYS > 0:
+        _thread = threading.Thread(target=_run, daemon=True, name="history-retention")
+        _thread.start()
+
+
+def stats() -> Dict:
+    return {**_stats, "retention_days": HISTORY_RETENTION_DAYS}
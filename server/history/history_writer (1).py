@@ -1,18 +1,26 @@
-from history.history import get_history_db_connection, init_history_db
+from history.history import history_db_writer, history_epochs, init_history_db
+import device_settings
+
+# Devices whose history schema was already ensured by this process
+_initialized_devices = set()
 
 def save_history_record(device_id: str, medicine_name: str, container_id: int, quantity: int,
                        scheduled_time: str, scheduled_days: str, datetime_taken: str, time_taken: str):
-    init_history_db(device_id)
-    conn = get_history_db_connection(device_id)
+    if device_id not in _initialized_devices:
+        init_history_db(device_id)
+        _initialized_devices.add(device_id)
     try:
-        conn.execute("""
+        taken_at, scheduled_at = history_epochs(datetime_taken, scheduled_time, device_settings.get_timezone(device_id))
+        # Concurrent inserts for the same file share one commit on its writer
+        history_db_writer(device_id).write(lambda conn: conn.execute("""
             INSERT INTO history 
-            (medicine_name, container_id, quantity, scheduled_time, scheduled_days, datetime_taken, time_taken) 
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        """, (medicine_name, container_id, quantity, scheduled_time, scheduled_days, datetime_taken, time_taken))
-        conn.commit()
+            (device_id, medicine_name, container_id, quantity, scheduled_time, scheduled_days, datetime_taken, time_taken,
+             taken_at, scheduled_at) 
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (device_id, medicine_name, container_id, quantity, scheduled_time, scheduled_days, datetime_taken, time_taken,
+              taken_at, scheduled_at)))
         print(f"✅ History saved: {medicine_name} from container {container_id} taken at {time_taken}")
     except Exception as e:
+        # Callers must know: a lost dose record must not be reported as taken
         print(f"❌ Failed to save history: {e}")
-    finally:
-        conn.close()
\ No newline at end of file
+        raise
\ No newline at end of file
@@ -1,8 +1,11 @@
 from fastapi import APIRouter, HTTPException
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel
-from history.history_writer import save_history_record
+from repositories import history as history_repo
 from context import firebase_config_store
 from routes.notification import send_taken_notification
+import event_stream
+import inventory
 
 router = APIRouter()
 
@@ -16,7 +19,7 @@ class HistoryRecord(BaseModel):
     time_taken: str
 
 @router.post("/push_history", summary="Receive complete history data from ESP32")
-def push_history(record: HistoryRecord):
+async def push_history(record: HistoryRecord):
     device_id = firebase_config_store.get("device_id")
     if not device_id:
         print("❌ No device_id found in firebase_config_store.")
@@ -30,20 +33,37 @@ def push_history(record: HistoryRecord):
     print(f"   Taken: {record.time_taken} ({record.datetime_taken})")
 
     try:
-        send_taken_notification(record.container_id, record.medicine_name, record.time_taken)
+        await run_in_threadpool(
+            send_taken_notification, record.container_id, record.medicine_name, record.time_taken
+        )
     except Exception as e:
         print(f"⚠️ Failed to send notification: {e}")
 
-    save_history_record(
-        device_id=device_id,
-        medicine_name=record.medicine_name,
-        container_id=record.container_id,
-        quantity=record.quantity,
-        scheduled_time=record.scheduled_time,
-        scheduled_days=record.scheduled_days,
-        datetime_taken=record.datetime_taken,
-        time_taken=record.time_taken
-    )
+    try:
+        await history_repo.asave_history_record(
+            device_id=device_id,
+            medicine_name=record.medicine_name,
+            container_id=record.container_id,
+            quantity=record.quantity,
+            scheduled_time=record.scheduled_time,
+            scheduled_days=record.scheduled_days,
+            datetime_taken=record.datetime_taken,
+            time_taken=record.time_taken
+        )
+    except Exception as e:
+        await run_in_threadpool(event_stream.publish, device_id, event_stream.ERROR, {
+            "container_id": record.container_id,
+            "message": f"Failed to save history: {e}",
+        })
+        # Not taken as far as the server knows: no MEDICINE_TAKEN event, no stock change
+        raise HTTPException(status_code=500, detail=f"❌ Failed to save history: {e}")
+
+    await run_in_threadpool(event_stream.publish, device_id, event_stream.MEDICINE_TAKEN, record.model_dump())
+
+    try:
+        await inventory.aapply_taken(device_id, record.container_id, record.quantity)
+    except Exception as e:
+        print(f"⚠️ Failed to update inventory: {e}")
 
     return {
         "status": "✅ History saved successfully",
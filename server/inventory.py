@@ -0,0 +1,140 @@
+"""
+Pill Inventory
+Applies dispenses and confirmations to the per-container counters and
+forecasts when each container runs out. Forecasts walk the weekly
+schedule cycle (at most two weeks of doses), never the history table.
+"""
+import datetime
+import time
+from typing import Dict, List, Optional
+import pytz
+from starlette.concurrency import run_in_threadpool
+import device_settings
+import event_stream
+import schedule_plan
+from db_executor import SCHEDULES_EXECUTOR
+from repositories import inventory as inventory_repo
+from repositories import schedules as schedule_repo
+from routes.notification import send_low_stock_notification
+
+MINUTES_PER_WEEK = 7 * 24 * 60
+
+
+def weekly_doses(rows: List) -> Dict[int, List]:
+    """Schedule rows -> {container_id: sorted [(minute of week, quantity)]}"""
+    doses: Dict[int, List] = {}
+    for parsed in filter(None, (schedule_plan.parse_schedule_row(row) for row in rows)):
+        _, _, hour, minute, _, _, weekdays, container_id, qty = parsed
+        if qty <= 0:
+            continue
+        for weekday in weekdays:
+            doses.setdefault(container_id, []).append((weekday * 1440 + hour * 60 + minute, qty))
+    for slots in doses.values():
+        slots.sort()
+    return doses
+
+
+def forecast_container(pills: int, slots: List, tz_name: str, now: Optional[float] = None) -> Dict:
+    """
+    When a container can no longer fill a scheduled dose. slots are the
+    container's (minute of week, quantity) pairs in the device's local time.
+    """
+    now = time.time() if now is None else now
+    weekly = sum(qty for _, qty in slots)
+    if not weekly:
+        return {"daily_average": 0.0, "doses_left": None, "runs_out_at": None, "days_until_empty": None}
+
+    tz = pytz.timezone(tz_name)
+    local_now = datetime.datetime.fromtimestamp(now, tz)
+    now_minute = local_now.weekday() * 1440 + local_now.hour * 60 + local_now.minute
+    # One cycle starting at the next dose after now
+    cycle = [(m, q) for m, q in slots if m > now_minute] + \
+            [(m + MINUTES_PER_WEEK, q) for m, q in slots if m <= now_minute]
+
+    # Skip whole weeks arithmetically, then walk what is left (under two cycles)
+    weeks = max(pills // weekly - 1, 0)
+    remaining = pills - weeks * weekly
+    doses_left = weeks * len(cycle)
+    empty_minute = None
+    while empty_minute is None:
+        for minute, qty in cycle:
+            if remaining < qty:
+                empty_minute = weeks * MINUTES_PER_WEEK + minute
+                break
+            remaining -= qty
+            doses_left += 1
+        else:
+            weeks += 1
+
+    week_start = datetime.datetime.combine(
+        local_now.date() - datetime.timedelta(days=local_now.weekday()), datetime.time()
+    )
+    runs_out_at = tz.localize(week_start + datetime.timedelta(minutes=empty_minute))
+    return {
+        "daily_average": round(weekly / 7, 2),
+        "doses_left": doses_left,
+        "runs_out_at": runs_out_at.isoformat(),
+        "days_until_empty": round((runs_out_at.timestamp() - now) / 86400, 1),
+    }
+
+
+def forecast_device(device_id: str, now: Optional[float] = None) -> List[Dict]:
+    """Counters plus depletion forecast for every tracked container (blocking)"""
+    tz_name = device_settings.get_timezone_name(device_id)
+    doses = weekly_doses(schedule_repo.list_dispatch_rows(device_id))
+    return [
+        {**item, **forecast_container(item["pills"], doses.get(item["container_id"], []), tz_name, now)}
+        for item in inventory_repo.list_inventory(device_id)
+    ]
+
+
+def _low_stock_event(item: Dict, forecasts: List[Dict]) -> Dict:
+    forecast = next((f for f in forecasts if f["container_id"] == item["container_id"]), {})
+    print(f"📉 Container {item['container_id']} low on stock: {item['pills']} pill(s) left")
+    return {
+        "container_id": item["container_id"],
+        "pills": item["pills"],
+        "days_until_empty": forecast.get("days_until_empty"),
+    }
+
+
+def _after_update(device_id: str, item: Optional[Dict]):
+    """Publish the new count and raise the low-stock alert once per refill"""
+    if item is None:
+        return  # container not tracked
+    alert = item.pop("low_stock_alert", False)
+    event_stream.publish(device_id, event_stream.INVENTORY_CHANGED, item)
+    if not alert:
+        return
+
+    low_stock = _low_stock_event(item, SCHEDULES_EXECUTOR.call(forecast_device, device_id))
+    event_stream.publish(device_id, event_stream.LOW_STOCK, low_stock)
+    send_low_stock_notification(low_stock["container_id"], low_stock["pills"], low_stock["days_until_empty"])
+
+
+def apply_dispensed(device_id: str, container_id: int, quantity: int):
+    """A dispense command reached the device (called from the dispatch lane)"""
+    _after_update(device_id, SCHEDULES_EXECUTOR.call(
+        inventory_repo.record_dispensed, device_id, container_id, quantity
+    ))
+
+
+async def aapply_taken(device_id: str, container_id: int, quantity: int):
+    """
+    The device reported a dose through /push_history. The counter update
+    and forecast run on the schedules executor; only the event publishes
+    and the notification use the threadpool.
+    """
+    item = await inventory_repo.arecord_taken(device_id, container_id, quantity)
+    if item is None:
+        return  # container not tracked
+    alert = item.pop("low_stock_alert", False)
+    await run_in_threadpool(event_stream.publish, device_id, event_stream.INVENTORY_CHANGED, item)
+    if not alert:
+        return
+
+    low_stock = _low_stock_event(item, await SCHEDULES_EXECUTOR.run(forecast_device, device_id))
+    await run_in_threadpool(event_stream.publish, device_id, event_stream.LOW_STOCK, low_stock)
+    await run_in_threadpool(
+        send_low_stock_notification, low_stock["container_id"], low_stock["pills"], low_stock["days_until_empty"]
+    )
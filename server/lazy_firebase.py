@@ -0,0 +1,31 @@
+"""
+Lazy Firebase Access
+Thin wrappers that import the firebase module (and firebase_admin) only
+when Firebase is actually used, keeping it off the cold-start path
+"""
+import sys
+
+
+def is_firebase_initialized() -> bool:
+    # Nothing can be initialized before the module was ever imported
+    if "firebase" not in sys.modules:
+        return False
+    from firebase import is_firebase_initialized as _is_initialized
+    return _is_initialized()
+
+
+def initialize_firebase(firebase_url: str):
+    from firebase import initialize_firebase as _initialize
+    return _initialize(firebase_url=firebase_url)
+
+
+def reset_firebase():
+    if "firebase" not in sys.modules:
+        return
+    from firebase import reset_firebase as _reset
+    return _reset()
+
+
+def get_command_ref():
+    from firebase import get_command_ref as _get_command_ref
+    return _get_command_ref()
@@ -0,0 +1,97 @@
+"""
+Registry Migration
+Splits the single device_registry.db into REGISTRY_SHARDS shard files by
+device_id and builds the owner index. Registrations and connection
+history keep their IDs; the source file is left untouched.
+
+Run this while the server is stopped, then start it with the same
+REGISTRY_SHARDS.
+
+Usage: python migrate_registry.py [--shards N] [--source PATH] [--dry-run]
+"""
+import argparse
+import os
+import sqlite3
+from typing import Dict
+import device_registry
+
+REGISTRATION_COLUMNS = ("id", "device_id", "owner_email", "registered_at", "last_connected",
+                        "firebase_url", "is_active")
+HISTORY_COLUMNS = ("id", "device_id", "email", "action", "timestamp", "success", "notes")
+CHUNK_ROWS = 5000
+
+
+def _count(conn: sqlite3.Connection, table: str) -> int:
+    return conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+
+
+def _copy_table(src: sqlite3.Connection, table: str, columns) -> int:
+    """Stream a table into the shards, one writer operation per shard per chunk"""
+    placeholders = ", ".join("?" for _ in columns)
+    insert = f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({placeholders})"
+    device_column = columns.index("device_id")
+    cursor = src.execute(f"SELECT {', '.join(columns)} FROM {table} ORDER BY id")
+    copied = 0
+    while True:
+        rows = cursor.fetchmany(CHUNK_ROWS)
+        if not rows:
+            return copied
+        groups = {}
+        for row in rows:
+            groups.setdefault(device_registry.shard_for(row[device_column]), []).append(tuple(row))
+        futures = [
+            device_registry.shard_writer(shard).submit(lambda conn, rows=shard_rows: conn.executemany(insert, rows))
+            for shard, shard_rows in groups.items()
+        ]
+        for future in futures:
+            future.result()
+        copied += len(rows)
+
+
+def migrate_to_shards(source: str = device_registry.DB_PATH, shards: int = device_registry.REGISTRY_SHARDS,
+                      dry_run: bool = False) -> Dict:
+    """Copy the single registry file into shard files. Returns row counts."""
+    if shards < 2:
+        raise ValueError("--shards must be at least 2; a single shard is the original file")
+    if not os.path.exists(source):
+        raise FileNotFoundError(source)
+
+    src = sqlite3.connect(f"file:{source}?mode=ro", uri=True)
+    try:
+        summary = {"shards": shards, "registrations": _count(src, "device_registrations"),
+                   "connection_history": _count(src, "connection_history")}
+        if dry_run:
+            return summary
+
+        device_registry.REGISTRY_SHARDS = shards
+        device_registry.create_registry_schema()
+        for path in device_registry.shard_paths():
+            with device_registry.read_connection(path) as conn:
+                if _count(conn, "device_registrations") or _count(conn, "connection_history"):
+                    raise RuntimeError(f"{os.path.basename(path)} already has rows; remove the shard files to re-run")
+
+        _copy_table(src, "device_registrations", REGISTRATION_COLUMNS)
+        print(f"✅ Copied {summary['registrations']} registrations")
+        _copy_table(src, "connection_history", HISTORY_COLUMNS)
+        print(f"✅ Copied {summary['connection_history']} connection history rows")
+    finally:
+        src.close()
+
+    summary["owners_indexed"] = device_registry.fill_owner_index()
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Split the device registry into shard files")
+    parser.add_argument("--shards", type=int, default=device_registry.REGISTRY_SHARDS)
+    parser.add_argument("--source", default=device_registry.DB_PATH)
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+
+    summary = migrate_to_shards(args.source, args.shards, args.dry_run)
+    print(f"📦 {summary}")
+    print(f"➡️  Start the server with REGISTRY_SHARDS={args.shards} to use the shards")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+"""
+Storage Migration
+Copies schedules and history from the per-device layout (<id>.db and
+<id>_history.db under /tmp/devices) into the sharded layout.
+
+Schedule and history IDs are reassigned because IDs from different
+devices collide inside a shard; run this while the server is stopped.
+
+Usage: python migrate_storage.py [--shards N] [--source DIR] [--dry-run]
+"""
+import argparse
+import os
+import sqlite3
+from typing import Dict, List, Tuple
+import storage
+import device_registry
+from database import open_tuned_connection, ensure_schedules_schema
+from history.history import backfill_epochs, ensure_history_schema
+
+SCHEDULE_COLUMNS = ("container_id", "name", "time", "days", "quantity")
+HISTORY_COLUMNS = ("medicine_name", "container_id", "quantity", "scheduled_time",
+                   "scheduled_days", "datetime_taken", "time_taken", "created_at")
+ROLLUP_COLUMNS = ("day", "container_id", "doses", "quantity")
+INVENTORY_COLUMNS = ("container_id", "pills", "pending_dispensed", "low_stock_threshold",
+                     "low_stock_alerted", "updated_at")
+INVENTORY_EVENT_COLUMNS = ("container_id", "kind", "amount", "pills_after", "created_at")
+
+
+def _known_device_ids() -> Dict[str, str]:
+    """Map sanitized file names back to real device IDs via the registry"""
+    try:
+        return {storage.safe_device_id(device_id): device_id for device_id in device_registry.list_device_ids()}
+    except sqlite3.Error:
+        return {}
+
+
+def find_device_files(source_dir: str) -> List[Tuple[str, str, str]]:
+    """(device_id, schedules_path, history_path) for every device in the per-device layout"""
+    known = _known_device_ids()
+    devices = {}
+    for name in sorted(os.listdir(source_dir)):
+        if not name.endswith(".db"):
+            continue
+        stem = name[:-len(".db")]
+        kind = "history" if stem.endswith("_history") else "schedules"
+        if kind == "history":
+            stem = stem[:-len("_history")]
+        devices.setdefault(stem, {})[kind] = os.path.join(source_dir, name)
+
+    return [
+        (known.get(stem) or _stored_device_id(paths) or stem, paths.get("schedules"), paths.get("history"))
+        for stem, paths in devices.items()
+    ]
+
+
+def _stored_device_id(paths: Dict[str, str]):
+    """device_id recorded in the rows themselves (files upgraded after sharding support)"""
+    for table, path in (("schedules", paths.get("schedules")), ("history", paths.get("history"))):
+        if not path:
+            continue
+        conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        try:
+            row = conn.execute(
+                f"SELECT device_id FROM {table} WHERE device_id IS NOT NULL LIMIT 1"
+            ).fetchone()
+            if row:
+                return row[0]
+        except sqlite3.OperationalError:
+            pass  # table or column missing
+        finally:
+            conn.close()
+    return None
+
+
+def _copy_rows(src_path: str, table: str, columns: Tuple[str, ...], device_id: str,
+               dest: sqlite3.Connection, order_by: str = "id") -> int:
+    src = sqlite3.connect(f"file:{src_path}?mode=ro", uri=True)
+    try:
+        exists = src.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)
+        ).fetchone()
+        if not exists:
+            return 0
+        rows = src.execute(f"SELECT {', '.join(columns)} FROM {table} ORDER BY {order_by}").fetchall()
+    finally:
+        src.close()
+
+    placeholders = ", ".join("?" for _ in range(len(columns) + 1))
+    dest.executemany(
+        f"INSERT INTO {table} (device_id, {', '.join(columns)}) VALUES ({placeholders})",
+        [(device_id, *row) for row in rows]
+    )
+    return len(rows)
+
+
+def migrate_to_shards(source_dir: str = storage.BASE_DIR, shards: int = storage.STORAGE_SHARDS,
+                      dry_run: bool = False) -> Dict:
+    """Copy every per-device file into shard files. Returns row counts."""
+    target = storage.ShardedBackend(shards=shards)
+    devices = find_device_files(source_dir)
+    summary = {"devices": len(devices), "schedules": 0, "history": 0, "rollups": 0, "inventory": 0,
+               "shards": shards}
+
+    if dry_run:
+        return summary
+
+    connections = {}
+    try:
+        for device_id, schedules_path, history_path in devices:
+            path = target.schedules_path(device_id)
+            conn = connections.get(path)
+            if conn is None:
+                conn = connections[path] = open_tuned_connection(path)
+                ensure_schedules_schema(conn)
+                ensure_history_schema(conn)
+
+            # Skip devices already migrated so the tool can be re-run safely
+            already = conn.execute(
+                "SELECT 1 FROM schedules WHERE device_id = ? UNION ALL "
+                "SELECT 1 FROM history WHERE device_id = ? LIMIT 1",
+                (device_id, device_id)
+            ).fetchone()
+            if already:
+                print(f"⏭️  {device_id} already present in {os.path.basename(path)}")
+                continue
+
+            with conn:
+                if schedules_path:
+                    summary["schedules"] += _copy_rows(schedules_path, "schedules", SCHEDULE_COLUMNS, device_id, conn)
+                    summary["inventory"] += _copy_rows(schedules_path, "inventory", INVENTORY_COLUMNS,
+                                                       device_id, conn, order_by="container_id")
+                    _copy_rows(schedules_path, "inventory_events", INVENTORY_EVENT_COLUMNS, device_id, conn)
+                if history_path:
+                    first_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM history").fetchone()[0]
+                    summary["history"] += _copy_rows(history_path, "history", HISTORY_COLUMNS, device_id, conn)
+                    backfill_epochs(conn, after_id=first_id)
+                    summary["rollups"] += _copy_rows(history_path, "history_daily", ROLLUP_COLUMNS,
+                                                     device_id, conn, order_by="day")
+            print(f"✅ Migrated {device_id} -> {os.path.basename(path)}")
+    finally:
+        for conn in connections.values():
+            conn.close()
+
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrate per-device SQLite files into shards")
+    parser.add_argument("--shards", type=int, default=storage.STORAGE_SHARDS)
+    parser.add_argument("--source", default=storage.BASE_DIR)
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+
+    summary = migrate_to_shards(args.source, args.shards, args.dry_run)
+    print(f"📦 {summary}")
+    print("➡️  Start the server with STORAGE_BACKEND=sharded to use the shards")
+
+
+if __name__ == "__main__":
+    main()
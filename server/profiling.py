@@ -0,0 +1,272 @@
+"""
+Request Profiling
+Opt-in cProfile capture for single requests and scheduler ticks. Off by
+default: the middleware and admin routes are only installed when
+PROFILING_ENABLED is set, so a normal deployment pays nothing.
+
+A request is profiled when it carries X-Profile: 1 with the admin key,
+or when it is picked by PROFILE_SAMPLE_RATE. A scheduler tick is
+profiled after an admin arms one. Each profile is a pstats dump plus a
+JSON sidecar (route, device, duration, top functions) in PROFILE_DIR.
+
+Up to Python 3.11 cProfile only sees the thread it runs on, so SQLite
+work a capture sends to the DB executors and writer threads is profiled
+there and merged into the capture. From 3.12 cProfile is built on
+sys.monitoring, which is process-wide: the capture's own profiler already
+records every thread, and a second profiler cannot be enabled at all, so
+the per-thread profilers are skipped. The event-loop side of a request capture also records any
+other request's coroutines that ran meanwhile; the sidecar's
+concurrent_requests says how many were in flight.
+"""
+import contextvars
+import cProfile
+import io
+import json
+import os
+import pstats
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime
+from typing import Dict, List, Optional
+import shared_state
+
+PROFILING_ENABLED = os.environ.get("PROFILING_ENABLED", "0").lower() in ("1", "true", "yes")
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_DIR = os.environ.get("PROFILE_DIR", os.path.join(os.environ.get("DB_DIR", "/tmp"), "profiles"))
+PROFILE_MAX_FILES = int(os.environ.get("PROFILE_MAX_FILES", "100"))
+ADMIN_KEY = os.environ.get("ADMIN_KEY", "")
+PROFILE_HEADER = "x-profile"
+ADMIN_KEY_HEADER = "x-admin-key"
+TOP_FUNCTIONS = 15
+
+PROFILE_ID_REGEX = re.compile(r'^\d+-(request|scheduler)-[0-9a-f]{8}$')
+
+# cProfile hooks are per thread and a second profiler would displace the
+# first, so only one capture runs at a time; others are skipped
+_capture_lock = threading.Lock()
+_stats = {"captured": 0, "skipped_busy": 0}
+tick_requested = False
+
+
+class Capture:
+    """A running capture: the profiler of the thread that began it plus
+    the profiles of executor and writer work done on its behalf"""
+
+    def __init__(self):
+        self.profiler = cProfile.Profile()
+        self.offloaded: List[cProfile.Profile] = []
+        self._lock = threading.Lock()
+        self._token = None
+
+    def add(self, profiler: cProfile.Profile):
+        with self._lock:
+            self.offloaded.append(profiler)
+
+    def stats(self) -> pstats.Stats:
+        stats = pstats.Stats(self.profiler)
+        with self._lock:
+            for profiler in self.offloaded:
+                stats.add(profiler)
+        return stats
+
+
+# Before 3.12 each thread needs its own profiler; later ones share one hook
+PER_THREAD_PROFILERS = sys.version_info < (3, 12)
+
+# The capture of the current request or tick; copied into route tasks and
+# read by the executors when work is submitted
+_current: contextvars.ContextVar = contextvars.ContextVar("profile_capture", default=None)
+
+
+def current() -> Optional[Capture]:
+    return _current.get()
+
+
+def run_captured(capture: Capture, fn, *args, **kwargs):
+    """Run fn on this thread under its own profiler, credited to capture"""
+    token = _current.set(capture)
+    profiler = cProfile.Profile() if PER_THREAD_PROFILERS else None
+    try:
+        if profiler is not None:
+            try:
+                profiler.enable()
+            except ValueError:
+                # Another profiling tool (a debugger, coverage) holds the hook
+                profiler = None
+        return fn(*args, **kwargs)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            capture.add(profiler)
+        _current.reset(token)
+
+
+def is_admin(key: Optional[str]) -> bool:
+    return bool(ADMIN_KEY) and key == ADMIN_KEY
+
+
+def wants_profile(headers) -> Optional[str]:
+    """Why this request should be profiled ("header" or "sampled"), or None"""
+    if headers.get(PROFILE_HEADER) == "1" and is_admin(headers.get(ADMIN_KEY_HEADER)):
+        return "header"
+    if PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE:
+        return "sampled"
+    return None
+
+
+def begin() -> Optional[Capture]:
+    """Start a capture, or return None if another one is running"""
+    if not _capture_lock.acquire(blocking=False):
+        _stats["skipped_busy"] += 1
+        return None
+    capture = Capture()
+    try:
+        capture.profiler.enable()
+    except ValueError:
+        # Another profiling tool holds the hook; the request runs unprofiled
+        _capture_lock.release()
+        _stats["skipped_busy"] += 1
+        return None
+    capture._token = _current.set(capture)
+    return capture
+
+
+def _top_functions(stats: pstats.Stats) -> List[Dict]:
+    rows = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:TOP_FUNCTIONS]
+    return [
+        {
+            "function": f"{os.path.basename(filename)}:{line}({name})",
+            "calls": calls,
+            "total_ms": round(total * 1000, 3),
+            "cumulative_ms": round(cumulative * 1000, 3),
+        }
+        for (filename, line, name), (_, calls, total, cumulative, _) in rows
+    ]
+
+
+def _prune():
+    names = sorted(n for n in os.listdir(PROFILE_DIR) if n.endswith(".json"))
+    for name in names[:max(0, len(names) - PROFILE_MAX_FILES)]:
+        for suffix in (".json", ".prof"):
+            try:
+                os.remove(os.path.join(PROFILE_DIR, name[:-len(".json")] + suffix))
+            except FileNotFoundError:
+                pass
+
+
+def stop(capture: Capture):
+    """End a capture (must run in the thread and context that called begin)"""
+    try:
+        capture.profiler.disable()
+        _current.reset(capture._token)
+    finally:
+        _capture_lock.release()
+
+
+def save(capture: Capture, kind: str, duration_ms: float, **metadata) -> Optional[str]:
+    """Store a stopped capture with its metadata (blocking); returns the profile ID"""
+    profile_id = f"{int(time.time() * 1000)}-{kind}-{uuid.uuid4().hex[:8]}"
+    try:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        stats = capture.stats()
+        stats.dump_stats(os.path.join(PROFILE_DIR, f"{profile_id}.prof"))
+        record = {
+            "id": profile_id,
+            "kind": kind,
+            "created_at": datetime.now().isoformat(),
+            "duration_ms": round(duration_ms, 2),
+            "worker_id": shared_state.WORKER_ID,
+            "offloaded_calls": len(capture.offloaded),
+            **metadata,
+            "top": _top_functions(stats),
+        }
+        with open(os.path.join(PROFILE_DIR, f"{profile_id}.json"), "w") as f:
+            json.dump(record, f)
+        _prune()
+    except Exception as e:
+        print(f"⚠️ Failed to save profile: {e}")
+        return None
+    _stats["captured"] += 1
+    print(f"🔬 Saved {kind} profile {profile_id} ({duration_ms:.1f} ms)")
+    return profile_id
+
+
+def finish(capture: Capture, kind: str, duration_ms: float, **metadata) -> Optional[str]:
+    """Stop and store a capture from the thread that started it"""
+    stop(capture)
+    return save(capture, kind, duration_ms, **metadata)
+
+
+def list_profiles(limit: int = 50) -> List[Dict]:
+    """Stored profile metadata, newest first (without the top-function lists)"""
+    if not os.path.isdir(PROFILE_DIR):
+        return []
+    names = sorted((n for n in os.listdir(PROFILE_DIR) if n.endswith(".json")), reverse=True)[:limit]
+    profiles = []
+    for name in names:
+        try:
+            with open(os.path.join(PROFILE_DIR, name)) as f:
+                record = json.load(f)
+        except (OSError, ValueError):
+            continue
+        record.pop("top", None)
+        profiles.append(record)
+    return profiles
+
+
+def profile_path(profile_id: str) -> Optional[str]:
+    """Path of a stored .prof file, or None for unknown or malformed IDs"""
+    if not PROFILE_ID_REGEX.match(profile_id):
+        return None
+    path = os.path.join(PROFILE_DIR, f"{profile_id}.prof")
+    return path if os.path.exists(path) else None
+
+
+def load_metadata(profile_id: str) -> Optional[Dict]:
+    if not profile_path(profile_id):
+        return None
+    with open(os.path.join(PROFILE_DIR, f"{profile_id}.json")) as f:
+        return json.load(f)
+
+
+def render_text(profile_id: str, limit: int = 40) -> Optional[str]:
+    """pstats report sorted by cumulative time"""
+    path = profile_path(profile_id)
+    if not path:
+        return None
+    out = io.StringIO()
+    pstats.Stats(path, stream=out).sort_stats("cumulative").print_stats(limit)
+    return out.getvalue()
+
+
+def arm_scheduler_tick():
+    """Profile the next tick of whichever worker leads the scheduler"""
+    global tick_requested
+    tick_requested = True
+    shared_state.bump("profile:scheduler")
+
+
+def take_tick_request() -> bool:
+    global tick_requested
+    if not tick_requested:
+        return False
+    tick_requested = False
+    return True
+
+
+def _on_remote_arm(scope: str):
+    global tick_requested
+    tick_requested = True
+
+
+if PROFILING_ENABLED:
+    shared_state.on_change("profile:scheduler", _on_remote_arm)
+
+
+def stats() -> Dict:
+    return {**_stats, "enabled": PROFILING_ENABLED, "sample_rate": PROFILE_SAMPLE_RATE,
+            "tick_requested": tick_requested}
@@ -0,0 +1,137 @@
+"""
+Rate Limiting
+In-memory token buckets with separate limits for app and device (ESP32)
+endpoints. Before auth, app requests are only limited per client address;
+the device_id / email buckets apply once a request is authenticated, so
+an unauthenticated caller cannot drain the owner's allowance. Device
+endpoints carry no auth: they are limited per configured device_id,
+behind a per-address bucket of their own (so one flooding address is cut
+off before it reaches the device's budget, and app traffic from the same
+NAT does not count against the device). Each check is O(1).
+
+Behind a reverse proxy every request comes from the proxy's address, so
+X-Forwarded-For is honoured when the peer is listed in TRUSTED_PROXIES
+(comma-separated addresses or networks, e.g. "10.0.0.0/8,127.0.0.1").
+It is ignored otherwise, since any client can send the header.
+"""
+import ipaddress
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+# Sustained requests per minute and burst size for each class of client
+APP_RATE_PER_MINUTE = float(os.environ.get("RATE_LIMIT_APP_PER_MINUTE", "120"))
+APP_BURST = float(os.environ.get("RATE_LIMIT_APP_BURST", "30"))
+DEVICE_RATE_PER_MINUTE = float(os.environ.get("RATE_LIMIT_DEVICE_PER_MINUTE", "30"))
+DEVICE_BURST = float(os.environ.get("RATE_LIMIT_DEVICE_BURST", "10"))
+# Upper bound on tracked keys; least recently seen buckets are dropped first
+MAX_TRACKED_KEYS = int(os.environ.get("RATE_LIMIT_MAX_KEYS", "10000"))
+TRUSTED_PROXIES = [
+    ipaddress.ip_network(entry.strip(), strict=False)
+    for entry in os.environ.get("TRUSTED_PROXIES", "").split(",") if entry.strip()
+]
+
+
+class RateLimiter:
+    """Token buckets stored as (tokens, last_refill) in an LRU-bounded dict"""
+
+    def __init__(self, limits: Dict[str, Tuple[float, float]], max_keys: int = MAX_TRACKED_KEYS):
+        # scope -> (refill tokens per second, capacity)
+        self.limits = {
+            scope: (per_minute / 60.0, burst) for scope, (per_minute, burst) in limits.items()
+        }
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[Tuple[str, str], list]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.allowed = {scope: 0 for scope in limits}
+        self.limited = {scope: 0 for scope in limits}
+
+    def check(self, scope: str, key: str, now: float = None) -> float:
+        """
+        Take one token. Returns 0 if allowed, otherwise the number of
+        seconds until a token is available (for Retry-After).
+        """
+        return self.check_all([(scope, key)], now)[1]
+
+    def check_all(self, checks: List[Tuple[str, str]], now: float = None) -> Tuple[str, float]:
+        """
+        Take one token from every (scope, key) bucket, or from none of them
+        if any is empty. Returns ("", 0) if allowed, otherwise the scope that
+        is limited and the seconds until it has a token.
+        """
+        now = time.monotonic() if now is None else now
+
+        with self._lock:
+            buckets = [(scope, self._refill(scope, key, now)) for scope, key in checks]
+            for scope, bucket in buckets:
+                if bucket[0] < 1:
+                    self.limited[scope] += 1
+                    return scope, (1 - bucket[0]) / self.limits[scope][0]
+
+            for scope, bucket in buckets:
+                bucket[0] -= 1
+                self.allowed[scope] += 1
+            return "", 0.0
+
+    def _refill(self, scope: str, key: str, now: float) -> list:
+        """The bucket for (scope, key), topped up to now (caller holds the lock)"""
+        rate, capacity = self.limits[scope]
+        bucket_key = (scope, key)
+        bucket = self._buckets.get(bucket_key)
+        if bucket is None:
+            bucket = [capacity, now]
+            self._buckets[bucket_key] = bucket
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(bucket_key)
+            bucket[0] = min(capacity, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+        return bucket
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "tracked_keys": len(self._buckets),
+                "allowed": dict(self.allowed),
+                "shed": dict(self.limited),
+            }
+
+
+limiter = RateLimiter({
+    "app_device": (APP_RATE_PER_MINUTE, APP_BURST),
+    "app_email": (APP_RATE_PER_MINUTE, APP_BURST),
+    "device": (DEVICE_RATE_PER_MINUTE, DEVICE_BURST),
+    "client": (APP_RATE_PER_MINUTE, APP_BURST),
+    "device_client": (APP_RATE_PER_MINUTE, APP_BURST),
+})
+
+
+def retry_after_header(wait_seconds: float) -> str:
+    return str(max(1, math.ceil(wait_seconds)))
+
+
+def _trusted(address: str) -> bool:
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(ip in network for network in TRUSTED_PROXIES)
+
+
+def client_address(peer: Optional[str], forwarded_for: Optional[str]) -> str:
+    """
+    The address to rate limit: the peer, or when the peer is a trusted
+    proxy, the last X-Forwarded-For hop that is not itself a trusted proxy
+    """
+    address = peer or "unknown"
+    if not forwarded_for or not _trusted(address):
+        return address
+    for hop in reversed([hop.strip() for hop in forwarded_for.split(",") if hop.strip()]):
+        address = hop
+        if not _trusted(hop):
+            break
+    return address
@@ -0,0 +1,278 @@
+"""
+History Repository
+Blocking history queries plus async wrappers that run on the history DB executor
+"""
+import base64
+import heapq
+import json
+import os
+import re
+import sqlite3
+import time
+from datetime import datetime, timedelta
+from itertools import islice
+from typing import Dict, Iterator, List, Optional, Tuple
+import storage
+from history.history import CREATED_AT_FORMAT, FTS5_AVAILABLE, history_connection, history_db_writer, local_epoch
+from history.history_writer import save_history_record
+from db_executor import HISTORY_EXECUTOR
+import device_settings
+
+
+def list_history(device_id: str) -> List[Dict]:
+    """All history entries, newest first"""
+    with history_connection(device_id) as conn:
+        history = conn.execute("""
+            SELECT id, medicine_name, container_id, quantity, 
+                   scheduled_time, scheduled_days, datetime_taken, time_taken
+            FROM history 
+            WHERE device_id = ?
+            ORDER BY created_at DESC
+        """, (device_id,)).fetchall()
+
+        return [
+            {
+                "id": row[0],
+                "medicine_name": row[1],
+                "container_id": row[2],
+                "quantity": row[3],
+                "scheduled_time": row[4],
+                "scheduled_days": row[5],
+                "datetime_taken": row[6],
+                "time_taken": row[7]
+            }
+            for row in history
+        ]
+
+
+def delete_all_history(device_id: str) -> int:
+    """Delete every history entry and return how many were removed"""
+    def delete_all(conn):
+        deleted = conn.execute("DELETE FROM history WHERE device_id = ?", (device_id,)).rowcount
+        rolled = conn.execute(
+            "SELECT COALESCE(SUM(doses), 0) FROM history_daily WHERE device_id = ?", (device_id,)
+        ).fetchone()[0]
+        conn.execute("DELETE FROM history_daily WHERE device_id = ?", (device_id,))
+        conn.execute("DELETE FROM history_medicines WHERE device_id = ?", (device_id,))
+        return deleted + rolled
+
+    return history_db_writer(device_id).write(delete_all)
+
+
+def delete_history_entry(device_id: str, history_id: int) -> bool:
+    """Delete one history entry. Returns False if it did not exist."""
+    return history_db_writer(device_id).write(lambda conn: conn.execute(
+        "DELETE FROM history WHERE id = ? AND device_id = ?", (history_id, device_id)
+    ).rowcount > 0)
+
+
+def get_history_stats(device_id: str) -> Dict:
+    """Total, per-container and last-7-days counts, including rolled-up history"""
+    with history_connection(device_id) as conn:
+        by_container = conn.execute("""
+            SELECT container_id, SUM(count) FROM (
+                SELECT container_id, COUNT(*) AS count
+                FROM history WHERE device_id = ? GROUP BY container_id
+                UNION ALL
+                SELECT container_id, SUM(doses)
+                FROM history_daily WHERE device_id = ? GROUP BY container_id
+            )
+            GROUP BY container_id
+        """, (device_id, device_id)).fetchall()
+
+        rolled_up = conn.execute(
+            "SELECT COALESCE(SUM(doses), 0) FROM history_daily WHERE device_id = ?", (device_id,)
+        ).fetchone()[0]
+
+        recent = conn.execute(
+            "SELECT COUNT(*) FROM history WHERE device_id = ? AND taken_at >= ?",
+            (device_id, int(time.time()) - 7 * 86400)
+        ).fetchone()[0]
+        # Only non-zero when the retention window is shorter than a week;
+        # rollup days are device-local
+        week_ago = datetime.now(device_settings.get_timezone(device_id)).date() - timedelta(days=7)
+        recent += conn.execute("""
+            SELECT COALESCE(SUM(doses), 0) FROM history_daily
+            WHERE device_id = ? AND day >= ?
+        """, (device_id, week_ago.isoformat())).fetchone()[0]
+
+        return {
+            "total_entries": sum(row[1] for row in by_container),
+            "by_container": {row[0]: row[1] for row in by_container},
+            "recent_7_days": recent,
+            "rolled_up_entries": rolled_up,
+        }
+
+
+EXPORT_COLUMNS = ("id", "medicine_name", "container_id", "quantity", "scheduled_time",
+                  "scheduled_days", "datetime_taken", "time_taken", "created_at")
+EXPORT_BATCH_SIZE = 500
+
+
+def iter_history(device_id: str, start: Optional[datetime] = None, end: Optional[datetime] = None,
+                 container_id: Optional[int] = None,
+                 batch_size: int = EXPORT_BATCH_SIZE) -> Iterator[Tuple]:
+    """
+    Stream history rows (EXPORT_COLUMNS order, oldest taken first) in
+    batches. Uses its own read-only connection so a long export never holds
+    the cached connection; WAL lets writers continue meanwhile.
+    start/end bound the taken time like search_history (naive values are
+    wall clock in the device's timezone, end exclusive). Rows without a
+    taken_at (text that does not parse, or not backfilled yet) are bounded
+    by created_at instead and come first.
+    """
+    path = storage.history_path(device_id)
+    if not os.path.exists(path):
+        return
+
+    tz = device_settings.get_timezone(device_id)
+    clauses, params = ["device_id = ?"], [device_id]
+    if start or end:
+        taken, received = ["taken_at IS NOT NULL"], ["taken_at IS NULL"]
+        taken_params, received_params = [], []
+        for bound, op in ((start, ">="), (end, "<")):
+            if bound:
+                epoch = local_epoch(bound, tz)
+                taken.append(f"taken_at {op} ?")
+                taken_params.append(epoch)
+                received.append(f"created_at {op} ?")
+                received_params.append(datetime.utcfromtimestamp(epoch).strftime(CREATED_AT_FORMAT))
+        clauses.append(f"(({' AND '.join(taken)}) OR ({' AND '.join(received)}))")
+        params.extend(taken_params + received_params)
+    if container_id is not None:
+        clauses.append("container_id = ?")
+        params.append(container_id)
+
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+    try:
+        cursor = conn.execute(
+            f"SELECT {', '.join(EXPORT_COLUMNS)} FROM history "
+            f"WHERE {' AND '.join(clauses)} ORDER BY taken_at, id",
+            params
+        )
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                return
+            yield from rows
+    finally:
+        conn.close()
+
+
+SEARCH_COLUMNS = ("id", "medicine_name", "container_id", "quantity", "scheduled_time",
+                  "scheduled_days", "datetime_taken", "time_taken", "taken_at", "scheduled_at")
+SEARCH_LIMIT = 50
+SEARCH_MAX_LIMIT = 200
+# A prefix matching more names than this searches only the first ones
+SEARCH_MAX_NAMES = 50
+_SEARCH_TAKEN = SEARCH_COLUMNS.index("taken_at")
+
+
+def encode_search_cursor(taken_at: int, history_id: int) -> str:
+    return base64.urlsafe_b64encode(json.dumps([taken_at, history_id]).encode()).decode()
+
+
+def decode_search_cursor(cursor: str) -> Tuple[int, int]:
+    """(taken_at, id) of the last row of the previous page; ValueError if malformed"""
+    try:
+        taken_at, history_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        raise ValueError("malformed cursor")
+    if not isinstance(taken_at, int) or not isinstance(history_id, int):
+        raise ValueError("malformed cursor")
+    return taken_at, history_id
+
+
+def match_medicine_names(conn, device_id: str, query: str) -> List[str]:
+    """The device's medicine names matching every word of query as a prefix"""
+    terms = re.findall(r"\w+", query)
+    if not terms:
+        return []
+    if FTS5_AVAILABLE:
+        rows = conn.execute("""
+            SELECT m.medicine_name FROM history_medicines_fts
+            JOIN history_medicines m ON m.id = history_medicines_fts.rowid
+            WHERE history_medicines_fts MATCH ? AND m.device_id = ?
+            LIMIT ?
+        """, (" ".join(f'"{term}"*' for term in terms), device_id, SEARCH_MAX_NAMES))
+    else:
+        prefix = query.strip().replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        rows = conn.execute("""
+            SELECT medicine_name FROM history_medicines
+            WHERE device_id = ? AND medicine_name LIKE ? ESCAPE '\\'
+            LIMIT ?
+        """, (device_id, prefix + "%", SEARCH_MAX_NAMES))
+    return [row[0] for row in rows]
+
+
+def search_history(device_id: str, medicine: Optional[str] = None, container_id: Optional[int] = None,
+                   scheduled_time: Optional[str] = None, start: Optional[datetime] = None,
+                   end: Optional[datetime] = None, after: Optional[Tuple[int, int]] = None,
+                   limit: int = SEARCH_LIMIT) -> Dict:
+    """
+    One page of history matching every given filter, newest taken first.
+    start/end bound the taken time (wall clock in the device's timezone,
+    end exclusive); after is the decoded cursor. Pages are keyset-paginated
+    on (taken_at, id), so every page is an integer index seek plus at most
+    limit rows whatever the history size.
+    """
+    tz = device_settings.get_timezone(device_id)
+    clauses, params = ["device_id = ?", "taken_at IS NOT NULL"], [device_id]
+    if container_id is not None:
+        clauses.append("container_id = ?")
+        params.append(container_id)
+    if scheduled_time:
+        clauses.append("scheduled_time = ?")
+        params.append(scheduled_time)
+    if start:
+        clauses.append("taken_at >= ?")
+        params.append(local_epoch(start, tz))
+    if end:
+        clauses.append("taken_at < ?")
+        params.append(local_epoch(end, tz))
+    if after:
+        clauses.append("(taken_at, id) < (?, ?)")
+        params.extend(after)
+
+    query = f"SELECT {', '.join(SEARCH_COLUMNS)} FROM history WHERE {' AND '.join(clauses)}"
+    order = " ORDER BY taken_at DESC, id DESC LIMIT ?"
+    with history_connection(device_id) as conn:
+        if medicine is None:
+            rows = conn.execute(query + order, (*params, limit + 1)).fetchall()
+        else:
+            # One ordered index read per matching name, merged here; a single
+            # medicine_name IN (...) query would have to sort every match
+            runs = [
+                conn.execute(query + " AND medicine_name = ?" + order, (*params, name, limit + 1)).fetchall()
+                for name in match_medicine_names(conn, device_id, medicine)
+            ]
+            rows = list(islice(
+                heapq.merge(*runs, key=lambda row: (row[_SEARCH_TAKEN], row[0]), reverse=True), limit + 1
+            ))
+
+    page = [dict(zip(SEARCH_COLUMNS, row)) for row in rows[:limit]]
+    next_cursor = None
+    if len(rows) > limit:
+        next_cursor = encode_search_cursor(page[-1]["taken_at"], page[-1]["id"])
+    return {"results": page, "next_cursor": next_cursor}
+
+
+# ---- Async API (used by routes) ----
+
+async def alist_history(device_id: str) -> List[Dict]:
+    return await HISTORY_EXECUTOR.run(list_history, device_id)
+
+async def adelete_all_history(device_id: str) -> int:
+    return await HISTORY_EXECUTOR.run(delete_all_history, device_id)
+
+async def adelete_history_entry(device_id: str, history_id: int) -> bool:
+    return await HISTORY_EXECUTOR.run(delete_history_entry, device_id, history_id)
+
+async def aget_history_stats(device_id: str) -> Dict:
+    return await HISTORY_EXECUTOR.run(get_history_stats, device_id)
+
+async def asave_history_record(**record) -> None:
+    await HISTORY_EXECUTOR.run(lambda: save_history_record(**record))
+
+async def asearch_history(device_id: str, **filters) -> Dict:
+    return await HISTORY_EXECUTOR.run(lambda: search_history(device_id, **filters))
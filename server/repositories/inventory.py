@@ -0,0 +1,187 @@
+"""
+Inventory Repository
+Per-container pill counters kept in the schedules DB. Every change is a
+primary-key UPDATE, so dispenses and confirmations cost O(1) regardless
+of how much history a device has. Changes run on the file's writer.
+"""
+import os
+from typing import Dict, List, Optional
+from database import device_connection, device_db_writer
+from db_executor import SCHEDULES_EXECUTOR
+
+LOW_STOCK_DEFAULT_THRESHOLD = int(os.environ.get("LOW_STOCK_DEFAULT_THRESHOLD", "5"))
+INVENTORY_EVENTS_LIMIT = 100
+
+_COLUMNS = "container_id, pills, pending_dispensed, low_stock_threshold, low_stock_alerted, updated_at"
+
+
+def _row_to_dict(row) -> Dict:
+    return {
+        "container_id": row[0],
+        "pills": row[1],
+        "pending_dispensed": row[2],
+        "low_stock_threshold": row[3],
+        "low_stock_alerted": bool(row[4]),
+        "updated_at": row[5],
+    }
+
+
+def _fetch(conn, device_id: str, container_id: int) -> Optional[Dict]:
+    row = conn.execute(
+        f"SELECT {_COLUMNS} FROM inventory WHERE device_id = ? AND container_id = ?",
+        (device_id, container_id)
+    ).fetchone()
+    return _row_to_dict(row) if row else None
+
+
+def _claim_low_stock_alert(conn, device_id: str, item: Dict) -> bool:
+    """Flag the container as alerted the first time it drops to its threshold"""
+    if item["pills"] > item["low_stock_threshold"] or item["low_stock_alerted"]:
+        return False
+    cursor = conn.execute(
+        "UPDATE inventory SET low_stock_alerted = 1 WHERE device_id = ? AND container_id = ? AND low_stock_alerted = 0",
+        (device_id, item["container_id"])
+    )
+    item["low_stock_alerted"] = True
+    return cursor.rowcount == 1
+
+
+def list_inventory(device_id: str) -> List[Dict]:
+    """Counters for every tracked container"""
+    with device_connection(device_id) as conn:
+        rows = conn.execute(
+            f"SELECT {_COLUMNS} FROM inventory WHERE device_id = ? ORDER BY container_id",
+            (device_id,)
+        ).fetchall()
+    return [_row_to_dict(row) for row in rows]
+
+
+def refill(device_id: str, container_id: int, pills: int, set_total: bool = False,
+           low_stock_threshold: Optional[int] = None) -> Dict:
+    """
+    Add pills to a container (or set its count when set_total) and log a
+    refill event. Starts tracking the container if it was not tracked yet.
+    A refill clears the low-stock flag and any unconfirmed dispenses.
+    """
+    threshold = LOW_STOCK_DEFAULT_THRESHOLD if low_stock_threshold is None else low_stock_threshold
+
+    def apply(conn):
+        conn.execute(
+            """INSERT INTO inventory (device_id, container_id, pills, low_stock_threshold, updated_at)
+               VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
+               ON CONFLICT(device_id, container_id) DO UPDATE SET
+               pills = CASE WHEN ? THEN excluded.pills ELSE pills + excluded.pills END,
+               pending_dispensed = 0,
+               low_stock_threshold = COALESCE(?, low_stock_threshold),
+               low_stock_alerted = 0,
+               updated_at = CURRENT_TIMESTAMP""",
+            (device_id, container_id, pills, threshold, set_total, low_stock_threshold)
+        )
+        item = _fetch(conn, device_id, container_id)
+        conn.execute(
+            "INSERT INTO inventory_events (device_id, container_id, kind, amount, pills_after) VALUES (?, ?, ?, ?, ?)",
+            (device_id, container_id, "set" if set_total else "refill", pills, item["pills"])
+        )
+        return item
+
+    return device_db_writer(device_id).write(apply)
+
+
+def record_dispensed(device_id: str, container_id: int, quantity: int) -> Optional[Dict]:
+    """
+    Take a delivered dispense command off the count. The dose stays pending
+    until /push_history confirms it, so the confirmation is not counted twice.
+    Returns the updated counters (None if the container is not tracked) with
+    low_stock_alert set when this dose crossed the threshold.
+    """
+    def apply(conn):
+        cursor = conn.execute(
+            """UPDATE inventory SET
+               pills = MAX(pills - ?, 0),
+               pending_dispensed = pending_dispensed + ?,
+               updated_at = CURRENT_TIMESTAMP
+               WHERE device_id = ? AND container_id = ?""",
+            (quantity, quantity, device_id, container_id)
+        )
+        if cursor.rowcount == 0:
+            return None
+        item = _fetch(conn, device_id, container_id)
+        item["low_stock_alert"] = _claim_low_stock_alert(conn, device_id, item)
+        return item
+
+    return device_db_writer(device_id).write(apply)
+
+
+def record_taken(device_id: str, container_id: int, quantity: int) -> Optional[Dict]:
+    """
+    Apply a /push_history record. Quantity already taken off by a dispense
+    command only settles the pending count; anything beyond it (a dose the
+    scheduler did not send) is taken off the pills.
+    """
+    def apply(conn):
+        # SET expressions all read the pre-update row
+        cursor = conn.execute(
+            """UPDATE inventory SET
+               pills = MAX(pills - MAX(? - pending_dispensed, 0), 0),
+               pending_dispensed = MAX(pending_dispensed - ?, 0),
+               updated_at = CURRENT_TIMESTAMP
+               WHERE device_id = ? AND container_id = ?""",
+            (quantity, quantity, device_id, container_id)
+        )
+        if cursor.rowcount == 0:
+            return None
+        item = _fetch(conn, device_id, container_id)
+        item["low_stock_alert"] = _claim_low_stock_alert(conn, device_id, item)
+        return item
+
+    return device_db_writer(device_id).write(apply)
+
+
+def remove_container(device_id: str, container_id: int) -> bool:
+    """Stop tracking a container (its refill events are kept)"""
+    return device_db_writer(device_id).write(lambda conn: conn.execute(
+        "DELETE FROM inventory WHERE device_id = ? AND container_id = ?", (device_id, container_id)
+    ).rowcount > 0)
+
+
+def list_events(device_id: str, container_id: Optional[int] = None,
+                limit: int = INVENTORY_EVENTS_LIMIT) -> List[Dict]:
+    """Most recent refill events, newest first"""
+    query = "SELECT id, container_id, kind, amount, pills_after, created_at FROM inventory_events WHERE device_id = ?"
+    params = [device_id]
+    if container_id is not None:
+        query += " AND container_id = ?"
+        params.append(container_id)
+    query += " ORDER BY id DESC LIMIT ?"
+    params.append(limit)
+    with device_connection(device_id) as conn:
+        rows = conn.execute(query, params).fetchall()
+    return [
+        {
+            "id": row[0],
+            "container_id": row[1],
+            "kind": row[2],
+            "amount": row[3],
+            "pills_after": row[4],
+            "created_at": row[5],
+        }
+        for row in rows
+    ]
+
+
+# ---- Async API (used by routes) ----
+
+async def alist_inventory(device_id: str) -> List[Dict]:
+    return await SCHEDULES_EXECUTOR.run(list_inventory, device_id)
+
+async def arefill(*args, **kwargs) -> Dict:
+    return await SCHEDULES_EXECUTOR.run(refill, *args, **kwargs)
+
+async def arecord_taken(device_id: str, container_id: int, quantity: int) -> Optional[Dict]:
+    return await SCHEDULES_EXECUTOR.run(record_taken, device_id, container_id, quantity)
+
+async def aremove_container(device_id: str, container_id: int) -> bool:
+    return await SCHEDULES_EXECUTOR.run(remove_container, device_id, container_id)
+
+async def alist_events(*args, **kwargs) -> List[Dict]:
+    return await SCHEDULES_EXECUTOR.run(list_events, *args, **kwargs)
@@ -0,0 +1,106 @@
+"""
+Registry Repository
+Async wrappers around device_registry that run on the registry DB executor
+"""
+import json
+from typing import Dict, List, Optional
+import audit_log
+import device_registry as registry
+from db_executor import REGISTRY_EXECUTOR
+
+
+def get_connection_history(device_id: str, limit: int = 10) -> List[Dict]:
+    """Most recent connection attempts for a device"""
+    # Make buffered audit rows visible before reading
+    audit_log.flush()
+    with registry.get_db_connection(device_id) as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            """SELECT action, email, timestamp, success, notes
+               FROM connection_history
+               WHERE device_id = ?
+               ORDER BY timestamp DESC, id DESC
+               LIMIT ?""",
+            (device_id, limit)
+        )
+        return [
+            {
+                "action": row['action'],
+                "email": row['email'],
+                "timestamp": row['timestamp'],
+                "success": bool(row['success']),
+                "notes": row['notes']
+            }
+            for row in cursor.fetchall()
+        ]
+
+
+def get_devices_by_ids(device_ids: List[str]) -> List[Dict]:
+    """Registration rows for many devices, one indexed query per shard (active or not)"""
+    rows = []
+    for shard, shard_ids in registry.group_by_shard(device_ids).items():
+        with registry.read_connection(registry.shard_path(shard)) as conn:
+            cursor = conn.cursor()
+            # json_each keeps it one statement regardless of the bound-variable limit
+            cursor.execute(
+                """SELECT device_id, owner_email, is_active, registered_at, last_connected
+                   FROM device_registrations
+                   WHERE device_id IN (SELECT value FROM json_each(?))""",
+                (json.dumps(shard_ids),)
+            )
+            rows += [dict(row) for row in cursor.fetchall()]
+    return rows
+
+
+def get_devices_by_owners(emails: List[str]) -> List[Dict]:
+    """Active devices of many owners in one indexed query (per shard, via the owner index)"""
+    if registry.is_sharded():
+        wanted = set(emails)
+        return [
+            {key: row[key] for key in ("device_id", "owner_email", "registered_at", "last_connected")}
+            for row in get_devices_by_ids(registry.owned_device_ids(emails))
+            if row["is_active"] and row["owner_email"] in wanted
+        ]
+    with registry.get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            """SELECT device_id, owner_email, registered_at, last_connected
+               FROM device_registrations
+               WHERE owner_email IN (SELECT value FROM json_each(?)) AND is_active = 1""",
+            (json.dumps(emails),)
+        )
+        return [dict(row) for row in cursor.fetchall()]
+
+
+async def ais_device_registered(device_id: str) -> bool:
+    return await REGISTRY_EXECUTOR.run(registry.is_device_registered, device_id)
+
+async def aget_device_owner(device_id: str) -> Optional[str]:
+    return await REGISTRY_EXECUTOR.run(registry.get_device_owner, device_id)
+
+async def aregister_device(device_id: str, owner_email: str, firebase_url: str) -> Dict:
+    return await REGISTRY_EXECUTOR.run(registry.register_device, device_id, owner_email, firebase_url)
+
+async def adisconnect_device(device_id: str, owner_email: str) -> Dict:
+    return await REGISTRY_EXECUTOR.run(registry.disconnect_device, device_id, owner_email)
+
+async def aget_user_devices(owner_email: str) -> List[Dict]:
+    return await REGISTRY_EXECUTOR.run(registry.get_user_devices, owner_email)
+
+async def aupdate_last_connected(device_id: str) -> None:
+    await REGISTRY_EXECUTOR.run(registry.update_last_connected, device_id)
+
+async def aget_device_info(device_id: str) -> Optional[Dict]:
+    return await REGISTRY_EXECUTOR.run(registry.get_device_info, device_id)
+
+async def aget_connection_history(device_id: str, limit: int = 10) -> List[Dict]:
+    return await REGISTRY_EXECUTOR.run(get_connection_history, device_id, limit)
+
+async def acleanup_old_connections(days: int = 90) -> int:
+    return await REGISTRY_EXECUTOR.run(registry.cleanup_old_connections, days)
+
+async def aget_devices_by_ids(device_ids: List[str]) -> List[Dict]:
+    return await REGISTRY_EXECUTOR.run(get_devices_by_ids, device_ids)
+
+async def aget_devices_by_owners(emails: List[str]) -> List[Dict]:
+    return await REGISTRY_EXECUTOR.run(get_devices_by_owners, emails)
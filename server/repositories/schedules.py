@@ -0,0 +1,153 @@
+"""
+Schedule Repository
+Blocking schedule queries plus async wrappers that run on the schedules DB executor.
+Reads use the cached WAL connection; writes are queued to the file's writer.
+"""
+import sqlite3
+from typing import Dict, List, Optional
+from database import device_connection, device_db_writer
+from db_executor import SCHEDULES_EXECUTOR
+
+
+def insert_schedule(device_id: str, container_id: int, name: str, time: str,
+                    days: str, quantity: int) -> int:
+    """Insert a schedule and return its new ID"""
+    def insert(conn):
+        cursor = conn.execute(
+            "INSERT INTO schedules (device_id, container_id, name, time, days, quantity) VALUES (?, ?, ?, ?, ?, ?)",
+            (device_id, container_id, name, time, days, quantity)
+        )
+        return cursor.lastrowid
+
+    return device_db_writer(device_id).write(insert)
+
+
+def list_container_schedules(device_id: str, container_id: int) -> List[Dict]:
+    """All schedules for one container, ordered by time"""
+    with device_connection(device_id) as conn:
+        cursor = conn.execute(
+            "SELECT id, name, time, days, quantity FROM schedules WHERE device_id = ? AND container_id = ? ORDER BY time ASC",
+            (device_id, container_id),
+        )
+        return [
+            {
+                "id": row[0],
+                "name": row[1],
+                "time": row[2],
+                "days": row[3],
+                "quantity": row[4],
+            }
+            for row in cursor.fetchall()
+        ]
+
+
+def get_schedule(device_id: str, schedule_id: int) -> Optional[Dict]:
+    """A single schedule by ID, or None"""
+    with device_connection(device_id) as conn:
+        cursor = conn.cursor()
+        cursor.row_factory = sqlite3.Row
+        row = cursor.execute(
+            "SELECT * FROM schedules WHERE id = ? AND device_id = ?", (schedule_id, device_id)
+        ).fetchone()
+        if not row:
+            return None
+        return {
+            "id": row["id"],
+            "container_id": row["container_id"],
+            "name": row["name"],
+            "time": row["time"],
+            "days": row["days"],
+            "quantity": row["quantity"],
+        }
+
+
+def update_schedule(device_id: str, schedule_id: int, container_id: int, name: str,
+                    time: str, days: str, quantity: int) -> bool:
+    """
+    Update a schedule. A container_id of 0 keeps the existing container.
+    Returns False if the schedule does not exist.
+    """
+    def update(conn):
+        target = container_id
+        if target == 0:
+            existing = conn.execute(
+                "SELECT container_id FROM schedules WHERE id = ? AND device_id = ?", (schedule_id, device_id)
+            ).fetchone()
+            if not existing:
+                return False
+            target = existing[0]
+
+        result = conn.execute(
+            "UPDATE schedules SET container_id = ?, name = ?, time = ?, days = ?, quantity = ? WHERE id = ? AND device_id = ?",
+            (target, name, time, days, quantity, schedule_id, device_id)
+        )
+        return result.rowcount > 0
+
+    return device_db_writer(device_id).write(update)
+
+
+def delete_schedule(device_id: str, schedule_id: int) -> bool:
+    """Delete a schedule. Returns False if it did not exist."""
+    return device_db_writer(device_id).write(lambda conn: conn.execute(
+        "DELETE FROM schedules WHERE id = ? AND device_id = ?", (schedule_id, device_id)
+    ).rowcount > 0)
+
+
+def delete_container_schedules(device_id: str, container_id: int) -> int:
+    """Delete every schedule of a container and return how many were removed"""
+    return device_db_writer(device_id).write(lambda conn: conn.execute(
+        "DELETE FROM schedules WHERE device_id = ? AND container_id = ?", (device_id, container_id)
+    ).rowcount)
+
+
+def list_all_schedules(device_id: str) -> List[Dict]:
+    """All schedules across containers"""
+    with device_connection(device_id) as conn:
+        cursor = conn.execute(
+            "SELECT id, container_id, name, time, days, quantity FROM schedules WHERE device_id = ? ORDER BY container_id, time ASC",
+            (device_id,)
+        )
+        return [
+            {
+                "id": row[0],
+                "container_id": row[1],
+                "name": row[2],
+                "time": row[3],
+                "days": row[4],
+                "quantity": row[5],
+            }
+            for row in cursor.fetchall()
+        ]
+
+
+def list_dispatch_rows(device_id: str) -> List[tuple]:
+    """Raw (id, name, time, days, container_id, quantity) rows for the scheduler"""
+    with device_connection(device_id) as conn:
+        return conn.execute(
+            "SELECT id, name, time, days, container_id, quantity FROM schedules WHERE device_id = ?",
+            (device_id,)
+        ).fetchall()
+
+
+# ---- Async API (used by routes) ----
+
+async def ainsert_schedule(*args) -> int:
+    return await SCHEDULES_EXECUTOR.run(insert_schedule, *args)
+
+async def alist_container_schedules(device_id: str, container_id: int) -> List[Dict]:
+    return await SCHEDULES_EXECUTOR.run(list_container_schedules, device_id, container_id)
+
+async def aget_schedule(device_id: str, schedule_id: int) -> Optional[Dict]:
+    return await SCHEDULES_EXECUTOR.run(get_schedule, device_id, schedule_id)
+
+async def aupdate_schedule(*args) -> bool:
+    return await SCHEDULES_EXECUTOR.run(update_schedule, *args)
+
+async def adelete_schedule(device_id: str, schedule_id: int) -> bool:
+    return await SCHEDULES_EXECUTOR.run(delete_schedule, device_id, schedule_id)
+
+async def adelete_container_schedules(device_id: str, container_id: int) -> int:
+    return await SCHEDULES_EXECUTOR.run(delete_container_schedules, device_id, container_id)
+
+async def alist_all_schedules(device_id: str) -> List[Dict]:
+    return await SCHEDULES_EXECUTOR.run(list_all_schedules, device_id)
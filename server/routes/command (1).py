@@ -1,4 +1,4 @@
-from firebase import get_command_ref
+from lazy_firebase import get_command_ref
 
 def send_command(command_data: dict) -> bool:
     """
@@ -1,14 +1,73 @@
-from fastapi import APIRouter, Body
+from typing import Optional
+from fastapi import APIRouter, Body, HTTPException
+from pydantic import BaseModel, field_validator
+from starlette.concurrency import run_in_threadpool
 from context import firebase_config_store
+import device_settings
+import schedule_plan
+import re
 
 router = APIRouter()
 
+EMAIL_REGEX = re.compile(r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$')
+
+class SettingsUpdate(BaseModel):
+    email: str
+    timezone: Optional[str] = None
+    dispensing_message: Optional[str] = None
+    notify_dispensing: Optional[bool] = None
+    notify_taken: Optional[bool] = None
+    notify_errors: Optional[bool] = None
+    notify_low_stock: Optional[bool] = None
+    quiet_start: Optional[str] = None  # "HH:MM", null together with quiet_end to disable
+    quiet_end: Optional[str] = None
+
+    @field_validator('email')
+    @classmethod
+    def validate_email(cls, v: str) -> str:
+        if not EMAIL_REGEX.match(v):
+            raise ValueError('Invalid email format')
+        return v.lower()
+
+def get_device_id_or_fail():
+    device_id = firebase_config_store.get("device_id")
+    if not device_id:
+        raise HTTPException(status_code=400, detail="❌ No device_id found. Please scan QR code.")
+    return device_id
+
 @router.post("/update_dispensing_message", summary="Update dispensing Pushbullet message")
 def update_dispensing_message(
     dispensing_message: str = Body(..., embed=True),
 ):
     """
-    Saves the custom 'dispensing_message' into memory (or your DB).
+    Saves the custom 'dispensing_message' in the device's settings.
     """
-    firebase_config_store["dispensing_message"] = dispensing_message
+    device_id = get_device_id_or_fail()
+    device_settings.update_settings(device_id, dispensing_message=dispensing_message)
     return {"status": "ok"}
+
+@router.get("/settings", summary="Get device settings")
+async def get_settings(email: str):
+    """Current settings of the configured device - email required as query parameter"""
+    device_id = get_device_id_or_fail()
+    settings = await run_in_threadpool(device_settings.get_settings, device_id)
+    return settings.to_dict()
+
+@router.patch("/settings", summary="Update device settings")
+async def update_settings(update: SettingsUpdate):
+    """
+    Change any subset of the device's settings; fields left out keep
+    their value. Email is validated by middleware
+    """
+    device_id = get_device_id_or_fail()
+    changes = update.model_dump(exclude_unset=True, exclude={"email"})
+    try:
+        settings = await run_in_threadpool(device_settings.update_settings, device_id, **changes)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    if "timezone" in changes:
+        # Fire instants are precomputed per timezone - rebuild them
+        schedule_plan.invalidate(device_id)
+    print(f"⚙️ Settings for {device_id} updated: {', '.join(changes) or 'no changes'}")
+    return settings.to_dict()
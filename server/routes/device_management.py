@@ -3,9 +3,13 @@ Device Management Routes
 API endpoints for device registration and management
 """
 from fastapi import APIRouter, HTTPException
-from pydantic import BaseModel, field_validator
-from typing import List, Dict
-import device_registry as registry
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field, field_validator
+from typing import List, Dict, Optional
+from repositories import registry as registry_repo
+from routes.matched import scheduler_health
+import health_monitor
+import json
 import re
 
 router = APIRouter(prefix="/device", tags=["Device Management"])
@@ -35,13 +39,140 @@ class DeviceCheckRequest(BaseModel):
             raise ValueError('Invalid email format')
         return v.lower()
 
+# Bulk lookups: larger lists must be streamed, and streams query in chunks
+MAX_BULK_ITEMS = 10000
+MAX_INLINE_ITEMS = 1000
+BULK_CHUNK_SIZE = 500
+
+def mask_email(email: Optional[str]) -> Optional[str]:
+    if not email or "@" not in email:
+        return None
+    return email[:3] + "***@" + email.split('@')[1]
+
+class BulkStatusRequest(BaseModel):
+    email: str
+    device_ids: List[str] = Field(min_length=1, max_length=MAX_BULK_ITEMS)
+    stream: bool = False
+
+    @field_validator('email')
+    @classmethod
+    def validate_email(cls, v: str) -> str:
+        if not EMAIL_REGEX.match(v):
+            raise ValueError('Invalid email format')
+        return v.lower()
+
+class BulkOwnershipRequest(BaseModel):
+    email: str
+    emails: List[str] = Field(min_length=1, max_length=MAX_BULK_ITEMS)
+    stream: bool = False
+
+    @field_validator('email')
+    @classmethod
+    def validate_email(cls, v: str) -> str:
+        if not EMAIL_REGEX.match(v):
+            raise ValueError('Invalid email format')
+        return v.lower()
+
+    @field_validator('emails')
+    @classmethod
+    def validate_emails(cls, v: List[str]) -> List[str]:
+        for email in v:
+            if not EMAIL_REGEX.match(email):
+                raise ValueError(f'Invalid email format: {email}')
+        return [email.lower() for email in v]
+
+def _device_status(device_id: str, row: Optional[Dict], requester: str, health: Dict) -> Dict:
+    if not row:
+        registration = "unregistered"
+    else:
+        registration = "active" if row["is_active"] else "disconnected"
+    active = registration == "active"
+    return {
+        "device_id": device_id,
+        "registration": registration,
+        "owner": mask_email(row["owner_email"]) if active else None,
+        "is_owner": active and row["owner_email"] == requester,
+        "last_connected": row["last_connected"] if row else None,
+        "scheduler": health[device_id],
+    }
+
+async def _status_chunk(device_ids: List[str], requester: str) -> List[Dict]:
+    rows = {row["device_id"]: row for row in await registry_repo.aget_devices_by_ids(device_ids)}
+    health = scheduler_health(device_ids)
+    return [_device_status(device_id, rows.get(device_id), requester, health) for device_id in device_ids]
+
+async def _owner_chunk(emails: List[str]) -> List[Dict]:
+    owned = {email: [] for email in emails}
+    rows = await registry_repo.aget_devices_by_owners(emails)
+    health = scheduler_health([row["device_id"] for row in rows])
+    for row in rows:
+        owned[row["owner_email"]].append({
+            "device_id": row["device_id"],
+            "registered_at": row["registered_at"],
+            "last_connected": row["last_connected"],
+            "scheduler": health[row["device_id"]],
+        })
+    for devices in owned.values():
+        devices.sort(key=lambda device: device["last_connected"] or "", reverse=True)
+    return [{"email": email, "device_count": len(devices), "devices": devices} for email, devices in owned.items()]
+
+def _ndjson_stream(items: List, fetch_chunk):
+    """One JSON object per line, querying BULK_CHUNK_SIZE items at a time"""
+    async def generate():
+        for start in range(0, len(items), BULK_CHUNK_SIZE):
+            for result in await fetch_chunk(items[start:start + BULK_CHUNK_SIZE]):
+                yield json.dumps(result, default=str) + "\n"
+    return StreamingResponse(generate(), media_type="application/x-ndjson")
+
+def _require_stream(count: int):
+    if count > MAX_INLINE_ITEMS:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Lists over {MAX_INLINE_ITEMS} items must use stream=true"
+        )
+
+@router.post("/bulk/status")
+async def bulk_device_status(request: BulkStatusRequest):
+    """
+    Registration state, masked owner, last_connected and scheduler health
+    for many devices at once
+    """
+    device_ids = list(dict.fromkeys(request.device_ids))
+    try:
+        if request.stream:
+            return _ndjson_stream(device_ids, lambda chunk: _status_chunk(chunk, request.email))
+        _require_stream(len(device_ids))
+        devices = await _status_chunk(device_ids, request.email)
+        return {"device_count": len(devices), "devices": devices}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to get device status: {str(e)}")
+
+@router.post("/bulk/ownership")
+async def bulk_device_ownership(request: BulkOwnershipRequest):
+    """
+    Active devices owned by each of many emails
+    """
+    emails = list(dict.fromkeys(request.emails))
+    try:
+        if request.stream:
+            return _ndjson_stream(emails, _owner_chunk)
+        _require_stream(len(emails))
+        owners = await _owner_chunk(emails)
+        return {"owner_count": len(owners), "owners": owners}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to get device ownership: {str(e)}")
+
 @router.post("/disconnect")
-def disconnect_device(request: DeviceDisconnectRequest):
+async def disconnect_device(request: DeviceDisconnectRequest):
     """
     Disconnect a device from a user account
     """
     try:
-        result = registry.disconnect_device(request.device_id, request.owner_email)
+        result = await registry_repo.adisconnect_device(request.device_id, request.owner_email)
         
         if not result["success"]:
             raise HTTPException(
@@ -50,7 +181,7 @@ def disconnect_device(request: DeviceDisconnectRequest):
             )
         
         # NEW: Clear server config if this is the currently connected device
-        from context import firebase_config_store, qr_state
+        from context import firebase_config_store, qr_state, persist_context
         from routes.matched import set_firebase_ready
         
         if firebase_config_store.get("device_id") == request.device_id:
@@ -59,10 +190,12 @@ def disconnect_device(request: DeviceDisconnectRequest):
             firebase_config_store.update({})
             qr_state["received"] = False
             set_firebase_ready(False)
+            persist_context()
+            health_monitor.request_refresh()
             
             # Reset Firebase connection
             try:
-                from firebase import reset_firebase
+                from lazy_firebase import reset_firebase
                 reset_firebase()
                 print("✅ Firebase connection reset")
             except Exception as e:
@@ -80,14 +213,14 @@ def disconnect_device(request: DeviceDisconnectRequest):
         raise HTTPException(status_code=500, detail=f"Failed to disconnect device: {str(e)}")
 
 @router.post("/check_access")
-def check_device_access(request: DeviceCheckRequest):
+async def check_device_access(request: DeviceCheckRequest):
     """
     Check if a user can access a device
     Used before allowing QR code connection
     """
     try:
         # Check if device is already registered
-        is_registered = registry.is_device_registered(request.device_id)
+        is_registered = await registry_repo.ais_device_registered(request.device_id)
         
         if not is_registered:
             # Device is available
@@ -98,7 +231,7 @@ def check_device_access(request: DeviceCheckRequest):
             }
         
         # Check ownership
-        owner = registry.get_device_owner(request.device_id)
+        owner = await registry_repo.aget_device_owner(request.device_id)
         
         if owner == request.email:
             # User owns this device
@@ -120,12 +253,12 @@ def check_device_access(request: DeviceCheckRequest):
         raise HTTPException(status_code=500, detail=f"Failed to check device access: {str(e)}")
 
 @router.get("/list/{email}")
-def list_user_devices(email: str):
+async def list_user_devices(email: str):
     """
     Get all devices registered to a user
     """
     try:
-        devices = registry.get_user_devices(email)
+        devices = await registry_repo.aget_user_devices(email)
         return {
             "email": email,
             "device_count": len(devices),
@@ -135,12 +268,12 @@ def list_user_devices(email: str):
         raise HTTPException(status_code=500, detail=f"Failed to retrieve devices: {str(e)}")
 
 @router.get("/info/{device_id}")
-def get_device_info(device_id: str):
+async def get_device_info(device_id: str):
     """
     Get information about a specific device
     """
     try:
-        info = registry.get_device_info(device_id)
+        info = await registry_repo.aget_device_info(device_id)
         
         if not info:
             raise HTTPException(status_code=404, detail="Device not found or inactive")
@@ -155,12 +288,12 @@ def get_device_info(device_id: str):
         raise HTTPException(status_code=500, detail=f"Failed to get device info: {str(e)}")
 
 @router.post("/verify_ownership")
-def verify_device_ownership(request: DeviceCheckRequest):
+async def verify_device_ownership(request: DeviceCheckRequest):
     """
     Verify if a user owns a specific device
     """
     try:
-        owner = registry.get_device_owner(request.device_id)
+        owner = await registry_repo.aget_device_owner(request.device_id)
         
         if not owner:
             return {
@@ -179,43 +312,29 @@ def verify_device_ownership(request: DeviceCheckRequest):
         raise HTTPException(status_code=500, detail=f"Failed to verify ownership: {str(e)}")
 
 @router.get("/connection_history/{device_id}")
-def get_connection_history(device_id: str, limit: int = 10):
+async def get_connection_history(device_id: str, limit: int = 10):
     """
     Get connection history for a device (for debugging/audit)
     """
     try:
-        from device_registry import get_db_connection
+        rows = await registry_repo.aget_connection_history(device_id, limit)
         
-        with get_db_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                """SELECT action, email, timestamp, success, notes
-                   FROM connection_history
-                   WHERE device_id = ?
-                   ORDER BY timestamp DESC
-                   LIMIT ?""",
-                (device_id, limit)
-            )
-            
-            history = []
-            for row in cursor.fetchall():
-                history.append({
-                    "action": row['action'],
-                    "email": row['email'][:3] + "***@" + row['email'].split('@')[1],
-                    "timestamp": row['timestamp'],
-                    "success": bool(row['success']),
-                    "notes": row['notes']
-                })
-            
-            return {
-                "device_id": device_id,
-                "history": history
-            }
+        history = []
+        for row in rows:
+            history.append({
+                **row,
+                "email": row['email'][:3] + "***@" + row['email'].split('@')[1]
+            })
+        
+        return {
+            "device_id": device_id,
+            "history": history
+        }
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to get connection history: {str(e)}")
 
 @router.post("/admin/cleanup")
-def cleanup_old_devices(days: int = 90, admin_key: str = ""):
+async def cleanup_old_devices(days: int = 90, admin_key: str = ""):
     """
     Admin endpoint to clean up old inactive devices
     Requires admin authentication key
@@ -225,7 +344,7 @@ def cleanup_old_devices(days: int = 90, admin_key: str = ""):
         raise HTTPException(status_code=403, detail="Unauthorized")
     
     try:
-        deleted = registry.cleanup_old_connections(days)
+        deleted = await registry_repo.acleanup_old_connections(days)
         return {
             "message": f"Cleaned up {deleted} old device registrations",
             "deleted_count": deleted
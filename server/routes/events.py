@@ -0,0 +1,86 @@
+"""
+Device Event Routes
+Server-sent event stream of dispensing and history events for one device
+"""
+import asyncio
+import json
+from typing import Optional
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from repositories import registry as registry_repo
+import event_stream
+
+router = APIRouter(tags=["Events"])
+
+KEEPALIVE_SECONDS = 15
+RETRY_MS = 3000
+
+
+def format_event(event) -> str:
+    return f"id: {event['id']}\nevent: {event['event']}\ndata: {json.dumps({**event['data'], 'timestamp': event['timestamp']})}\n\n"
+
+
+@router.get("/events/{device_id}")
+async def device_events(device_id: str, request: Request, email: str,
+                        last_event_id: Optional[int] = None):
+    """
+    Live dispense-fired, command-delivered, medicine-taken, inventory and
+    error events.
+    Reconnecting clients resume after the Last-Event-ID header (or
+    ?last_event_id=); a "resync" event means some events were lost and
+    state should be re-fetched once.
+    """
+    owner = await registry_repo.aget_device_owner(device_id)
+    if not owner:
+        raise HTTPException(status_code=404, detail="Device not found or inactive")
+    if owner != email.lower().strip():
+        raise HTTPException(status_code=403, detail="Access denied: You don't own this device")
+
+    header_id = request.headers.get("last-event-id")
+    if header_id:
+        try:
+            last_event_id = int(header_id)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid Last-Event-ID")
+
+    # Subscribe before reading the log so nothing falls between replay and live events
+    subscription = event_stream.subscribe(device_id)
+    missed, gap = [], False
+    if last_event_id is not None:
+        try:
+            missed, gap = await run_in_threadpool(event_stream.replay, device_id, last_event_id)
+        except Exception:
+            event_stream.unsubscribe(subscription)
+            raise
+    replayed_through = missed[-1]["id"] if missed else 0
+
+    async def stream():
+        try:
+            yield f"retry: {RETRY_MS}\n\n"
+            if gap:
+                yield f"event: resync\ndata: {json.dumps({'device_id': device_id})}\n\n"
+            for event in missed:
+                yield format_event(event)
+            while True:
+                try:
+                    event = await asyncio.wait_for(subscription.queue.get(), KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        break
+                    yield ": keepalive\n\n"
+                    continue
+                if event["id"] <= replayed_through:
+                    continue  # already sent in the replay
+                yield format_event(event)
+                if subscription.overflowed and subscription.queue.empty():
+                    # Too slow to keep up; the client reconnects and resumes from the log
+                    break
+        finally:
+            event_stream.unsubscribe(subscription)
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
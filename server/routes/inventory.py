@@ -0,0 +1,101 @@
+"""
+Inventory Routes
+Refills, per-container pill counts and days-until-empty forecasts
+"""
+import re
+from typing import Optional
+from fastapi import APIRouter, HTTPException
+from pydantic import BaseModel, field_validator
+from starlette.concurrency import run_in_threadpool
+from context import firebase_config_store
+from db_executor import SCHEDULES_EXECUTOR
+from repositories import inventory as inventory_repo
+import event_stream
+import inventory
+
+router = APIRouter(tags=["Inventory"])
+
+EMAIL_REGEX = re.compile(r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$')
+
+
+class RefillRequest(BaseModel):
+    email: str
+    container_id: int
+    pills: int
+    set_total: bool = False  # replace the count instead of adding to it
+    low_stock_threshold: Optional[int] = None
+
+    @field_validator('email')
+    @classmethod
+    def validate_email(cls, v: str) -> str:
+        if not EMAIL_REGEX.match(v):
+            raise ValueError('Invalid email format')
+        return v.lower()
+
+
+def get_device_id_or_fail():
+    device_id = firebase_config_store.get("device_id")
+    if not device_id:
+        raise HTTPException(status_code=400, detail="❌ No device_id found. Please scan QR code.")
+    return device_id
+
+
+@router.post("/inventory/refill")
+async def refill_container(request: RefillRequest):
+    """
+    Record a refill - adds pills to the container, or sets the count
+    when set_total is true. Email is validated by middleware
+    """
+    device_id = get_device_id_or_fail()
+    if request.container_id <= 0:
+        raise HTTPException(status_code=400, detail="❌ Invalid container_id")
+    if request.pills < 0 or (request.pills == 0 and not request.set_total):
+        raise HTTPException(status_code=400, detail="❌ pills must be positive")
+    if request.low_stock_threshold is not None and request.low_stock_threshold < 0:
+        raise HTTPException(status_code=400, detail="❌ low_stock_threshold cannot be negative")
+
+    item = await inventory_repo.arefill(
+        device_id, request.container_id, request.pills,
+        set_total=request.set_total, low_stock_threshold=request.low_stock_threshold
+    )
+    await run_in_threadpool(event_stream.publish, device_id, event_stream.INVENTORY_CHANGED, item)
+    print(f"💊 Container {request.container_id} refilled: {item['pills']} pill(s)")
+    return {"status": "✅ Inventory updated", **item}
+
+
+@router.get("/inventory")
+async def get_inventory(email: str):
+    """Pill counts for every tracked container - email required as query parameter"""
+    device_id = get_device_id_or_fail()
+    return {"device_id": device_id, "containers": await inventory_repo.alist_inventory(device_id)}
+
+
+@router.get("/inventory/forecast")
+async def get_inventory_forecast(email: str):
+    """
+    Days until each tracked container runs out, from its pill count and
+    its schedules - email required as query parameter
+    """
+    device_id = get_device_id_or_fail()
+    forecasts = await SCHEDULES_EXECUTOR.run(inventory.forecast_device, device_id)
+    for forecast in forecasts:
+        forecast["low_stock"] = forecast["pills"] <= forecast["low_stock_threshold"]
+    return {"device_id": device_id, "containers": forecasts}
+
+
+@router.get("/inventory/events")
+async def get_inventory_events(email: str, container_id: Optional[int] = None,
+                               limit: int = inventory_repo.INVENTORY_EVENTS_LIMIT):
+    """Recent refills, newest first - email required as query parameter"""
+    device_id = get_device_id_or_fail()
+    limit = max(1, min(limit, inventory_repo.INVENTORY_EVENTS_LIMIT))
+    return await inventory_repo.alist_events(device_id, container_id, limit)
+
+
+@router.delete("/inventory/{container_id}")
+async def stop_tracking_container(container_id: int, email: str):
+    """Stop tracking a container's pills - email required as query parameter"""
+    device_id = get_device_id_or_fail()
+    if not await inventory_repo.aremove_container(device_id, container_id):
+        raise HTTPException(status_code=404, detail="❌ Container is not tracked")
+    return {"status": "✅ Container no longer tracked", "container_id": container_id}
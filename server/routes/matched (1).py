@@ -1,19 +1,30 @@
-import datetime
+import heapq
+import itertools
+import os
 import time
 import threading
-import sqlite3
-import pytz
-from firebase import is_firebase_initialized
-from database import get_db_connection_for_device, close_db_connection
-from context import selected_timezone, set_selected_timezone, firebase_config_store
+from lazy_firebase import is_firebase_initialized
+from repositories import schedules as schedule_repo
+from db_executor import SCHEDULES_EXECUTOR
+from dispatch_executor import dispatcher
+from context import firebase_config_store
+import device_settings
+import event_stream
+import fire_log
+import inventory
+import schedule_plan
+import scheduler_lease
+import profiling
 from fastapi import HTTPException
 from routes.command import send_command
 from routes.notification import send_dispensing_notification
 
-triggered_schedules = {}
+dispatched_count = 0
+_count_lock = threading.Lock()
 schedule_thread_started = False
-is_dispensing = False
 firebase_ready = False
+# Wakes the scheduler as soon as a device becomes ready (QR scan or restore)
+firebase_ready_event = threading.Event()
 
 def set_firebase_ready(ready: bool):
     """
@@ -22,11 +33,13 @@ def set_firebase_ready(ready: bool):
     global firebase_ready
     firebase_ready = ready
     if ready:
+        firebase_ready_event.set()
         print("🔥 Firebase is now ready for commands!")
     else:
+        firebase_ready_event.clear()
         print("⏳ Firebase not ready - waiting for QR code configuration...")
 
-def get_device_conn():
+def get_device_id():
     required = ["firebase_url", "device_id", "auth_token"]
     for key in required:
         if key not in firebase_config_store:
@@ -34,112 +47,290 @@ def get_device_conn():
                 status_code=500,
                 detail=f"❌ firebase_config_store missing keys: {key}"
             )
-    return get_db_connection_for_device(
-        firebase_config_store["device_id"],
-        firebase_config_store["firebase_url"],
-        firebase_config_store["auth_token"]
+    return firebase_config_store["device_id"]
+
+FIRE_LOG_PRUNE_INTERVAL = 3600
+# The loop ticks at least every 10s; a heartbeat older than this means it is stuck or dead
+SCHEDULER_STALE_SECONDS = 30
+last_tick = 0.0
+
+# A failed delivery is retried with doubling backoff while it is still inside
+# the catch-up grace window; after the last attempt the dose is reported missed
+DISPATCH_RETRY_SECONDS = float(os.environ.get("DISPATCH_RETRY_SECONDS", "30"))
+DISPATCH_MAX_ATTEMPTS = int(os.environ.get("DISPATCH_MAX_ATTEMPTS", "4"))
+# Heap of (retry_at, seq, device_id, occurrence, attempt), held by the leader only
+_retries = []
+_retry_lock = threading.Lock()
+_retry_seq = itertools.count()
+
+def _push_retry(device_id: str, occurrence, attempt: int, retry_at: float) -> bool:
+    """Queue an attempt at retry_at; False if that is past the grace window"""
+    if retry_at - occurrence.fire_at > fire_log.CATCH_UP_GRACE_SECONDS:
+        return False
+    with _retry_lock:
+        heapq.heappush(_retries, (retry_at, next(_retry_seq), device_id, occurrence, attempt))
+    return True
+
+def schedule_retry(device_id: str, occurrence, attempt: int):
+    """Queue the next delivery attempt; returns its delay, or None when out of attempts"""
+    delay = DISPATCH_RETRY_SECONDS * 2 ** (attempt - 1)
+    if attempt >= DISPATCH_MAX_ATTEMPTS or not _push_retry(device_id, occurrence, attempt + 1, time.time() + delay):
+        return None
+    return delay
+
+def requeue_retry(device_id: str, occurrence, attempt: int) -> bool:
+    """Hold a retry for a device that is not the active one; False once it is too late"""
+    return _push_retry(device_id, occurrence, attempt, time.time() + DISPATCH_RETRY_SECONDS)
+
+def pop_due_retries(now: float):
+    due = []
+    with _retry_lock:
+        while _retries and _retries[0][0] <= now:
+            _, _, device_id, occurrence, attempt = heapq.heappop(_retries)
+            due.append((device_id, occurrence, attempt))
+    return due
+
+def next_retry_at():
+    with _retry_lock:
+        return _retries[0][0] if _retries else None
+
+def clear_retries():
+    with _retry_lock:
+        _retries.clear()
+
+def load_dispatch_rows(device_id: str):
+    return SCHEDULES_EXECUTOR.call(schedule_repo.list_dispatch_rows, device_id)
+
+def dispatch_occurrence(device_id: str, occurrence, attempt: int = 1):
+    """
+    Claim one occurrence and queue its delivery on the container's dispatch lane.
+    Returns the delivery Future, or None if the fire log shows it was already sent.
+    """
+    if not fire_log.claim(device_id, occurrence.schedule_id, occurrence.fire_at):
+        return None
+
+    event_stream.publish(device_id, event_stream.DISPENSE_FIRED, {
+        "schedule_id": occurrence.schedule_id,
+        "container_id": occurrence.container_id,
+        "name": occurrence.name,
+        "time": occurrence.time,
+        "quantity": occurrence.quantity,
+        "occurrence_at": occurrence.fire_at,
+        "attempt": attempt,
+    })
+
+    return dispatcher.submit(
+        device_id, occurrence.container_id, deliver_occurrence, device_id, occurrence, attempt,
+        info={"schedule_id": occurrence.schedule_id, "name": occurrence.name, "occurrence_at": occurrence.fire_at}
     )
 
-def match_schedule():
-    global triggered_schedules, is_dispensing
+def report_missed(device_id: str, occurrence, attempts: int = 0):
+    """
+    Report a dose that will not be dispensed. The occurrence is claimed
+    first, so it is reported once and no catch-up dispenses it afterwards.
+    """
+    if not fire_log.claim(device_id, occurrence.schedule_id, occurrence.fire_at):
+        return
+    event_stream.publish(device_id, event_stream.DOSE_MISSED, {
+        "schedule_id": occurrence.schedule_id,
+        "container_id": occurrence.container_id,
+        "name": occurrence.name,
+        "quantity": occurrence.quantity,
+        "occurrence_at": occurrence.fire_at,
+        "attempts": attempts,
+    })
 
-    last_checked_minute = None
+def deliver_occurrence(device_id: str, occurrence, attempt: int = 1) -> bool:
+    """Push the dispense command and notify; runs on the container's lane"""
+    global dispatched_count
 
-    while True:
-        try:
-            now = datetime.datetime.now(selected_timezone)
-            current_minute = now.strftime("%Y-%m-%d %H:%M")
+    command_data = {
+        "container_id": occurrence.container_id,
+        "name": occurrence.name,
+        "days": occurrence.days,
+        "time": occurrence.time,
+        "quantity": occurrence.quantity
+    }
+    try:
+        delivered = send_command(command_data)
+    except Exception as e:
+        print(f"❌ Dispatch of schedule {occurrence.schedule_id} failed: {e}")
+        delivered = False
 
-            if current_minute == last_checked_minute:
-                time.sleep(1)
-                continue
+    if not delivered:
+        # Unclaim so the retry (or a new leader's catch-up) can claim it again
+        fire_log.release(device_id, occurrence.schedule_id, occurrence.fire_at)
+        delay = schedule_retry(device_id, occurrence, attempt)
+        if delay is not None:
+            event_stream.publish(device_id, event_stream.ERROR, {
+                "schedule_id": occurrence.schedule_id,
+                "container_id": occurrence.container_id,
+                "message": f"Failed to deliver dispense command, retrying in {delay:.0f}s",
+                "attempt": attempt,
+            })
+            return False
+        print(f"❌ Missed dose: schedule {occurrence.schedule_id} undelivered after {attempt} attempt(s)")
+        report_missed(device_id, occurrence, attempt)
+        return False
 
-            last_checked_minute = current_minute
+    with _count_lock:
+        dispatched_count += 1
+    event_stream.publish(device_id, event_stream.COMMAND_DELIVERED, {
+        "schedule_id": occurrence.schedule_id,
+        "container_id": occurrence.container_id,
+        "name": occurrence.name,
+        "quantity": occurrence.quantity,
+    })
+    # The dose is out; a notification failure must not release the claim
+    default_msg = "Time to take your medicine!"
+    send_dispensing_notification(occurrence.container_id, default_msg)
+    try:
+        inventory.apply_dispensed(device_id, occurrence.container_id, occurrence.quantity)
+    except Exception as e:
+        print(f"⚠️ Failed to update inventory for container {occurrence.container_id}: {e}")
+    return True
+
+def catch_up_missed(device_id: str, now: float) -> int:
+    """Dispatch occurrences that fell due during downtime, within the grace window"""
+    start = now - fire_log.CATCH_UP_GRACE_SECONDS
+    due = schedule_plan.occurrences_between(
+        device_id, device_settings.get_timezone_name(device_id), load_dispatch_rows(device_id), start, now
+    )
+    fired = fire_log.fired_between(device_id, start, now)
+    missed = [o for o in due if (o.schedule_id, int(o.fire_at)) not in fired]
+    if missed:
+        print(f"⏪ Catching up {len(missed)} missed dose(s) for device {device_id}")
+    return sum(1 for occurrence in missed if dispatch_occurrence(device_id, occurrence) is not None)
 
-            if is_dispensing:
-                time.sleep(1)
+def match_schedule():
+    global last_tick
+
+    caught_up_devices = set()
+    last_prune = 0.0
+    was_leader = False
+
+    while True:
+        last_tick = time.time()
+        sleep_for = 1.0
+        tick_profile = None
+        try:
+            # Every worker runs this loop; only the lease holder dispatches
+            if not scheduler_lease.maintain(last_tick):
+                if was_leader:
+                    caught_up_devices.clear()
+                    # The new leader's catch-up covers released occurrences
+                    clear_retries()
+                    was_leader = False
+                time.sleep(1.0)
                 continue
+            if not was_leader:
+                # Plans from an earlier term may predate edits made through other workers
+                schedule_plan.invalidate_local()
+                was_leader = True
 
+            # Waits stay under the renew interval so the lease never lapses while idle
             if not firebase_ready:
-                time.sleep(10)
+                firebase_ready_event.wait(scheduler_lease.SCHEDULER_LEASE_RENEW)
                 continue
                 
             if not is_firebase_initialized():
-                time.sleep(10)
+                time.sleep(scheduler_lease.SCHEDULER_LEASE_RENEW)
                 continue
 
-            current_time = now.strftime("%I:%M %p")
-            current_day = now.strftime("%a")
+            if profiling.tick_requested and profiling.take_tick_request():
+                tick_profile = profiling.begin()
 
-            conn = get_device_conn()
-            try:
-                cursor = conn.execute(
-                    "SELECT id, name, time, days, container_id, quantity FROM schedules"
-                )
-                schedules = cursor.fetchall()
-                
-                for sid, med_name, time_str, days_str, container_id, quantity in schedules:
-                    try:
-                        formatted = datetime.datetime.strptime(time_str, "%I:%M %p").strftime("%I:%M %p")
-                        days_list = [d.strip().capitalize() for d in days_str.split(",")] if days_str else []
-                        qty = int(quantity)
-                    except Exception as e:
-                        continue
-                
-                    if current_day in days_list and formatted == current_time:
-                        if triggered_schedules.get(sid):
-                            continue
-                    
-                        is_dispensing = True
-                        command_data = {
-                            "container_id": container_id,
-                            "name": med_name,
-                            "days": days_list,
-                            "time": formatted,
-                            "quantity": qty 
-                        }
-                        if send_command(command_data):
-                            triggered_schedules[sid] = True
-                            default_msg = "Time to take your medicine!"
-                            send_dispensing_notification(container_id, default_msg)
-                    
-                        is_dispensing = False
-            
-            finally:
-                close_db_connection(conn)
-
-        except Exception:
-            is_dispensing = False
-
-        time.sleep(1)
-
-def reset_triggered_schedules():
-    global triggered_schedules
-    while True:
-        try:
-            now = datetime.datetime.now(selected_timezone)
-            if now.strftime("%H:%M") == "00:00":
-                triggered_schedules = {}
-        except Exception:
-            pass
-        time.sleep(60)
+            device_id = get_device_id()
+            now = time.time()
+
+            if device_id not in caught_up_devices:
+                catch_up_missed(device_id, now)
+                caught_up_devices.add(device_id)
+
+            plan = schedule_plan.get_plan(
+                device_id, now, load_dispatch_rows, device_settings.get_timezone_name(device_id)
+            )
+
+            for occurrence in plan.pop_due(now):
+                if now - occurrence.fire_at > fire_log.CATCH_UP_GRACE_SECONDS:
+                    print(f"⚠️ Missed schedule {occurrence.schedule_id} due {now - occurrence.fire_at:.0f}s ago")
+                    report_missed(device_id, occurrence)
+                    continue
+                dispatch_occurrence(device_id, occurrence)
+
+            for retry_device, occurrence, attempt in pop_due_retries(now):
+                if retry_device == device_id:
+                    dispatch_occurrence(device_id, occurrence, attempt)
+                elif not requeue_retry(retry_device, occurrence, attempt):
+                    # Commands only reach the configured device; this one can no longer be sent
+                    print(f"❌ Missed dose: schedule {occurrence.schedule_id} of {retry_device} (device no longer active)")
+                    report_missed(retry_device, occurrence, attempt - 1)
+
+            if now - last_prune > FIRE_LOG_PRUNE_INTERVAL:
+                pruned = fire_log.prune()
+                if pruned:
+                    print(f"🧹 Pruned {pruned} old fire log entries")
+                last_prune = now
+
+            next_fire_at = min((t for t in (plan.next_fire_at, next_retry_at()) if t is not None), default=None)
+            if next_fire_at is not None:
+                sleep_for = min(1.0, max(0.05, next_fire_at - time.time()))
+
+        except Exception as e:
+            print(f"❌ Scheduler tick failed: {e}")
+        finally:
+            if tick_profile is not None:
+                profiling.finish(tick_profile, "scheduler", (time.time() - last_tick) * 1000,
+                                 device_id=firebase_config_store.get("device_id"))
+
+        time.sleep(sleep_for)
 
 def trigger_match_schedule():
     global schedule_thread_started
     if not schedule_thread_started:
+        # Try for the lease right away so health checks see a leader from the start
+        scheduler_lease.maintain()
         threading.Thread(target=match_schedule, daemon=True).start()
-        threading.Thread(target=reset_triggered_schedules, daemon=True).start()
         schedule_thread_started = True
 
+def scheduler_alive() -> bool:
+    return schedule_thread_started and time.time() - last_tick < SCHEDULER_STALE_SECONDS
+
+def scheduler_health(device_ids):
+    """
+    Scheduler state per device. Only the lease holder builds plans, so
+    other workers report the shared lease instead of pending doses.
+    """
+    lease = scheduler_lease.status()
+    # The leader renews from its loop, so a held lease means a live scheduler somewhere
+    running = lease["held"] and (scheduler_alive() if lease["leader"] else True)
+    active_device = firebase_config_store.get("device_id") if firebase_ready else None
+    plans = schedule_plan.plan_stats()
+    health = {}
+    for device_id in device_ids:
+        plan = plans.get(device_id)
+        scheduled = device_id == active_device
+        health[device_id] = {
+            "scheduled": scheduled,
+            "scheduled_here": scheduled and lease["leader"],
+            "running": running and scheduled,
+            "pending_doses": plan["pending"] if plan else (0 if lease["leader"] else None),
+            "next_fire_at": plan["next_fire_at"] if plan else None,
+        }
+    return health
+
 def get_dispensing_status():
     """
     Returns the current dispensing status.
     """
+    device_id = firebase_config_store.get("device_id")
     return {
-        "is_dispensing": is_dispensing,
+        "is_dispensing": dispatcher.is_busy(device_id),
+        "in_flight": dispatcher.device_status(device_id) if device_id else {},
         "firebase_ready": firebase_ready,
         "firebase_initialized": is_firebase_initialized(),
-        "triggered_schedules_count": len(triggered_schedules),
+        "triggered_schedules_count": dispatched_count,
+        "schedule_plans": schedule_plan.plan_stats(),
         "status_message": (
             "✅ Ready for commands"
             if firebase_ready and is_firebase_initialized()
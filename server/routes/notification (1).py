@@ -1,9 +1,10 @@
-import requests
+import functools
 import logging
+import threading
 from typing import Optional
 from context import firebase_config_store
 from datetime import datetime
-from context import selected_timezone
+import device_settings
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -13,6 +14,50 @@ PUSHBULLET_TOKEN = "o.ZTRMg7u9eNV6yxD1lvx7gegOUhVvrlRA"
 PUSHBULLET_API_URL = "https://api.pushbullet.com/v2/pushes"
 REQUEST_TIMEOUT = 10 
 
+def _requests():
+    """Import requests on first use to keep it off the cold-start path"""
+    import requests
+    return requests
+
+# Sends are synchronous, so "queued" means callers currently blocked on Pushbullet
+_stats_lock = threading.Lock()
+_stats = {"in_flight": 0, "sent": 0, "failed": 0, "suppressed": 0, "last_failure_at": None}
+
+def _tracked(kind: str):
+    """
+    Skip sends the device's settings mute (preference off or quiet hours)
+    and count in-flight, sent and failed notifications for health monitoring
+    """
+    def decorator(send):
+        @functools.wraps(send)
+        def wrapper(*args, **kwargs):
+            if not device_settings.should_notify(firebase_config_store.get("device_id"), kind):
+                logger.info(f"🔕 {kind} notification muted by device settings")
+                with _stats_lock:
+                    _stats["suppressed"] += 1
+                return False
+            with _stats_lock:
+                _stats["in_flight"] += 1
+            ok = False
+            try:
+                ok = send(*args, **kwargs)
+                return ok
+            finally:
+                with _stats_lock:
+                    _stats["in_flight"] -= 1
+                    if ok:
+                        _stats["sent"] += 1
+                    else:
+                        _stats["failed"] += 1
+                        _stats["last_failure_at"] = datetime.now().isoformat()
+        return wrapper
+    return decorator
+
+def notification_stats() -> dict:
+    with _stats_lock:
+        return dict(_stats)
+
+@_tracked("dispensing")
 def send_dispensing_notification(container_id: int, default_msg: str) -> bool:
     if not isinstance(container_id, int) or container_id <= 0:
         logger.error(f"❌ Invalid container_id: {container_id}")
@@ -28,11 +73,12 @@ def send_dispensing_notification(container_id: int, default_msg: str) -> bool:
         return False
 
     title = f"Dispensing on container {container_id}\n"
-    custom_message = firebase_config_store.get("dispensing_message", default_msg)
-    timestamp = datetime.now(selected_timezone).strftime("%d/%m/%Y %I:%M %p")
+    custom_message = device_settings.get_settings(device_id).dispensing_message or default_msg
+    timestamp = datetime.now(device_settings.get_timezone(device_id)).strftime("%d/%m/%Y %I:%M %p")
 
     body = f"Message: {custom_message}\n\n\nTime: {timestamp}"
 
+    requests = _requests()
     try:
         resp = requests.post(
             PUSHBULLET_API_URL,
@@ -71,6 +117,7 @@ def send_dispensing_notification(container_id: int, default_msg: str) -> bool:
         logger.error(f"❌ Unexpected error: {str(e)}")
         return False
 
+@_tracked("taken")
 def send_taken_notification(container_id: int, medicine_name: str, time_taken: str) -> bool:
     """Send push notification when medicine is taken"""
     device_id = firebase_config_store.get("device_id")
@@ -84,13 +131,14 @@ def send_taken_notification(container_id: int, medicine_name: str, time_taken: s
 
     title = "Medicine has been taken\n"
     default_msg = "Your medicine has been taken by the patient successfully."
-    custom_message = firebase_config_store.get("dispensing_message", default_msg)
+    custom_message = device_settings.get_settings(device_id).dispensing_message or default_msg
     
     body = f"Medicine: {medicine_name}\n"
     body += f"Container: {container_id}\n"
     body += f"Message: {custom_message}\n\n"
     body += f"Time: {time_taken}"
 
+    requests = _requests()
     try:
         resp = requests.post(
             PUSHBULLET_API_URL,
@@ -117,6 +165,7 @@ def send_taken_notification(container_id: int, medicine_name: str, time_taken: s
         logger.error(f"❌ Failed to send taken notification: {str(e)}")
         return False
 
+@_tracked("errors")
 def send_error_notification(container_id: int, error_msg: str) -> bool:
     """Send push notification when there's an error"""
     device_id = firebase_config_store.get("device_id", "Unknown")
@@ -133,6 +182,7 @@ def send_error_notification(container_id: int, error_msg: str) -> bool:
     body += f"📱 Device: {device_id}\n\n"
     body += "Please check your medicine dispenser!"
 
+    requests = _requests()
     try:
         resp = requests.post(
             PUSHBULLET_API_URL,
@@ -159,7 +209,56 @@ def send_error_notification(container_id: int, error_msg: str) -> bool:
         logger.error(f"❌ Failed to send error notification: {str(e)}")
         return False
 
+@_tracked("low_stock")
+def send_low_stock_notification(container_id: int, pills_left: int,
+                                days_left: Optional[float] = None) -> bool:
+    """Send push notification when a container is running out of pills"""
+    device_id = firebase_config_store.get("device_id")
+    if not device_id:
+        logger.warning("❌ No device_id registered — skipping low stock notification.")
+        return False
+
+    if not PUSHBULLET_TOKEN:
+        logger.warning("❌ No Pushbullet token configured — skipping low stock notification.")
+        return False
+
+    title = f"💊 Low Stock - Container {container_id}"
+    timestamp = datetime.now(device_settings.get_timezone(device_id)).strftime("%d/%m/%Y %I:%M %p")
+    body = f"Only {pills_left} pill(s) left in container {container_id}.\n"
+    if days_left is not None:
+        body += f"Estimated to run out in {days_left:.1f} day(s).\n"
+    body += f"\nTime: {timestamp}\n\n"
+    body += "Please refill your medicine dispenser."
+
+    requests = _requests()
+    try:
+        resp = requests.post(
+            PUSHBULLET_API_URL,
+            headers={
+                "Access-Token": PUSHBULLET_TOKEN,
+                "Content-Type": "application/json"
+            },
+            json={
+                "type": "note",
+                "title": title,
+                "body": body
+            },
+            timeout=REQUEST_TIMEOUT
+        )
+
+        if resp.status_code == 200:
+            logger.info(f"✅ Low stock notification sent for container {container_id}")
+            return True
+        else:
+            logger.error(f"❌ Low stock notification failed [{resp.status_code}]: {resp.text}")
+            return False
+
+    except Exception as e:
+        logger.error(f"❌ Failed to send low stock notification: {str(e)}")
+        return False
+
 def test_notification() -> bool:
+    requests = _requests()
     try:
         resp = requests.get(
             "https://api.pushbullet.com/v2/users/me",
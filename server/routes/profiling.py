@@ -0,0 +1,60 @@
+"""
+Profiling Routes
+Admin endpoints to list, download and request profiles. Only mounted
+when PROFILING_ENABLED is set; every call needs the admin key.
+"""
+from typing import Optional
+from fastapi import APIRouter, Header, HTTPException
+from fastapi.responses import FileResponse, PlainTextResponse
+from starlette.concurrency import run_in_threadpool
+import profiling
+
+router = APIRouter(prefix="/admin/profiles", tags=["Profiling"])
+
+
+def require_admin(admin_key: Optional[str]):
+    if not profiling.is_admin(admin_key):
+        raise HTTPException(status_code=403, detail="Unauthorized")
+
+
+@router.get("")
+async def list_profiles(limit: int = 50, x_admin_key: Optional[str] = Header(None)):
+    """Stored request and scheduler profiles, newest first"""
+    require_admin(x_admin_key)
+    profiles = await run_in_threadpool(profiling.list_profiles, max(1, min(limit, 500)))
+    return {"profiles": profiles, "stats": profiling.stats()}
+
+
+@router.post("/scheduler")
+async def profile_scheduler_tick(x_admin_key: Optional[str] = Header(None)):
+    """Capture the next scheduler tick on the leading worker"""
+    require_admin(x_admin_key)
+    await run_in_threadpool(profiling.arm_scheduler_tick)
+    return {"message": "Next scheduler tick will be profiled"}
+
+
+@router.get("/{profile_id}")
+async def get_profile(profile_id: str, format: str = "prof", x_admin_key: Optional[str] = Header(None)):
+    """
+    Download a profile: format=prof returns the pstats dump (open it with
+    pstats or snakeviz), format=text a cumulative-time report, format=json
+    the metadata and top functions
+    """
+    require_admin(x_admin_key)
+    if format == "text":
+        report = await run_in_threadpool(profiling.render_text, profile_id)
+        if report is None:
+            raise HTTPException(status_code=404, detail="Profile not found")
+        return PlainTextResponse(report)
+    if format == "json":
+        record = await run_in_threadpool(profiling.load_metadata, profile_id)
+        if record is None:
+            raise HTTPException(status_code=404, detail="Profile not found")
+        return record
+    if format != "prof":
+        raise HTTPException(status_code=400, detail="format must be prof, text or json")
+
+    path = profiling.profile_path(profile_id)
+    if not path:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return FileResponse(path, media_type="application/octet-stream", filename=f"{profile_id}.prof")
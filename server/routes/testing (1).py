@@ -2,7 +2,7 @@ from fastapi import APIRouter, HTTPException
 from pydantic import BaseModel, field_validator
 from routes.command import send_command
 from routes.matched import get_dispensing_status
-from firebase import is_firebase_initialized
+from lazy_firebase import is_firebase_initialized
 import routes.matched as matched
 import re
 
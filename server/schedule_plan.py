@@ -0,0 +1,198 @@
+"""
+Schedule Fire Planner
+Converts each device's schedules (local "08:00 AM" + weekdays) into UTC
+fire instants once. Within a plan window the zone's UTC offset is
+constant, so instants are plain arithmetic; the window ends at the next
+DST transition from the zone's transition table (or the horizon), and
+the plan is rebuilt only then or when schedules/timezone change.
+
+Across a transition a schedule still fires once per day: a time in the
+repeated hour of a fall-back fires only at its first occurrence, and a
+time in the hour skipped by spring-forward fires shifted forward by the
+gap (02:30 becomes 03:30), as pytz's normalize() would place it.
+"""
+import bisect
+import calendar
+import datetime
+import heapq
+import threading
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Callable, Dict, List, Optional, Tuple
+import pytz
+import shared_state
+
+PLAN_HORIZON_SECONDS = 7 * 24 * 3600
+DAY_INDEX = {"Mon": 0, "Tue": 1, "Wed": 2, "Thu": 3, "Fri": 4, "Sat": 5, "Sun": 6}
+
+
+@dataclass(order=True)
+class FireInstant:
+    fire_at: float
+    schedule_id: int = field(compare=False)
+    container_id: int = field(compare=False)
+    name: str = field(compare=False)
+    time: str = field(compare=False)
+    days: List[str] = field(compare=False)
+    quantity: int = field(compare=False)
+
+
+@lru_cache(maxsize=None)
+def transition_epochs(tz_name: str) -> Tuple[float, ...]:
+    """UTC epoch seconds of every offset change for a zone (empty if fixed)"""
+    tz = pytz.timezone(tz_name)
+    times = getattr(tz, "_utc_transition_times", None) or []
+    # The first entry is datetime.min, a sentinel rather than a transition
+    return tuple(calendar.timegm(t.timetuple()) for t in times[1:])
+
+
+def next_transition(tz_name: str, after: float) -> Optional[float]:
+    epochs = transition_epochs(tz_name)
+    index = bisect.bisect_right(epochs, after)
+    return epochs[index] if index < len(epochs) else None
+
+
+def last_transition(tz_name: str, at: float) -> Optional[float]:
+    epochs = transition_epochs(tz_name)
+    index = bisect.bisect_right(epochs, at) - 1
+    return epochs[index] if index >= 0 else None
+
+
+def parse_schedule_row(row) -> Optional[Tuple]:
+    """(id, name, time, days, container_id, quantity) -> parsed tuple, or None if malformed"""
+    sid, med_name, time_str, days_str, container_id, quantity = row
+    try:
+        parsed = datetime.datetime.strptime(time_str, "%I:%M %p")
+        days_list = [d.strip().capitalize() for d in days_str.split(",")] if days_str else []
+        qty = int(quantity)
+    except Exception:
+        return None
+    weekdays = {DAY_INDEX[d] for d in days_list if d in DAY_INDEX}
+    return (sid, med_name, parsed.hour, parsed.minute, parsed.strftime("%I:%M %p"),
+            days_list, weekdays, container_id, qty)
+
+
+class DevicePlan:
+    """Upcoming fire instants for one device, valid until `valid_until`"""
+
+    def __init__(self, device_id: str, tz_name: str, rows: List, now: float,
+                 horizon: float = PLAN_HORIZON_SECONDS, carry: Optional[List[FireInstant]] = None):
+        self.device_id = device_id
+        self.tz_name = tz_name
+        self.built_at = now
+
+        transition = next_transition(tz_name, now)
+        self.valid_until = min(now + horizon, transition) if transition else now + horizon
+
+        tz = pytz.timezone(tz_name)
+        local_now = datetime.datetime.fromtimestamp(now, tz)
+        offset = local_now.utcoffset().total_seconds()
+        today = local_now.date()
+        # Wall times next to the last transition are ambiguous (fall back) or
+        # missing (spring forward); both resolve against the earlier offset
+        last = last_transition(tz_name, now)
+        prev_offset = datetime.datetime.fromtimestamp(last - 1, tz).utcoffset().total_seconds() if last else offset
+
+        self._heap: List[FireInstant] = list(carry or [])
+        parsed_rows = [p for p in (parse_schedule_row(r) for r in rows) if p]
+        days_ahead = int(horizon // 86400) + 1
+        for day in range(days_ahead + 1):
+            date = today + datetime.timedelta(days=day)
+            weekday = date.weekday()
+            midnight_local = calendar.timegm(date.timetuple())
+            for sid, name, hour, minute, time_str, days_list, weekdays, container_id, qty in parsed_rows:
+                if weekday not in weekdays:
+                    continue
+                wall = midnight_local + hour * 3600 + minute * 60
+                fire_at = wall - offset
+                if prev_offset > offset and wall - prev_offset < last <= fire_at:
+                    continue  # repeated hour: it fired at its first occurrence, before the transition
+                if prev_offset < offset and fire_at < last <= wall - prev_offset:
+                    fire_at = wall - prev_offset  # skipped hour: fire it shifted forward by the gap
+                if now <= fire_at < self.valid_until:
+                    self._heap.append(FireInstant(fire_at, sid, container_id, name, time_str, days_list, qty))
+        heapq.heapify(self._heap)
+
+    @property
+    def next_fire_at(self) -> Optional[float]:
+        return self._heap[0].fire_at if self._heap else None
+
+    def pop_due(self, now: float) -> List[FireInstant]:
+        due = []
+        while self._heap and self._heap[0].fire_at <= now:
+            due.append(heapq.heappop(self._heap))
+        return due
+
+    def is_stale(self, now: float) -> bool:
+        return now >= self.valid_until
+
+    def pending(self) -> int:
+        return len(self._heap)
+
+
+def occurrences_between(device_id: str, tz_name: str, rows: List,
+                        start: float, end: float) -> List[FireInstant]:
+    """All instants in [start, end], walking plan windows across DST transitions"""
+    occurrences = []
+    while start < end:
+        plan = DevicePlan(device_id, tz_name, rows, start, horizon=end - start + 1)
+        occurrences.extend(plan.pop_due(end))
+        start = plan.valid_until
+    return occurrences
+
+
+_lock = threading.Lock()
+_plans: Dict[str, DevicePlan] = {}
+
+
+def _drop(device_id: str):
+    with _lock:
+        _plans.pop(device_id, None)
+
+
+def invalidate(device_id: str):
+    """Drop a device's plan after schedule or timezone edits, in every worker"""
+    _drop(device_id)
+    shared_state.bump(f"plan:{device_id}")
+
+
+def invalidate_local():
+    """Drop every plan held by this worker (e.g. on becoming scheduler leader)"""
+    with _lock:
+        _plans.clear()
+
+
+shared_state.on_change("plan:", lambda scope: _drop(scope.split(":", 1)[1]))
+
+
+def get_plan(device_id: str, now: float, load_rows: Callable[[str], List],
+             tz_name: str) -> DevicePlan:
+    """Current plan for a device, rebuilding it only when needed"""
+    with _lock:
+        plan = _plans.get(device_id)
+    if plan is not None and plan.tz_name == tz_name and not plan.is_stale(now):
+        return plan
+
+    if plan is not None and plan.tz_name == tz_name:
+        # Window ended (DST transition or horizon): continue from its boundary
+        # so nothing between the last tick and now is skipped
+        carry = plan.pop_due(now)
+        plan = DevicePlan(device_id, tz_name, load_rows(device_id), plan.valid_until, carry=carry)
+    else:
+        plan = DevicePlan(device_id, tz_name, load_rows(device_id), now)
+    with _lock:
+        _plans[device_id] = plan
+    return plan
+
+
+def plan_stats() -> Dict:
+    with _lock:
+        return {
+            device_id: {
+                "timezone": plan.tz_name,
+                "pending": plan.pending(),
+                "next_fire_at": plan.next_fire_at,
+                "valid_until": plan.valid_until,
+            }
+            for device_id, plan in _plans.items()
+        }
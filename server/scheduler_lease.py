@@ -0,0 +1,138 @@
+"""
+Scheduler Lease
+Leader election between uvicorn workers through a lease row in the
+server state DB. Every worker serves HTTP; only the lease holder runs
+the dose scheduler and background maintenance. The holder renews the
+lease every SCHEDULER_LEASE_RENEW seconds; if it dies or stalls, another
+worker takes over once the lease expires, so failover takes at most
+SCHEDULER_LEASE_TTL + SCHEDULER_LEASE_RENEW seconds.
+
+A short overlap between an old and a new leader cannot double-dispatch:
+every dose is claimed in the shared fire log before it is sent.
+"""
+import os
+import threading
+import time
+from typing import Dict, Optional
+import state_store
+from shared_state import WORKER_ID
+
+LEASE_NAME = "scheduler"
+SCHEDULER_LEASE_TTL = float(os.environ.get("SCHEDULER_LEASE_TTL", "15"))
+SCHEDULER_LEASE_RENEW = SCHEDULER_LEASE_TTL / 3
+FAILOVER_BOUND_SECONDS = SCHEDULER_LEASE_TTL + SCHEDULER_LEASE_RENEW
+
+_lock = threading.Lock()
+_held_until = 0.0
+_token: Optional[int] = None
+_next_attempt = 0.0
+_initialized = False
+_stats = {"acquired": 0, "lost": 0}
+
+
+def _ensure_table():
+    global _initialized
+    if _initialized:
+        return
+    with state_store.transaction() as conn:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS leases (
+                name TEXT PRIMARY KEY,
+                holder TEXT NOT NULL,
+                token INTEGER NOT NULL,
+                expires_at REAL NOT NULL,
+                acquired_at REAL NOT NULL,
+                renewed_at REAL NOT NULL
+            )
+        """)
+    _initialized = True
+
+
+def maintain(now: Optional[float] = None) -> bool:
+    """
+    Acquire or renew the lease when due and report whether this worker
+    leads. Cheap to call every scheduler tick: it only touches the DB
+    once per renew interval.
+    """
+    global _held_until, _token, _next_attempt
+    now = time.time() if now is None else now
+    with _lock:
+        if now < _next_attempt:
+            return now < _held_until
+        _ensure_table()
+        expires_at = now + SCHEDULER_LEASE_TTL
+        with state_store.transaction() as conn:
+            if _token is not None and now < _held_until:
+                cursor = conn.execute(
+                    "UPDATE leases SET expires_at = ?, renewed_at = ? WHERE name = ? AND holder = ? AND token = ?",
+                    (expires_at, now, LEASE_NAME, WORKER_ID, _token)
+                )
+            else:
+                # Take the lease only if it is free, expired or already ours
+                cursor = conn.execute(
+                    """INSERT INTO leases (name, holder, token, expires_at, acquired_at, renewed_at)
+                       VALUES (?, ?, 1, ?, ?, ?)
+                       ON CONFLICT(name) DO UPDATE SET
+                       holder = excluded.holder, token = token + 1, expires_at = excluded.expires_at,
+                       acquired_at = excluded.acquired_at, renewed_at = excluded.renewed_at
+                       WHERE leases.expires_at < excluded.acquired_at OR leases.holder = excluded.holder""",
+                    (LEASE_NAME, WORKER_ID, expires_at, now, now)
+                )
+            held = cursor.rowcount == 1
+            token = None
+            if held:
+                token = conn.execute("SELECT token FROM leases WHERE name = ?", (LEASE_NAME,)).fetchone()[0]
+
+        was_leader = _token is not None
+        if held and not was_leader:
+            _stats["acquired"] += 1
+            print(f"👑 Worker {WORKER_ID} is now the scheduler leader (token {token})")
+        elif not held and was_leader:
+            _stats["lost"] += 1
+            print(f"⚠️ Worker {WORKER_ID} lost the scheduler lease")
+        _token = token
+        _held_until = expires_at if held else 0.0
+        _next_attempt = now + SCHEDULER_LEASE_RENEW
+        return held
+
+
+def is_leader() -> bool:
+    """True while this worker holds an unexpired lease (no DB access)"""
+    with _lock:
+        return _token is not None and time.time() < _held_until
+
+
+def release():
+    """Give the lease up on shutdown so another worker takes over at once"""
+    global _held_until, _token
+    with _lock:
+        if _token is None:
+            return
+        with state_store.transaction() as conn:
+            conn.execute(
+                "UPDATE leases SET expires_at = 0 WHERE name = ? AND holder = ? AND token = ?",
+                (LEASE_NAME, WORKER_ID, _token)
+            )
+        _token = None
+        _held_until = 0.0
+
+
+def status() -> Dict:
+    """Current lease holder as stored (one small read, for health checks)"""
+    _ensure_table()
+    with state_store.transaction() as conn:
+        row = conn.execute(
+            "SELECT holder, token, expires_at FROM leases WHERE name = ?", (LEASE_NAME,)
+        ).fetchone()
+    now = time.time()
+    holder, token, expires_at = row if row else (None, None, 0.0)
+    return {
+        "worker_id": WORKER_ID,
+        "leader": is_leader(),
+        "holder": holder,
+        "token": token,
+        "held": bool(row) and expires_at > now,
+        "expires_in": round(expires_at - now, 1) if row else None,
+        "failover_bound_seconds": FAILOVER_BOUND_SECONDS,
+        **_stats,
+    }
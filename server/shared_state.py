@@ -0,0 +1,113 @@
+"""
+Shared State
+Change signals between uvicorn workers. A worker that changes shared
+state bumps a version row in the server state DB; every worker polls
+that small table and runs the callbacks registered for scopes another
+worker changed, so per-process caches and the device context converge
+within one poll interval.
+"""
+import os
+import socket
+import threading
+import time
+from typing import Callable, Dict, List, Tuple
+import state_store
+
+SHARED_STATE_POLL_SECONDS = float(os.environ.get("SHARED_STATE_POLL_SECONDS", "1"))
+# Identifies this process in lease and change rows
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+_lock = threading.Lock()
+_seen: Dict[str, int] = {}
+_listeners: List[Tuple[str, Callable[[str], None]]] = []
+_thread = None
+_initialized = False
+_stats = {"polls": 0, "bumps": 0, "remote_changes": 0}
+
+
+def _ensure_table():
+    global _initialized
+    if _initialized:
+        return
+    with state_store.transaction() as conn:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS change_versions (
+                scope TEXT PRIMARY KEY,
+                version INTEGER NOT NULL,
+                changed_by TEXT,
+                changed_at REAL
+            ) WITHOUT ROWID
+        """)
+    _initialized = True
+
+
+def bump(scope: str):
+    """Tell the other workers that the state behind scope changed"""
+    _ensure_table()
+    with state_store.transaction() as conn:
+        conn.execute(
+            """INSERT INTO change_versions (scope, version, changed_by, changed_at) VALUES (?, 1, ?, ?)
+               ON CONFLICT(scope) DO UPDATE SET
+               version = version + 1, changed_by = excluded.changed_by, changed_at = excluded.changed_at""",
+            (scope, WORKER_ID, time.time())
+        )
+        version = conn.execute("SELECT version FROM change_versions WHERE scope = ?", (scope,)).fetchone()[0]
+    with _lock:
+        # Our own change is already applied locally
+        _seen[scope] = version
+        _stats["bumps"] += 1
+
+
+def on_change(prefix: str, callback: Callable[[str], None]):
+    """Run callback(scope) when another worker bumps a scope starting with prefix"""
+    with _lock:
+        _listeners.append((prefix, callback))
+
+
+def poll(notify: bool = True) -> int:
+    """Check for remote changes and run their callbacks; returns how many changed"""
+    _ensure_table()
+    with state_store.transaction() as conn:
+        rows = conn.execute("SELECT scope, version FROM change_versions").fetchall()
+    changed = []
+    with _lock:
+        for scope, version in rows:
+            if _seen.get(scope) != version:
+                _seen[scope] = version
+                changed.append(scope)
+        listeners = list(_listeners)
+        _stats["polls"] += 1
+        if notify:
+            _stats["remote_changes"] += len(changed)
+    if notify:
+        for scope in changed:
+            for prefix, callback in listeners:
+                if scope.startswith(prefix):
+                    try:
+                        callback(scope)
+                    except Exception as e:
+                        print(f"⚠️ Shared state callback for {scope} failed: {e}")
+    return len(changed)
+
+
+def _run():
+    while True:
+        time.sleep(SHARED_STATE_POLL_SECONDS)
+        try:
+            poll()
+        except Exception as e:
+            print(f"⚠️ Shared state poll failed: {e}")
+
+
+def start():
+    global _thread
+    if _thread is None:
+        # State loaded at startup is current: only later changes need callbacks
+        poll(notify=False)
+        _thread = threading.Thread(target=_run, daemon=True, name="shared-state")
+        _thread.start()
+
+
+def stats() -> Dict:
+    with _lock:
+        return {**_stats, "worker_id": WORKER_ID, "scopes": len(_seen)}
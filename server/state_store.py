@@ -0,0 +1,88 @@
+"""
+Server State Store
+Small persistent key/value store for runtime state that must survive
+restarts (device context, QR state, custom messages)
+
+Unlike the schedules and history files, the state DB is not written
+through db_writer. Its users (shared_state, scheduler_lease, fire_log,
+event_stream, device_settings) need read-then-write transactions: claim a
+fire, renew the lease, poll versions. Those run as transaction() blocks
+on one lock-guarded connection, and the lock already makes this process
+a single writer. Each transaction is a few single-row statements, so
+moving them onto a writer thread would add a thread hop to the
+scheduler tick without removing any lock contention. db_writer also
+depends on this module (through profiling and shared_state), so it
+cannot be built on top of it.
+"""
+import json
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Any, Optional
+
+DB_DIR = os.environ.get('DB_DIR', '/tmp')
+STATE_DB_PATH = os.path.join(DB_DIR, "server_state.db")
+
+_lock = threading.Lock()
+_conn: Optional[sqlite3.Connection] = None
+
+
+def _get_conn() -> sqlite3.Connection:
+    global _conn
+    if _conn is None:
+        os.makedirs(DB_DIR, exist_ok=True)
+        conn = sqlite3.connect(STATE_DB_PATH, timeout=10.0, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS runtime_state (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        conn.commit()
+        # Holds the Firebase auth token - keep it private to the server user
+        os.chmod(STATE_DB_PATH, 0o600)
+        _conn = conn
+    return _conn
+
+
+def save_state(key: str, value: Any):
+    """Persist a JSON-serialisable value under a key"""
+    with _lock:
+        conn = _get_conn()
+        conn.execute(
+            """INSERT INTO runtime_state (key, value, updated_at) VALUES (?, ?, CURRENT_TIMESTAMP)
+               ON CONFLICT(key) DO UPDATE SET value = excluded.value, updated_at = CURRENT_TIMESTAMP""",
+            (key, json.dumps(value))
+        )
+        conn.commit()
+
+
+def load_state(key: str, default: Any = None) -> Any:
+    """Load a persisted value, or the default if missing/unreadable"""
+    with _lock:
+        row = _get_conn().execute(
+            "SELECT value FROM runtime_state WHERE key = ?", (key,)
+        ).fetchone()
+    if not row:
+        return default
+    try:
+        return json.loads(row[0])
+    except ValueError:
+        return default
+
+
+@contextmanager
+def transaction():
+    """Exclusive access to the state DB connection for other state tables"""
+    with _lock:
+        conn = _get_conn()
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
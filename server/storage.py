@@ -0,0 +1,95 @@
+"""
+Storage Backends
+Maps a device to the SQLite files holding its schedules and history.
+
+- per_device: one <id>.db and one <id>_history.db per device (default)
+- sharded:    all devices spread over STORAGE_SHARDS shard_NNN.db files
+
+Both layouts use the same schema with a device_id column on every row,
+so queries are identical regardless of the backend.
+"""
+import glob
+import os
+import zlib
+from typing import List
+
+BASE_DIR = "/tmp/devices"
+os.makedirs(BASE_DIR, exist_ok=True)
+
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "per_device")
+STORAGE_SHARDS = int(os.environ.get("STORAGE_SHARDS", "16"))
+SHARD_DIR = os.environ.get("STORAGE_SHARD_DIR", os.path.join(BASE_DIR, "shards"))
+
+
+def safe_device_id(device_id: str) -> str:
+    """Device ID usable as a filename"""
+    return device_id.replace(":", "_").replace("/", "_")
+
+
+class PerDeviceBackend:
+    """One schedules file and one history file per device"""
+    name = "per_device"
+
+    def __init__(self, base_dir: str = BASE_DIR):
+        self.base_dir = base_dir
+
+    def schedules_path(self, device_id: str) -> str:
+        return os.path.join(self.base_dir, f"{safe_device_id(device_id)}.db")
+
+    def history_path(self, device_id: str) -> str:
+        return os.path.join(self.base_dir, f"{safe_device_id(device_id)}_history.db")
+
+    def database_paths(self) -> List[str]:
+        """Every schedules/history file currently on disk"""
+        return sorted(glob.glob(os.path.join(self.base_dir, "*.db")))
+
+
+class ShardedBackend:
+    """Fixed number of shard files; a device's rows live in shard crc32(id) % N"""
+    name = "sharded"
+
+    def __init__(self, shard_dir: str = SHARD_DIR, shards: int = STORAGE_SHARDS):
+        self.shard_dir = shard_dir
+        self.shards = shards
+        os.makedirs(shard_dir, exist_ok=True)
+
+    def shard_for(self, device_id: str) -> int:
+        # crc32 is stable across processes, unlike hash()
+        return zlib.crc32(device_id.encode("utf-8")) % self.shards
+
+    def shard_path(self, shard: int) -> str:
+        return os.path.join(self.shard_dir, f"shard_{shard:03d}.db")
+
+    def schedules_path(self, device_id: str) -> str:
+        return self.shard_path(self.shard_for(device_id))
+
+    def history_path(self, device_id: str) -> str:
+        return self.shard_path(self.shard_for(device_id))
+
+    def database_paths(self) -> List[str]:
+        return [self.shard_path(shard) for shard in range(self.shards)]
+
+
+def create_backend(name: str = STORAGE_BACKEND):
+    if name == PerDeviceBackend.name:
+        return PerDeviceBackend()
+    if name == ShardedBackend.name:
+        return ShardedBackend()
+    raise ValueError(f"Unknown STORAGE_BACKEND: {name}")
+
+
+backend = create_backend()
+
+
+def set_backend(new_backend):
+    """Swap the active backend (migrations, benchmarks)"""
+    global backend
+    backend = new_backend
+
+
+def schedules_path(device_id: str) -> str:
+    return backend.schedules_path(device_id)
+
+
+def history_path(device_id: str) -> str:
+    return backend.history_path(device_id)